@@ -1,19 +1,27 @@
 import ssl
+import socket
+import codecs
 import re
 import random
-import string
+import secrets
+import base64
 import time
 import json
 import http.server
 import http.client
+import html
 import datetime  # 添加此行
+import ipaddress
 from http import HTTPStatus
 from socketserver import ThreadingMixIn
 from urllib import parse
-from threading import Timer, Thread
+from threading import Timer, Thread, Lock, BoundedSemaphore, Condition, Event, get_ident, local
 from publicsuffix2 import PublicSuffixList
 import httpx
+import httpcore
 import gc
+import functools
+import contextlib
 import atexit
 import shutil
 import os
@@ -24,6 +32,19 @@ from loguru import logger
 import glob
 import queue
 import concurrent.futures
+import asyncio
+import io
+import zlib
+import collections
+import email.utils
+import heapq
+import mmap
+import struct
+import stat
+import sqlite3
+import hashlib
+import hmac
+import subprocess
 
 # ------------------ 配置与数据加载 ------------------
 with open('databases/config.json', 'r', encoding='utf-8') as config_file:
@@ -32,19 +53,146 @@ with open('databases/config.json', 'r', encoding='utf-8') as config_file:
 with open('databases/users.json', 'r', encoding='utf-8') as users_file:
     users_data = json.load(users_file)
 
+# ------------------ 多进程模式 ------------------
+# 工作进程编号与继承的监听套接字由主进程通过环境变量传入；单进程运行时 WORKER_ID 为 None
+WORKER_ID = os.environ.get('SILKROAD_WORKER')
+WORKER_LISTEN_FD_ENV = 'SILKROAD_LISTEN_FD'
+# 工作进程异常退出后重新启动前的等待时间（秒），连续快速退出时逐渐加长
+WORKER_RESTART_DELAY = 1
+WORKER_MAX_RESTART_DELAY = 30
+
+def worker_processes():
+    """配置的工作进程数量，1 表示单进程运行"""
+    return max(1, int(config.get('WORKER_PROCESSES', 1)))
+
+def use_reuseport():
+    """各工作进程是否使用 SO_REUSEPORT 自行监听端口（否则共享主进程创建的监听套接字）"""
+    return bool(config.get('WORKER_REUSEPORT', False)) and hasattr(socket, 'SO_REUSEPORT')
+
+def create_listen_socket(server_address, reuseport=False):
+    """创建监听套接字，reuseport 时多个进程可以同时监听同一端口，由内核分配连接"""
+    host, port = server_address
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuseport:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(1024)
+    return sock
+
+def worker_listen_socket(server_address):
+    """工作进程使用的监听套接字：继承自主进程或以 SO_REUSEPORT 自行监听；单进程运行时返回 None"""
+    if WORKER_ID is None:
+        return None
+    fd = os.environ.get(WORKER_LISTEN_FD_ENV)
+    if fd:
+        return socket.socket(fileno=int(fd))
+    return create_listen_socket(server_address, reuseport=True)
+
+class WorkerSupervisor:
+    """多进程模式的主进程：启动 WORKER_PROCESSES 个工作进程，并在工作进程异常退出时重新启动
+
+    每个工作进程都是独立运行的完整服务器（相同的引擎、TLS 证书与配置），HTML 修正等 CPU 密集的工作
+    分散到多个 CPU 核心上。工作进程共享主进程创建的监听套接字，或在配置 WORKER_REUSEPORT 时各自监听同一端口。
+    主进程不加载缓存、会话等状态，只负责监听端口与管理工作进程。
+    """
+    def __init__(self, count, server_address):
+        self.count = count
+        self.server_address = server_address
+        self.workers = {}  # 编号 -> (进程, 启动时间)
+        self.restart_delays = {}
+        self.pending = set()  # 等待重新启动的工作进程编号
+        self.sock = None
+        self.stopping = False
+
+    def start_worker(self, worker_id):
+        env = dict(os.environ, SILKROAD_WORKER=str(worker_id))
+        pass_fds = ()
+        if self.sock is not None:
+            env[WORKER_LISTEN_FD_ENV] = str(self.sock.fileno())
+            pass_fds = (self.sock.fileno(),)
+        proc = subprocess.Popen([sys.executable, os.path.abspath(__file__)] + sys.argv[1:],
+                                env=env, pass_fds=pass_fds)
+        self.workers[worker_id] = (proc, time.time())
+        logger.info(f"工作进程 {worker_id} 已启动，PID {proc.pid}")
+
+    def stop(self, sig=None, frame=None):
+        """结束所有工作进程后退出"""
+        self.stopping = True
+
+    def run(self):
+        if use_reuseport():
+            logger.info(f"多进程模式：{self.count} 个工作进程，使用 SO_REUSEPORT 监听端口 {self.server_address[1]}")
+        else:
+            self.sock = create_listen_socket(self.server_address)
+            logger.info(f"多进程模式：{self.count} 个工作进程，共享监听端口 {self.server_address[1]}")
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        for worker_id in range(1, self.count + 1):
+            self.start_worker(worker_id)
+        while not self.stopping:
+            time.sleep(0.5)
+            for worker_id, (proc, started_at) in list(self.workers.items()):
+                if worker_id in self.pending:
+                    continue
+                returncode = proc.poll()
+                if returncode is None or self.stopping:
+                    continue
+                # 启动后很快就退出时加长等待时间，避免反复崩溃占满 CPU
+                delay = self.restart_delays.get(worker_id, WORKER_RESTART_DELAY)
+                delay = min(delay * 2, WORKER_MAX_RESTART_DELAY) if time.time() - started_at < 10 else WORKER_RESTART_DELAY
+                self.restart_delays[worker_id] = delay
+                logger.warning(f"工作进程 {worker_id}（PID {proc.pid}）已退出，退出码 {returncode}，{delay} 秒后重新启动")
+                self.pending.add(worker_id)
+                Timer(delay, self._restart, args=(worker_id,)).start()
+        logger.info("正在停止所有工作进程...")
+        for proc, _ in self.workers.values():
+            if proc.poll() is None:
+                proc.terminate()
+        for proc, _ in self.workers.values():
+            try:
+                proc.wait(timeout=10)
+            except Exception:
+                proc.kill()
+
+    def _restart(self, worker_id):
+        if not self.stopping:
+            self.start_worker(worker_id)
+        self.pending.discard(worker_id)
+
+# 日志中注明所属进程
+if WORKER_ID is not None or (__name__ == '__main__' and worker_processes() > 1):
+    _process_tag = f"worker {WORKER_ID}" if WORKER_ID is not None else "主进程"
+    logger.configure(patcher=lambda record: record.update(message=f"[{_process_tag}] {record['message']}"))
+
+# 多进程模式下主进程在加载其余模块状态之前进入，只负责管理工作进程
+if __name__ == '__main__' and WORKER_ID is None and worker_processes() > 1 and '--benchmark' not in sys.argv:
+    if os.name == 'posix':
+        logger.add(config['LOG_FILE'], rotation="500 MB", level="INFO")
+        WorkerSupervisor(worker_processes(), (config['BIND_IP'], config['PORT'])).run()
+        sys.exit(0)
+    logger.warning("当前平台不支持多进程模式，以单进程运行")
+
 # 设置 http.client 最大请求头数量，修复 "get more than 100 headers" 错误
 http.client._MAXHEADERS = 1000
 
 # ------------------ 系统与资源管理 ------------------
+def start_timer(interval, function):
+    """在后台定时执行一次维护任务；使用守护线程，自我重新调度的定时器不会阻止进程退出"""
+    timer = Timer(interval, function)
+    timer.daemon = True
+    timer.start()
+    return timer
+
 def periodic_gc():
     """定时释放内存，每1分钟执行一次垃圾回收"""
     gc.collect()
-    Timer(60, periodic_gc).start()
+    start_timer(60, periodic_gc)
 
 periodic_gc()
 
 def clear_temp_cache():
-    """程序退出时清除 temp 文件夹中的缓存（包括编译后的 .pyc 与网站缓存）"""
+    """清除 temp 文件夹中的全部网站缓存"""
     # 确保使用程序所在目录
     temp_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "temp")
     if os.path.exists(temp_dir):
@@ -74,584 +222,2852 @@ def clear_temp_cache():
         except Exception as e:
             logger.error(f"清除缓存目录时出错: {e}")
 
-# 注册清理函数
-atexit.register(clear_temp_cache)
-
 # ------------------ 脚本管理 ------------------
+# 合并后的自定义脚本的访问路径，注入页面的是带内容版本参数的 <script src>
+SCRIPT_BUNDLE_PATH = '/scripts/bundle.js'
+# 检查脚本目录变化的间隔（秒）
+SCRIPT_WATCH_INTERVAL = 1
+# 可以出现在正则字面量之前的符号与关键字，其余位置的 / 是除号
+JS_REGEX_PRECEDERS = frozenset('(,=:[!&|?{};+-*%<>~^')
+JS_REGEX_KEYWORDS = frozenset(('return', 'typeof', 'case', 'do', 'else', 'in', 'instanceof',
+                               'new', 'delete', 'void', 'throw', 'yield', 'await'))
+
+def _js_word_char(c):
+    return c.isalnum() or c in '_$' or ord(c) > 127
+
+def _js_scan_string(source, i):
+    """返回从 i 开始的字符串字面量（单双引号或模板字符串）之后的位置"""
+    quote = source[i]
+    n = len(source)
+    j = i + 1
+    while j < n:
+        c = source[j]
+        if c == '\\':
+            j += 2
+            continue
+        if c == quote:
+            return j + 1
+        if quote == '`' and c == '$' and source.startswith('{', j + 1):
+            # 模板字符串中的 ${...} 表达式原样保留
+            depth = 1
+            j += 2
+            while j < n and depth:
+                c = source[j]
+                if c in '\'"`':
+                    j = _js_scan_string(source, j)
+                    continue
+                depth += (c == '{') - (c == '}')
+                j += 1
+            continue
+        if c == '\n' and quote != '`':
+            return j
+        j += 1
+    return n
+
+def _js_scan_regex(source, i):
+    """返回从 i 开始的正则字面量（含标志）之后的位置"""
+    n = len(source)
+    j = i + 1
+    in_class = False
+    while j < n:
+        c = source[j]
+        if c == '\\':
+            j += 2
+            continue
+        if c == '\n':
+            return j
+        if c == '[':
+            in_class = True
+        elif c == ']':
+            in_class = False
+        elif c == '/' and not in_class:
+            j += 1
+            break
+        j += 1
+    while j < n and _js_word_char(source[j]):
+        j += 1
+    return j
+
+def minify_js(source):
+    """压缩脚本：去除注释、缩进与空行，合并多余空白
+
+    字符串、模板字符串与正则字面量原样保留；换行不会被删除，不影响自动分号插入。
+    """
+    out = []
+    n = len(source)
+    i = 0
+    last = ''       # 上一个输出的字符
+    last_word = ''  # 上一个输出的标识符或关键字
+    pending = ''    # 待输出的空白
+    while i < n:
+        c = source[i]
+        if c.isspace():
+            j = i
+            while j < n and source[j].isspace():
+                j += 1
+            if '\n' in source[i:j]:
+                pending = '\n'
+            elif not pending:
+                pending = ' '
+            i = j
+            continue
+        if c == '/' and source.startswith('/', i + 1):
+            j = source.find('\n', i)
+            i = n if j == -1 else j
+            continue
+        if c == '/' and source.startswith('*', i + 1):
+            j = source.find('*/', i + 2)
+            j = n if j == -1 else j + 2
+            if '\n' in source[i:j]:
+                pending = '\n'
+            elif not pending:
+                pending = ' '
+            i = j
+            continue
+        if pending and out:
+            if pending == '\n':
+                out.append('\n')
+            elif (_js_word_char(last) and _js_word_char(c)) or (last in '+-' and c in '+-'):
+                out.append(' ')
+        pending = ''
+        if c in '\'"`':
+            j = _js_scan_string(source, i)
+            last_word = ''
+        elif c == '/' and (not last or last in JS_REGEX_PRECEDERS or last_word in JS_REGEX_KEYWORDS):
+            j = _js_scan_regex(source, i)
+            last_word = ''
+        elif _js_word_char(c):
+            j = i + 1
+            while j < n and _js_word_char(source[j]):
+                j += 1
+            last_word = source[i:j]
+        else:
+            j = i + 1
+            last_word = ''
+        out.append(source[i:j])
+        last = source[j - 1]
+        i = j
+    return ''.join(out)
+
+class ScriptBundle:
+    """合并压缩后的自定义脚本及其内容哈希"""
+    __slots__ = ('content', 'digest', 'etag', 'last_modified', 'script_tags')
+
+    def __init__(self, content, digest, last_modified, script_tags):
+        self.content = content
+        self.digest = digest
+        self.etag = f'"{digest}"'
+        self.last_modified = last_modified
+        self.script_tags = script_tags
+
+    @property
+    def version(self):
+        """脚本 URL 中的版本参数"""
+        return self.digest[:12]
+
 class ScriptManager:
-    """管理自定义JS脚本的类"""
+    """管理自定义JS脚本的类
+
+    scripts 目录下的脚本合并压缩为一个文件，通过带内容版本参数的 URL 提供，
+    页面中只插入一个 <script src> 标签，浏览器可以长期缓存脚本内容。
+    目录由后台定时检查文件的修改时间与大小，发生变化时重新生成，请求处理中不再读取目录。
+    """
     def __init__(self):
         self.scripts_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "scripts")
         self.scripts_cache = {}
-        self.last_load_time = 0
-        self.cache_ttl = 60  # 缓存有效期（秒）
+        # 合并后的脚本与目录状态（文件名、修改时间、大小）
+        self.bundle = None
+        self.signature = None
+        self.lock = Lock()
         
         # 确保脚本目录存在
         if not os.path.exists(self.scripts_dir):
             os.makedirs(self.scripts_dir)
             logger.info(f"创建脚本目录: {self.scripts_dir}")
+
+        self.reload()
+        self._schedule_watch()
+
+    def _schedule_watch(self):
+        start_timer(SCRIPT_WATCH_INTERVAL, self._watch)
+
+    def _watch(self):
+        """检查脚本目录是否变化"""
+        try:
+            if self._signature() != self.signature:
+                self.reload()
+        except Exception as e:
+            logger.error(f"检查脚本目录失败: {e}")
+        finally:
+            self._schedule_watch()
+
+    def _signature(self):
+        signature = []
+        with os.scandir(self.scripts_dir) as it:
+            for entry in it:
+                if entry.name.endswith('.js') and entry.is_file():
+                    file_stat = entry.stat()
+                    signature.append((entry.name, file_stat.st_mtime_ns, file_stat.st_size))
+        return tuple(sorted(signature))
+
+    def reload(self):
+        """重新加载所有脚本，内容变化时重新生成合并文件"""
+        with self.lock:
+            signature = self._signature()
+            scripts = {}
+            for script_path in sorted(glob.glob(os.path.join(self.scripts_dir, "*.js"))):
+                try:
+                    script_name = os.path.basename(script_path)
+                    with open(script_path, 'r', encoding='utf-8') as f:
+                        script_content = f.read()
+                    scripts[script_name] = script_content
+                    logger.debug(f"加载脚本: {script_name}")
+                except Exception as e:
+                    logger.error(f"加载脚本 {script_path} 失败: {e}")
+            self.signature = signature
+            if scripts == self.scripts_cache and self.bundle is not None:
+                return
+            self.bundle = self._build_bundle(scripts)
+            self.scripts_cache = scripts
+            if scripts:
+                logger.info(f"自定义脚本已合并: {len(scripts)} 个文件，{len(self.bundle.content)} 字节，版本 {self.bundle.version}")
     
     def get_all_scripts(self):
         """获取所有JS脚本内容"""
-        current_time = time.time()
-        
-        # 如果缓存未过期，直接返回缓存内容
-        if current_time - self.last_load_time < self.cache_ttl and self.scripts_cache:
-            return self.scripts_cache
-        
-        # 重新加载所有脚本
-        scripts = {}
-        script_files = glob.glob(os.path.join(self.scripts_dir, "*.js"))
-        
-        for script_path in script_files:
-            try:
-                script_name = os.path.basename(script_path)
-                with open(script_path, 'r', encoding='utf-8') as f:
-                    script_content = f.read()
-                scripts[script_name] = script_content
-                logger.debug(f"加载脚本: {script_name}")
-            except Exception as e:
-                logger.error(f"加载脚本 {script_path} 失败: {e}")
-        
-        # 更新缓存
-        self.scripts_cache = scripts
-        self.last_load_time = current_time
-        
-        return scripts
+        return self.scripts_cache
+
+    def get_script_tags(self):
+        """获取插入到HTML页面中的脚本标签（已编码为UTF-8）及其版本号（合并脚本的内容哈希）"""
+        bundle = self.bundle
+        return bundle.script_tags, bundle.digest
+
+    def _build_bundle(self, scripts):
+        """合并压缩所有脚本，生成插入到</body>之后的脚本标签"""
+        parts = []
+        for script_name, script_content in scripts.items():
+            # 每个脚本以分号结束，避免与下一个脚本连在一起
+            parts.append(f"/* {script_name} */\n{minify_js(script_content)}\n;\n")
+        content = ''.join(parts).encode('utf-8')
+        digest = hashlib.md5(content).hexdigest()
+        last_modified = email.utils.formatdate(time.time(), usegmt=True)
+        if not scripts:
+            return ScriptBundle(content, digest, last_modified, b'')
+        script_tags = (f'\n<script src="{config.get("SERVER", "")}{SCRIPT_BUNDLE_PATH}?v={digest[:12]}">'
+                       f'</script>\n').encode('utf-8')
+        return ScriptBundle(content, digest, last_modified, script_tags)
 
 # 初始化脚本管理器
 script_manager = ScriptManager()
 
 # ------------------ HTTP连接池管理 ------------------
-class HttpClientPool:
-    def __init__(self, pool_size=100):
-        self.pool = queue.Queue(maxsize=pool_size)
-        self.pool_size = pool_size
-        self.created_clients = 0  # 跟踪已创建的客户端数量
-        # 延迟初始化，不再一次性创建所有客户端
-        # 而是按需创建，最多创建pool_size个
-        
-    def init_pool(self):
-        # 此方法不再使用，保留为空以兼容现有代码
-        pass
-    
-    def get_client(self):
-        try:
-            return self.pool.get(block=False)
-        except queue.Empty:
-            # 如果池已空且未达到最大数量，创建新客户端
-            if self.created_clients < self.pool_size:
-                self.created_clients += 1
-                logger.debug(f"创建新的HTTP客户端 ({self.created_clients}/{self.pool_size})")
-                return httpx.Client(
-                    verify=False,
-                    follow_redirects=False,
-                    timeout=30.0,
-                    http2=False,
-                    transport=httpx.HTTPTransport(retries=2)
-                )
-            else:
-                # 如果已达到最大数量，等待可用客户端（最多等待1秒）
-                try:
-                    return self.pool.get(block=True, timeout=1)
-                except queue.Empty:
-                    # 如果等待超时，创建临时客户端（不计入池中）
-                    logger.warning("HTTP客户端池已满且无可用客户端，创建临时客户端")
-                    return httpx.Client(
-                        verify=False,
-                        follow_redirects=False,
-                        timeout=30.0,
-                        http2=False,
-                        transport=httpx.HTTPTransport(retries=2)
-                    )
-    
-    def release_client(self, client):
-        try:
-            # 检查客户端是否仍然可用
-            if hasattr(client, 'is_closed') and not client.is_closed:
-                # 如果客户端有is_closed属性且未关闭
-                self.pool.put(client, block=False)
-            elif not hasattr(client, 'is_closed') and hasattr(client, '_transport') and not client._transport.is_closed:
-                # 如果客户端没有is_closed属性但有_transport属性且未关闭
-                self.pool.put(client, block=False)
-            else:
-                # 客户端已关闭，减少计数
-                self.created_clients -= 1
-                client.close()
-        except queue.Full:
-            # 如果池已满，关闭客户端
-            client.close()
-        except Exception as e:
-            # 处理其他异常
-            logger.error(f"释放HTTP客户端时出错: {e}")
-            try:
-                client.close()
-            except:
-                pass
+# HTTP/2 依赖可选的 h2 库（pip install h2），未安装时只使用 HTTP/1.1
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
 
-# ------------------ 缓存管理类 ------------------
-class CacheManager:
-    """管理系统缓存的类"""
-    def __init__(self):
-        # 使用程序所在目录
-        self.base_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "temp")
-        self.html_cache_dir = os.path.join(self.base_dir, "html")
-        self.media_cache_dir = os.path.join(self.base_dir, "media")
-        self.response_cache_dir = os.path.join(self.base_dir, "responses")
-        self.max_cache_size = 500 * 1024 * 1024  # 500MB
-        self.max_cache_age = 24 * 60 * 60  # 24小时
-        
-        # 从配置文件中读取缓存设置
-        self.cache_enabled = config.get("CACHE_ENABLED", True)  # 默认启用缓存
-        self.cache_html = config.get("CACHE_HTML", True)  # 默认缓存HTML
-        self.cache_media = config.get("CACHE_MEDIA", True)  # 默认缓存媒体文件
-        self.cache_other = config.get("CACHE_OTHER", True)  # 默认缓存其他响应
-        self.cache_large_files = config.get("CACHE_LARGE_FILES", False)  # 默认不缓存大文件
-        
-        # 确保缓存目录存在
-        self._ensure_cache_dirs()
-        
-        # 启动定期清理任务
-        self._schedule_cleanup()
-        
-        logger.info(f"缓存状态: {'启用' if self.cache_enabled else '禁用'}")
-        if self.cache_enabled:
-            logger.info(f"缓存配置: HTML({'启用' if self.cache_html else '禁用'}), "
-                       f"媒体文件({'启用' if self.cache_media else '禁用'}), "
-                       f"其他响应({'启用' if self.cache_other else '禁用'}), "
-                       f"大文件({'启用' if self.cache_large_files else '禁用'})")
-    def _ensure_cache_dirs(self):
-        """确保所有缓存目录存在"""
-        for dir_path in [self.base_dir, self.html_cache_dir, 
-                         self.media_cache_dir, self.response_cache_dir]:
-            if not os.path.exists(dir_path):
-                os.makedirs(dir_path)
-                logger.debug(f"创建缓存目录: {dir_path}")
-    
-    def _schedule_cleanup(self):
-        """安排定期清理任务"""
-        cleanup_interval = 3600  # 每小时清理一次
-        Timer(cleanup_interval, self._cleanup_cache).start()
-    
-    def _cleanup_cache(self):
-        """清理过期和过大的缓存"""
+# ------------------ 上游 DNS 缓存与预连接 ------------------
+# 缓存的主机数量上限
+DNS_CACHE_SIZE = 1024
+# 等待同一主机正在进行的解析的最长时间（秒）
+DNS_WAIT_TIMEOUT = 10
+# 每个页面最多预连接的其他源站数量
+PRECONNECT_MAX_ORIGINS = 8
+# 预先建立的连接在多长时间内未被使用则关闭（秒），需短于一般服务器的空闲超时
+PRECONNECT_IDLE_TIMEOUT = 10
+# 预先建立连接的超时时间（秒）
+PRECONNECT_TIMEOUT = 5
+# 同时保留与正在建立的预连接数量上限，以及执行预连接的后台线程数
+PRECONNECT_MAX_WARM = 32
+PRECONNECT_WORKERS = 4
+# HTML 中带引号的绝对链接与协议相对链接的主机和端口（与链接修正规则匹配的位置一致）
+PRECONNECT_ORIGIN_RE = re.compile(rb'["\'](https?:)?//([a-zA-Z0-9.-]+)(?::(\d{1,5}))?(?=[/"\'?#\s>])')
+
+class DnsCache:
+    """进程内的上游 DNS 缓存
+
+    标准库的解析接口不提供记录的 TTL，解析结果按 DNS_CACHE_TTL 缓存；解析失败的结果按
+    DNS_NEGATIVE_TTL 缓存（负缓存），不存在的域名不会被反复解析。使用缓存的地址连接失败时条目立即作废，
+    下次重新解析。同一主机的并发解析只执行一次，其余线程等待结果。
+    """
+    def __init__(self, ttl=60, negative_ttl=10, max_entries=DNS_CACHE_SIZE):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.max_entries = max_entries
+        # 主机 -> (过期时间, 地址列表, 解析错误参数)
+        self.entries = {}
+        self.inflight = {}
+        self.lock = Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'negative_hits': 0, 'failures': 0, 'invalidations': 0}
+
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def resolve_cached(self, host):
+        """不解析，只返回 IP 地址或缓存中的地址列表；缓存的是解析失败时抛出 socket.gaierror，未缓存时返回 None"""
+        if host_classifier.classify(host).is_ip:
+            return [host]
+        entry = self.entries.get(host)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        if entry[2] is not None:
+            self._count('negative_hits')
+            raise socket.gaierror(*entry[2])
+        self._count('hits')
+        return entry[1]
+
+    def resolve(self, host, port):
+        """返回主机的地址列表，解析失败时抛出 socket.gaierror"""
+        addresses = self.resolve_cached(host)
+        if addresses is not None:
+            return addresses
+        with self.lock:
+            event = self.inflight.get(host)
+            leader = event is None
+            if leader:
+                event = self.inflight[host] = Event()
+        if not leader:
+            # 等待同一主机正在进行的解析，超时后自行解析
+            event.wait(DNS_WAIT_TIMEOUT)
+            addresses = self.resolve_cached(host)
+            if addresses is not None:
+                return addresses
         try:
-            logger.info("开始清理缓存...")
-            now = time.time()
-            total_size = 0
-            files_info = []
-            
-            # 收集所有缓存文件信息
-            for root, _, files in os.walk(self.base_dir):
-                for file in files:
-                    file_path = os.path.join(root, file)
-                    try:
-                        file_stat = os.stat(file_path)
-                        file_size = file_stat.st_size
-                        file_mtime = file_stat.st_mtime
-                        total_size += file_size
-                        files_info.append((file_path, file_size, file_mtime))
-                    except (FileNotFoundError, PermissionError) as e:
-                        logger.warning(f"无法获取文件信息 {file_path}: {e}")
-            
-            # 删除过期文件
-            expired_files = [(path, size) for path, size, mtime in files_info 
-                            if now - mtime > self.max_cache_age]
-            for path, size in expired_files:
-                try:
-                    os.remove(path)
-                    total_size -= size
-                    logger.debug(f"删除过期缓存文件: {path}")
-                except (FileNotFoundError, PermissionError) as e:
-                    logger.warning(f"无法删除文件 {path}: {e}")
-            
-            # 如果缓存仍然过大，按最后访问时间排序删除
-            if total_size > self.max_cache_size:
-                remaining_files = [(path, size, mtime) for path, size, mtime in files_info 
-                                if not any(path == exp_path for exp_path, _ in expired_files)]
-                remaining_files.sort(key=lambda x: x[2])  # 按修改时间排序
-                
-                for path, size, _ in remaining_files:
-                    if total_size <= self.max_cache_size:
-                        break
-                    try:
-                        os.remove(path)
-                        total_size -= size
-                        logger.debug(f"删除过大缓存文件: {path}")
-                    except (FileNotFoundError, PermissionError) as e:
-                        logger.warning(f"无法删除文件 {path}: {e}")
-            
-            logger.info(f"缓存清理完成，当前缓存大小: {total_size / 1024 / 1024:.2f}MB")
-            
-            # 重新安排下一次清理
-            self._schedule_cleanup()
-        except Exception as e:
-            logger.error(f"缓存清理过程中出错: {e}")
-            # 即使出错也要重新安排清理
-            self._schedule_cleanup()
-    
-    def get_cache_path(self, url, content_type=None):
-        """根据URL和内容类型获取缓存路径"""
-        # 使用URL的哈希值作为文件名，避免路径过长或包含非法字符
-        import hashlib
-        url_hash = hashlib.md5(url.encode()).hexdigest()
-        
-        # 根据内容类型选择缓存目录
-        if content_type and "text/html" in content_type:
-            cache_dir = self.html_cache_dir
-            ext = ".html"
-        elif content_type and ("image/" in content_type or "video/" in content_type or "audio/" in content_type):
-            cache_dir = self.media_cache_dir
-            # 从content_type中提取扩展名
-            ext = "." + content_type.split("/")[-1].split(";")[0]
-        else:
-            cache_dir = self.response_cache_dir
-            ext = ".dat"
-        
-        return os.path.join(cache_dir, url_hash + ext)
-    
-    def save_to_cache(self, url, content, content_type=None, headers=None):
-        """保存响应内容到缓存"""
-        # 如果缓存被全局禁用，直接返回
-        if not self.cache_enabled:
-            return False
-            
-        # 根据内容类型决定是否缓存
-        if content_type:
-            if "text/html" in content_type and not self.cache_html:
-                return False
-            elif ("image/" in content_type or "video/" in content_type or "audio/" in content_type) and not self.cache_media:
-                return False
-            elif not self.cache_other:
-                return False
-                
-        # 检查文件大小，如果是大文件且未启用大文件缓存，则不缓存
-        if len(content) > 1024 * 1024 and not self.cache_large_files:  # 大于1MB
-            return False
-            
+            return self._lookup(host, port)
+        finally:
+            if leader:
+                with self.lock:
+                    self.inflight.pop(host, None)
+                event.set()
+
+    def _lookup(self, host, port):
         try:
-            cache_path = self.get_cache_path(url, content_type)
-            
-            # 保存内容
-            with open(cache_path, 'wb') as f:
-                f.write(content)
-            
-            # 如果提供了headers，也保存它们
-            if headers:
-                headers_path = cache_path + ".headers"
-                with open(headers_path, 'w', encoding='utf-8') as f:
-                    json.dump(dict(headers), f)
-            
-            logger.debug(f"已缓存: {url} -> {cache_path}")
-            return True
-        except Exception as e:
-            logger.warning(f"缓存保存失败 {url}: {e}")
-            return False
-    
-    def get_from_cache(self, url, content_type=None):
-        """从缓存获取响应内容"""
-        # 如果缓存被全局禁用，直接返回None
-        if not self.cache_enabled:
-            return None, None
-            
-        # 根据内容类型决定是否使用缓存
-        if content_type:
-            if "text/html" in content_type and not self.cache_html:
-                return None, None
-            elif ("image/" in content_type or "video/" in content_type or "audio/" in content_type) and not self.cache_media:
-                return None, None
-            elif not self.cache_other:
-                return None, None
-                
+            infos = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+            addresses = list(dict.fromkeys(info[4][0] for info in infos))
+            error = None
+        except (OSError, UnicodeError) as e:
+            addresses = []
+            error = e.args if isinstance(e, socket.gaierror) else (socket.EAI_FAIL, str(e))
+        ttl = self.ttl if error is None else self.negative_ttl
+        with self.lock:
+            self.stats['misses' if error is None else 'failures'] += 1
+            if len(self.entries) >= self.max_entries:
+                self._purge_locked()
+            self.entries[host] = (time.monotonic() + ttl, addresses, error)
+        if error is not None:
+            raise socket.gaierror(*error)
+        return addresses
+
+    def _purge_locked(self):
+        """删除过期条目，仍然超出上限时删除最早加入的一半"""
+        now = time.monotonic()
+        for host in [host for host, entry in self.entries.items() if entry[0] < now]:
+            del self.entries[host]
+        if len(self.entries) >= self.max_entries:
+            for host in list(self.entries)[:len(self.entries) // 2]:
+                del self.entries[host]
+
+    def invalidate(self, host):
+        """连接缓存的地址失败时作废该主机的条目"""
+        with self.lock:
+            if self.entries.pop(host, None) is not None:
+                self.stats['invalidations'] += 1
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats, entries=len(self.entries))
+
+dns_cache = DnsCache(config.get('DNS_CACHE_TTL', 60), config.get('DNS_NEGATIVE_TTL', 10))
+
+class PreconnectedStream(httpcore.NetworkStream):
+    """预先建立的连接；已完成 TLS 握手时，连接池再调用 start_tls 直接返回原连接"""
+    def __init__(self, stream, tls):
+        self.stream = stream
+        self.tls = tls
+
+    def read(self, max_bytes, timeout=None):
+        return self.stream.read(max_bytes, timeout)
+
+    def write(self, buffer, timeout=None):
+        self.stream.write(buffer, timeout)
+
+    def close(self):
+        self.stream.close()
+
+    def start_tls(self, ssl_context, server_hostname=None, timeout=None):
+        if self.tls:
+            return self.stream
+        return self.stream.start_tls(ssl_context, server_hostname, timeout)
+
+    def get_extra_info(self, info):
+        return self.stream.get_extra_info(info)
+
+class CachedDnsBackend(httpcore.NetworkBackend):
+    """上游连接池的网络层：通过 DNS 缓存解析主机，并优先取用预先建立的连接"""
+    def __init__(self, backend, resolver, preconnector=None):
+        self.backend = backend
+        self.resolver = resolver
+        self.preconnector = preconnector
+
+    def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
+        if self.preconnector is not None:
+            # 网络层不知道连接用于哪种协议，由发起请求的线程登记（见 HttpClientPool.stream）
+            scheme = getattr(self.preconnector.request_scheme, 'value', None)
+            stream = self.preconnector.take(scheme, host, port) if scheme else None
+            if stream is not None:
+                return stream
+        return self.connect_resolved(host, port, timeout, local_address, socket_options)
+
+    def connect_resolved(self, host, port, timeout=None, local_address=None, socket_options=None):
+        """依次连接主机解析出的地址"""
         try:
-            cache_path = self.get_cache_path(url, content_type)
-            headers_path = cache_path + ".headers"
-            
-            # 检查缓存是否存在且未过期
-            if not os.path.exists(cache_path):
-                return None, None
-            
-            file_stat = os.stat(cache_path)
-            if time.time() - file_stat.st_mtime > self.max_cache_age:
-                # 缓存已过期，删除并返回None
-                os.remove(cache_path)
-                if os.path.exists(headers_path):
-                    os.remove(headers_path)
-                return None, None
-            
-            # 读取缓存内容
-            with open(cache_path, 'rb') as f:
-                content = f.read()
-            
-            # 读取headers（如果存在）
-            headers = None
-            if os.path.exists(headers_path):
-                with open(headers_path, 'r', encoding='utf-8') as f:
-                    headers = json.load(f)
-            
-            # 更新访问时间
-            os.utime(cache_path, None)
-            if os.path.exists(headers_path):
-                os.utime(headers_path, None)
-            
-            logger.debug(f"缓存命中: {url}")
-            return content, headers
-        except Exception as e:
-            logger.warning(f"读取缓存失败 {url}: {e}")
-            return None, None
-    
-    def clear_cache(self, url=None, content_type=None):
-        """清除特定URL的缓存或所有缓存"""
-        if url:
+            addresses = self.resolver.resolve(host, port)
+        except OSError as e:
+            raise httpcore.ConnectError(str(e)) from e
+        error = httpcore.ConnectError(f"无法解析 {host}")
+        for address in addresses:
             try:
-                cache_path = self.get_cache_path(url, content_type)
-                headers_path = cache_path + ".headers"
-                
-                if os.path.exists(cache_path):
-                    os.remove(cache_path)
-                if os.path.exists(headers_path):
-                    os.remove(headers_path)
-                logger.debug(f"已清除缓存: {url}")
-            except Exception as e:
-                logger.warning(f"清除缓存失败 {url}: {e}")
-        else:
-            # 清除所有缓存
-            clear_temp_cache()
-            self._ensure_cache_dirs()
-            logger.info("已清除所有缓存")
+                return self.backend.connect_tcp(address, port, timeout, local_address, socket_options)
+            except httpcore.ConnectError as e:
+                error = e
+            except httpcore.ConnectTimeout:
+                self.resolver.invalidate(host)
+                raise
+        self.resolver.invalidate(host)
+        raise error
 
-# 创建缓存管理器实例
-cache_manager = CacheManager()
+    def connect_unix_socket(self, path, timeout=None, socket_options=None):
+        return self.backend.connect_unix_socket(path, timeout, socket_options)
 
-# 添加系统自检和缓存清理函数
-def system_check_and_cleanup():
-    """系统启动时的自检和缓存清理"""
-    logger.info("开始系统自检和缓存清理...")
-    
-    # 1. 检查必要的目录是否存在，不存在则创建
-    required_dirs = ["temp", "databases", "templates"]
-    for dir_name in required_dirs:
-        dir_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), dir_name)
-        if not os.path.exists(dir_path):
-            os.makedirs(dir_path)
-            logger.info(f"创建目录: {dir_path}")
-    
-    # 2. 清除自身缓存
-    # 清除临时文件夹
-    clear_temp_cache()
-    
-    # 清除__pycache__文件夹
-    pycache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "__pycache__")
-    if os.path.exists(pycache_dir):
-        shutil.rmtree(pycache_dir)
-        logger.info("清除 __pycache__ 目录")
-    
-    # 3. 检查配置文件完整性
-    try:
-        required_configs = ["SERVER", "DOMAIN", "PORT", "BIND_IP", "SCHEME", 
-                           "LOGIN_PATH", "FAVICON_PATH", "INDEX_FILE", "LOGIN_FILE", "CHAT_FILE",
-                           "FAVICON_FILE", "SESSION_COOKIE_NAME", "SERVER_NAME", "LOG_FILE"]
-        missing_configs = [cfg for cfg in required_configs if cfg not in config]
-        if missing_configs:
-            logger.warning(f"配置文件缺少以下项: {', '.join(missing_configs)}")
-    except Exception as e:
-        logger.error(f"检查配置文件时出错: {e}")
-    
-    # 4. 初始化缓存目录结构
-    cache_manager._ensure_cache_dirs()
-    
-    logger.info("系统自检和缓存清理完成")
+    def sleep(self, seconds):
+        self.backend.sleep(seconds)
 
+class AsyncCachedDnsBackend(httpcore.AsyncNetworkBackend):
+    """CachedDnsBackend 的异步版本，缓存未命中时在线程池中解析"""
+    def __init__(self, backend, resolver):
+        self.backend = backend
+        self.resolver = resolver
 
-def exit_confirmation():
-    """退出程序时弹出确认对话框"""
-    # 在Windows系统上使用tkinter创建图形化对话框
-    if platform.system() == "Windows":
+    async def connect_tcp(self, host, port, timeout=None, local_address=None, socket_options=None):
         try:
-            import tkinter as tk
-            from tkinter import messagebox
-            
-            # 创建隐藏的根窗口
-            root = tk.Tk()
-            root.withdraw()
-            
-            # 显示确认对话框
-            result = messagebox.askyesno("退出确认", "是否退出程序？")
-            root.destroy()
-            return result
-        except ImportError:
-            # 如果tkinter不可用，回退到控制台输入
+            addresses = self.resolver.resolve_cached(host)
+            if addresses is None:
+                addresses = await asyncio.get_running_loop().run_in_executor(None, self.resolver.resolve, host, port)
+        except OSError as e:
+            raise httpcore.ConnectError(str(e)) from e
+        error = httpcore.ConnectError(f"无法解析 {host}")
+        for address in addresses:
+            try:
+                return await self.backend.connect_tcp(address, port, timeout, local_address, socket_options)
+            except httpcore.ConnectError as e:
+                error = e
+            except httpcore.ConnectTimeout:
+                self.resolver.invalidate(host)
+                raise
+        self.resolver.invalidate(host)
+        raise error
+
+    async def connect_unix_socket(self, path, timeout=None, socket_options=None):
+        return await self.backend.connect_unix_socket(path, timeout, socket_options)
+
+    async def sleep(self, seconds):
+        await self.backend.sleep(seconds)
+
+class Preconnector:
+    """在后台为页面引用的源站预先解析 DNS 并建立连接（HTTPS 源站同时完成 TLS 握手）
+
+    预建的连接按 (协议, 主机, 端口) 保存，连接池新建到该源站的连接时直接取用，浏览器随后请求子资源时
+    省去 DNS 解析与握手的延迟。超过 PRECONNECT_IDLE_TIMEOUT 未被使用或已被服务器关闭的连接会被丢弃。
+    warm 为 False 时（异步引擎的连接池无法使用同步连接）只预解析 DNS。
+    """
+    def __init__(self, resolver, http2, warm=True):
+        self.resolver = resolver
+        self.http2 = http2
+        self.warm = warm
+        # 预连接使用独立的 SSL 上下文，ALPN 只在创建时设置一次，不在后台线程中修改连接池共享的上下文
+        self.ssl_context = httpx.create_ssl_context(verify=False)
+        self.ssl_context.set_alpn_protocols(['http/1.1', 'h2'] if http2 else ['http/1.1'])
+        # 建立连接的函数，由连接池的网络层提供
+        self.connect = None
+        # 当前线程正在发送的请求的协议，网络层据此取用对应协议的预建连接
+        self.request_scheme = local()
+        self.streams = {}
+        self.pending = set()
+        self.lock = Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=PRECONNECT_WORKERS,
+                                                              thread_name_prefix="SilkRoad-Preconnect")
+        self.stats = {'dns_prefetches': 0, 'preconnects': 0, 'used': 0, 'expired': 0, 'failed': 0}
+
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def submit(self, scheme, host, port):
+        """在后台预连接源站，已有预建连接或正在预连接时忽略"""
+        key = (scheme, host, port)
+        with self.lock:
+            self._sweep_locked()
+            if key in self.pending or key in self.streams or len(self.pending) + len(self.streams) >= PRECONNECT_MAX_WARM:
+                return
+            self.pending.add(key)
+        self.executor.submit(self._preconnect, scheme, host, port)
+
+    def _preconnect(self, scheme, host, port):
+        key = (scheme, host, port)
+        try:
+            self.resolver.resolve(host, port)
+            self._count('dns_prefetches')
+            if not self.warm or self.connect is None:
+                return
+            stream = self.connect(host, port, PRECONNECT_TIMEOUT)
+            tls = scheme == 'https'
+            if tls:
+                stream = stream.start_tls(self.ssl_context, server_hostname=host, timeout=PRECONNECT_TIMEOUT)
+            with self.lock:
+                self.streams[key] = (time.monotonic(), PreconnectedStream(stream, tls))
+                self.stats['preconnects'] += 1
+        except Exception as e:
+            self._count('failed')
+            logger.debug(f"预连接 {scheme}://{host}:{port} 失败: {e}")
+        finally:
+            with self.lock:
+                self.pending.discard(key)
+
+    def take(self, scheme, host, port):
+        """取出到 (协议, 主机, 端口) 的预建连接，没有可用连接时返回 None"""
+        if not self.streams:
+            return None
+        with self.lock:
+            item = self.streams.pop((scheme, host, port), None)
+        if item is None:
+            return None
+        created, stream = item
+        if time.monotonic() - created > PRECONNECT_IDLE_TIMEOUT or not self._alive(stream):
+            stream.close()
+            self._count('expired')
+            return None
+        self._count('used')
+        return stream
+
+    @staticmethod
+    def _alive(stream):
+        """空闲连接可读说明已被服务器关闭；TLS 1.3 服务器在握手后发送的会话票据也会使连接可读，
+        此时尝试读取，没有应用数据（读取超时）说明连接仍然可用"""
+        if not stream.get_extra_info('is_readable'):
+            return True
+        if not stream.tls:
+            return False
+        try:
+            stream.read(1, timeout=0.001)
+        except httpcore.ReadTimeout:
+            return True
+        except Exception:
             pass
-    
-    # 非Windows系统或tkinter不可用时使用控制台输入
-    print("\n检测到退出信号。是否退出程序？(y/N): ", end='', flush=True)
-    response = sys.stdin.readline().strip().lower()
-    return response == 'y'
+        return False
 
-def signal_handler(sig, frame):
-    if exit_confirmation():
-        logger.info("程序退出，正在清理缓存...")
-        # 强制终止所有线程并退出
-        os._exit(0)
-    else:
-        logger.info("继续运行程序。")
+    def _sweep_locked(self):
+        """关闭超过空闲时间未被使用的预建连接"""
+        now = time.monotonic()
+        for key in [key for key, (created, _) in self.streams.items() if now - created > PRECONNECT_IDLE_TIMEOUT]:
+            self.streams.pop(key)[1].close()
+            self.stats['expired'] += 1
 
-# 注册SIGINT信号处理器（Ctrl+C）
-signal.signal(signal.SIGINT, signal_handler)
+    def get_stats(self):
+        with self.lock:
+            self._sweep_locked()
+            stats = dict(self.stats, warm=len(self.streams), pending=len(self.pending))
+        stats['hit_rate'] = round(stats['used'] / stats['preconnects'], 4) if stats['preconnects'] else None
+        return stats
 
-# 在Windows上使用更可靠的方法捕获窗口关闭事件
-if platform.system() == "Windows":
-    try:
-        import ctypes
-        
-        # Windows API常量
-        CTRL_CLOSE_EVENT = 2
-        CTRL_C_EVENT = 0
-        
-        # 定义控制台处理函数类型
-        @ctypes.WINFUNCTYPE(ctypes.c_int, ctypes.c_uint)
-        def console_ctrl_handler(ctrl_type):
-            # 处理窗口关闭事件
-            if ctrl_type in (CTRL_CLOSE_EVENT, CTRL_C_EVENT):
-                if exit_confirmation():
-                    logger.info("程序退出，正在清理缓存...")
-                    # 使用os._exit()强制终止进程
-                    os._exit(0)
-                else:
-                    logger.info("继续运行程序")
-                return 1
-            return 0
-        
-        # 设置控制台控制处理器
-        if ctypes.windll.kernel32.SetConsoleCtrlHandler(console_ctrl_handler, 1) == 0:
-            logger.warning("无法设置控制台控制处理器")
-    except (ImportError, AttributeError) as e:
-        logger.warning(f"无法注册Windows控制台事件处理器: {e}")
-        # 回退到使用SIGBREAK
+class OriginCollector:
+    """从正在修正的 HTML 中找出引用的其他源站，发现后立即交给连接池预连接
+
+    页面自身的源站此时正在使用连接池中的连接，由连接池的检查排除。
+    """
+    def __init__(self, scheme, callback, limit=PRECONNECT_MAX_ORIGINS):
+        self.scheme = scheme
+        self.callback = callback
+        self.seen = set()
+        self.remaining = limit
+
+    def feed(self, data):
+        if self.remaining <= 0:
+            return
+        for match in PRECONNECT_ORIGIN_RE.finditer(data):
+            scheme = match.group(1)[:-1].decode('ascii') if match.group(1) else self.scheme
+            host = match.group(2).decode('ascii')
+            port = int(match.group(3)) if match.group(3) else (443 if scheme == 'https' else 80)
+            origin = (scheme, host.lower(), port)
+            if origin in self.seen:
+                continue
+            self.seen.add(origin)
+            info = host_classifier.classify(host)
+            if not (info.is_domain or info.is_ip) or blacklist.is_blocked(info.host):
+                continue
+            self.callback(scheme, info.host, port)
+            self.remaining -= 1
+            if self.remaining <= 0:
+                return
+
+class HttpClientPool:
+    """所有工作线程共享的上游连接池
+
+    同一个 httpx 传输层在所有请求间共享，到同一源站的连接可以被不同工作线程复用，
+    避免重复的 TCP/TLS 握手；上游支持时通过 ALPN 协商 HTTP/2 多路复用。
+    每个主机的并发请求数单独限制，并统计连接复用与握手次数。
+    """
+    def __init__(self, pool_size=100, max_connections_per_host=256, keepalive_expiry=30.0, http2=True):
+        self.pool_size = pool_size
+        self.max_connections_per_host = max_connections_per_host
+        self.http2 = http2 and HTTP2_AVAILABLE
+        self.limits = httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=keepalive_expiry
+        )
+        self.transport = httpx.HTTPTransport(verify=False, http2=self.http2, limits=self.limits, retries=2)
+        # 上游主机通过进程内 DNS 缓存解析；页面引用的源站在后台预解析并预先建立连接
+        self.preconnect_enabled = config.get('PRECONNECT_ENABLED', True)
+        self.preconnector = None
+        backend = self._wrap_network_backend(self.transport, lambda inner: CachedDnsBackend(inner, dns_cache))
+        if backend is not None and self.preconnect_enabled:
+            self.preconnector = Preconnector(dns_cache, self.http2,
+                                             warm=config.get('SERVER_ENGINE', 'threading') != 'asyncio')
+            self.preconnector.connect = backend.connect_resolved
+            backend.preconnector = self.preconnector
+        self.client = httpx.Client(
+            verify=False,
+            follow_redirects=False,
+            timeout=30.0,
+            transport=self.transport
+        )
+        self.async_client = None
+        self.async_transport = None
+        # 每个主机的并发限制 {host: [信号量, 使用者数]} 与当前占用数；
+        # 没有请求持有或等待的信号量立即删除，映射表的大小不超过正在访问的主机数
+        self.host_semaphores = {}
+        self.async_host_semaphores = {}
+        self.host_active = {}
+        self.lock = Lock()
+        self.stats = {
+            'requests': 0,
+            'new_connections': 0,
+            'tls_handshakes': 0,
+            'http2_requests': 0,
+            'host_limit_waits': 0,
+        }
+        if http2 and not HTTP2_AVAILABLE:
+            logger.info("未安装 h2 库，上游连接仅使用 HTTP/1.1")
+
+    def get_async_client(self):
+        """返回共享的异步客户端，首次调用时在当前事件循环中创建"""
+        if self.async_client is None:
+            self.async_transport = httpx.AsyncHTTPTransport(verify=False, http2=self.http2,
+                                                            limits=self.limits, retries=2)
+            self._wrap_network_backend(self.async_transport, lambda inner: AsyncCachedDnsBackend(inner, dns_cache))
+            self.async_client = httpx.AsyncClient(
+                verify=False,
+                follow_redirects=False,
+                timeout=30.0,
+                transport=self.async_transport
+            )
+        return self.async_client
+
+    @staticmethod
+    def _wrap_network_backend(transport, wrap):
+        """httpx 没有提供设置网络层的参数，直接替换传输层连接池的网络层，返回新的网络层"""
         try:
-            signal.signal(signal.SIGBREAK, signal_handler)
+            pool = transport._pool
+            pool._network_backend = wrap(pool._network_backend)
         except AttributeError:
-            logger.warning("无法注册SIGBREAK信号处理器")
+            logger.warning("当前 httpx 版本无法替换连接池的网络层，上游 DNS 缓存与预连接未启用")
+            return None
+        return pool._network_backend
 
-# ------------------ 会话与用户管理 ------------------
-class Sessions(object):
-    def __init__(self, length=64, age=604800, recycle_interval=3600):
-        self.charset = string.ascii_letters + string.digits
-        self.length = length
-        self.age = age
-        self.recycle_interval = recycle_interval
-        self.sessions = list()
-        self.session_cache = {}  # 添加会话缓存
-        self.cache_ttl = 300  # 缓存有效期（秒）
-        self.recycle_session()
+    def preconnect(self, scheme, host, port):
+        """后台预解析并预连接页面引用的源站，连接池中已有到该源站的连接时忽略"""
+        if self.preconnector is None:
+            return
+        origin = httpcore.Origin(scheme.encode('ascii'), host.encode('ascii'), port)
+        try:
+            connections = self.transport._pool.connections
+        except AttributeError:
+            connections = ()
+        if any(c.can_handle_request(origin) and not c.is_closed() for c in connections):
+            return
+        self.preconnector.submit(scheme, host, port)
 
-    def generate_new_session(self):
-        new_session = ''.join(random.choice(self.charset) for _ in range(self.length))
-        current_time = time.time()
-        self.sessions.append([new_session, current_time])
-        # 添加到缓存
-        self.session_cache[new_session] = current_time
-        return new_session
+    def _count(self, name, amount=1):
+        with self.lock:
+            self.stats[name] += amount
 
-    def is_session_exist(self, session):
-        # 快速检查：无效会话直接返回False
-        if not session:
+    def _trace(self, event_name, info):
+        """httpx 连接事件回调，统计新建连接与 TLS 握手次数"""
+        if event_name == 'connection.connect_tcp.complete':
+            self._count('new_connections')
+        elif event_name == 'connection.start_tls.complete':
+            self._count('tls_handshakes')
+
+    async def _async_trace(self, event_name, info):
+        self._trace(event_name, info)
+
+    def _host_acquired(self, host, delta):
+        with self.lock:
+            self.host_active[host] = self.host_active.get(host, 0) + delta
+            if self.host_active[host] <= 0:
+                del self.host_active[host]
+
+    def _join_host(self, semaphores, host, factory):
+        """取得主机的并发限制信号量并登记为使用者（持有或等待）"""
+        with self.lock:
+            entry = semaphores.get(host)
+            if entry is None:
+                entry = semaphores[host] = [factory(self.max_connections_per_host), 0]
+            entry[1] += 1
+            return entry[0]
+
+    def _leave_host(self, semaphores, host):
+        """注销使用者，最后一个使用者离开时删除该主机的信号量"""
+        with self.lock:
+            entry = semaphores[host]
+            entry[1] -= 1
+            if entry[1] <= 0:
+                del semaphores[host]
+
+    @contextlib.contextmanager
+    def stream(self, method, url, **kwargs):
+        """以流式方式发送请求，同一主机的并发请求数不超过 max_connections_per_host"""
+        target = httpx.URL(url)
+        host = target.host
+        if self.preconnector is not None:
+            # 连接池在当前线程中新建连接，网络层按此协议取用预建连接
+            self.preconnector.request_scheme.value = target.scheme
+        semaphore = self._join_host(self.host_semaphores, host, BoundedSemaphore)
+        try:
+            if not semaphore.acquire(blocking=False):
+                self._count('host_limit_waits')
+                semaphore.acquire()
+            self._host_acquired(host, 1)
+            try:
+                self._count('requests')
+                with self.client.stream(method, url, extensions={'trace': self._trace}, **kwargs) as r:
+                    if r.http_version == 'HTTP/2':
+                        self._count('http2_requests')
+                    yield r
+            finally:
+                self._host_acquired(host, -1)
+                semaphore.release()
+        finally:
+            self._leave_host(self.host_semaphores, host)
+
+    @contextlib.asynccontextmanager
+    async def astream(self, method, url, **kwargs):
+        """stream 的异步版本，供 asyncio 引擎使用"""
+        client = self.get_async_client()
+        host = httpx.URL(url).host
+        semaphore = self._join_host(self.async_host_semaphores, host, asyncio.Semaphore)
+        try:
+            if semaphore.locked():
+                self._count('host_limit_waits')
+            async with semaphore:
+                self._host_acquired(host, 1)
+                try:
+                    self._count('requests')
+                    async with client.stream(method, url, extensions={'trace': self._async_trace}, **kwargs) as r:
+                        if r.http_version == 'HTTP/2':
+                            self._count('http2_requests')
+                        yield r
+                finally:
+                    self._host_acquired(host, -1)
+        finally:
+            self._leave_host(self.async_host_semaphores, host)
+
+    def _pool_occupancy(self, transport):
+        """读取传输层连接池中的连接数量"""
+        if transport is None:
+            return None
+        try:
+            connections = transport._pool.connections
+        except AttributeError:
+            return None
+        idle = sum(1 for c in connections if c.is_idle())
+        return {'total': len(connections), 'idle': idle, 'active': len(connections) - idle}
+
+    def get_stats(self):
+        """返回连接池占用情况与连接复用统计"""
+        with self.lock:
+            stats = dict(self.stats)
+            busiest_hosts = sorted(self.host_active.items(), key=lambda item: item[1], reverse=True)[:10]
+        requests = stats['requests']
+        stats['connection_reuse_rate'] = round(1 - stats['new_connections'] / requests, 4) if requests else None
+        stats['http2_enabled'] = self.http2
+        stats['max_connections'] = self.pool_size
+        stats['max_connections_per_host'] = self.max_connections_per_host
+        stats['pool'] = self._pool_occupancy(self.transport)
+        stats['async_pool'] = self._pool_occupancy(self.async_transport)
+        stats['active_hosts'] = dict(busiest_hosts)
+        stats['dns'] = dns_cache.get_stats()
+        if self.preconnector is not None:
+            stats['preconnect'] = self.preconnector.get_stats()
+        return stats
+
+# ------------------ 缓存管理类 ------------------
+class FrequencySketch:
+    """Count-Min Sketch 访问频率估计，定期减半使历史热度逐渐衰减（TinyLFU 准入过滤）"""
+    depth = 4
+
+    def __init__(self, width=4096):
+        self.width = width
+        self.mask = width - 1
+        self.table = [bytearray(width) for _ in range(self.depth)]
+        self.additions = 0
+        self.reset_threshold = width * 10
+
+    def _indexes(self, key):
+        h = hash(key)
+        for i in range(self.depth):
+            yield (h ^ (h >> (8 * i + 8)) ^ (i * 0x9E3779B1)) & self.mask
+
+    def increment(self, key):
+        for row, index in zip(self.table, self._indexes(key)):
+            if row[index] < 15:
+                row[index] += 1
+        self.additions += 1
+        if self.additions >= self.reset_threshold:
+            for row in self.table:
+                for index in range(self.width):
+                    row[index] >>= 1
+            self.additions //= 2
+
+    def estimate(self, key):
+        return min(row[index] for row, index in zip(self.table, self._indexes(key)))
+
+def parse_cache_control(value):
+    """解析 Cache-Control 头，返回 {指令: 参数}，无参数的指令值为 True"""
+    directives = {}
+    for part in (value or '').split(','):
+        name, _, arg = part.strip().partition('=')
+        if name:
+            directives[name.strip().lower()] = arg.strip().strip('"') if arg else True
+    return directives
+
+def parse_http_date(value):
+    """解析 HTTP 日期，返回时间戳，无效时返回 None"""
+    if not value:
+        return None
+    try:
+        return email.utils.parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+
+def cache_lifetime(headers, heuristic_max):
+    """按 HTTP 缓存语义计算共享缓存中响应的剩余新鲜时间（秒），不允许存储时返回 None
+
+    优先级为 s-maxage、max-age、Expires，只有 Last-Modified 时按其距今时长的 10% 推算。
+    没有任何新鲜度信息也没有验证器的响应无法安全复用，不予缓存。
+    """
+    cache_control = parse_cache_control(headers.get('Cache-Control'))
+    if 'no-store' in cache_control or 'private' in cache_control:
+        return None
+    if headers.get('Vary', '').strip() == '*':
+        return None
+    now = time.time()
+    date = parse_http_date(headers.get('Date')) or now
+    lifetime = None
+    for directive in ('s-maxage', 'max-age'):
+        if directive in cache_control:
+            try:
+                lifetime = max(int(cache_control[directive]), 0)
+                break
+            except (TypeError, ValueError):
+                lifetime = 0
+    if lifetime is None and 'Expires' in headers:
+        expires = parse_http_date(headers.get('Expires'))
+        # 无效的 Expires（如 "0"）表示已过期
+        lifetime = max(expires - date, 0) if expires is not None else 0
+    last_modified = parse_http_date(headers.get('Last-Modified'))
+    if lifetime is None and last_modified is not None:
+        lifetime = min(max(date - last_modified, 0) * 0.1, heuristic_max)
+    if 'no-cache' in cache_control:
+        lifetime = 0
+    if lifetime is None:
+        if not headers.get('ETag'):
+            return None
+        lifetime = 0
+    try:
+        age = int(headers.get('Age', 0))
+    except ValueError:
+        age = 0
+    return max(lifetime - age, 0)
+
+def strip_weak_etag(etag):
+    etag = etag.strip()
+    return etag[2:] if etag.startswith('W/') else etag
+
+def weak_etag(etag):
+    """内容经过修改或重新压缩后，原始的强验证器只能作为弱验证器使用"""
+    if not etag or etag.startswith('W/'):
+        return etag
+    return 'W/' + etag
+
+def is_not_modified(request_headers, etag, last_modified):
+    """按 If-None-Match / If-Modified-Since 判断客户端缓存的版本是否仍然有效"""
+    if_none_match = request_headers.get('If-None-Match')
+    if if_none_match:
+        if not etag:
             return False
-            
-        # 检查缓存 - 使用简单的字典查找，避免遍历
-        if session in self.session_cache:
+        tags = [strip_weak_etag(tag) for tag in if_none_match.split(',')]
+        return '*' in tags or strip_weak_etag(etag) in tags
+    if_modified_since = parse_http_date(request_headers.get('If-Modified-Since'))
+    modified = parse_http_date(last_modified)
+    return if_modified_since is not None and modified is not None and modified <= if_modified_since
+
+class CacheEntry:
+    """缓存条目：响应体、已解析的响应头与新鲜度元数据
+
+    meta 中记录 stored_at（存入时间）、expires_at（新鲜期截止时间）与 vary（Vary 所列请求头的取值）。
+    content 为 None 时响应体只在磁盘缓存记录中，位于 body_offset 处、长度为 body_length。
+    """
+    __slots__ = ('content', 'headers', 'meta', 'cache_path', 'loaded_at', 'size', 'body_offset', 'body_length')
+
+    def __init__(self, content, headers, meta, cache_path, loaded_at=None, body_offset=0, body_length=None):
+        self.content = content
+        self.headers = headers or {}
+        self.meta = meta or {}
+        self.cache_path = cache_path
+        self.loaded_at = loaded_at or time.time()
+        self.body_offset = body_offset
+        self.body_length = len(content) if content is not None else body_length
+        self.size = self.body_length + sum(len(k) + len(v) for k, v in self.headers.items()) + 200
+
+    def open_body(self):
+        """打开缓存记录文件，文件已被新版本替换（大小不一致）时抛出 ValueError"""
+        f = open(self.cache_path, 'rb')
+        if os.fstat(f.fileno()).st_size != self.body_offset + self.body_length:
+            f.close()
+            raise ValueError("缓存文件已被替换")
+        return f
+
+    def read_body(self):
+        if self.content is not None:
+            return self.content
+        with self.open_body() as f:
+            f.seek(self.body_offset)
+            return f.read(self.body_length)
+
+    def is_fresh(self, now=None):
+        # 旧格式的缓存没有新鲜度信息，沿用固定缓存时间
+        if 'expires_at' not in self.meta:
             return True
-                
-        # 缓存未命中，检查会话列表
-        current_time = time.time()
-        for _session in self.sessions:
-            if _session[0] == session:
-                # 更新缓存，但不频繁更新时间戳
-                self.session_cache[session] = True
-                # 只有当距离上次更新超过一定时间才更新时间戳
-                if current_time - _session[1] > 300:  # 5分钟更新一次
-                    _session[1] = current_time
-                return True
-                
-        return False
+        return (now or time.time()) < self.meta['expires_at']
 
-    def recycle_session(self):
-        now = time.time()
-        deleting_sessions = [s for s in self.sessions if now - s[1] > self.age]
-        for s in deleting_sessions:
-            self.sessions.remove(s)
-            # 同时清理缓存
-            if s[0] in self.session_cache:
-                del self.session_cache[s[0]]
-                
-        # 清理过期缓存
-        expired_cache = [k for k, v in self.session_cache.items() if now - v > self.cache_ttl]
-        for k in expired_cache:
-            if k in self.session_cache:
-                del self.session_cache[k]
-                
-        Timer(self.recycle_interval, self.recycle_session).start()
+    def age(self, now=None):
+        return max(int((now or time.time()) - self.meta.get('stored_at', self.loaded_at)), 0)
 
-sessions = Sessions()
+    def matches_vary(self, request_headers):
+        """判断请求与缓存条目存入时的 Vary 请求头取值是否一致"""
+        for name, value in self.meta.get('vary', {}).items():
+            if (request_headers.get(name) or '') != value:
+                return False
+        return True
 
-class Users(object):
-    def __init__(self):
-        self.users = users_data
+    @property
+    def etag(self):
+        return self.headers.get('etag')
 
-    def is_effective_user(self, user_name, password):
-        return user_name in self.users and password == self.users.get(user_name)
+    @property
+    def last_modified(self):
+        return self.headers.get('last-modified')
 
-users = Users()
+class MemoryCache:
+    """按字节预算管理的内存热点缓存层（W-TinyLFU）
 
-# ------------------ 模板管理 ------------------
-class Template(object):
-    def __init__(self):
-        encoding = config.get("TEMPLATE_ENCODING", "utf-8")
-        self.encoding = encoding
-        self.template_dir = os.path.dirname(os.path.abspath(__file__))
-        self.static_dir = os.path.join(self.template_dir, "static")
-        
-        # 确保静态资源目录存在
-        if not os.path.exists(self.static_dir):
-            os.makedirs(self.static_dir)
-            logger.info(f"创建静态资源目录: {self.static_dir}")
-        
-        # 加载模板文件
-        with open(config['INDEX_FILE'], encoding=encoding) as f:
-            self.index_html = f.read()
-        with open(config['LOGIN_FILE'], encoding=encoding) as f:
-            self.login_html = f.read()
-        # 添加加载chat.html的代码
-        with open(config['CHAT_FILE'], encoding=encoding) as f:
-            self.chat_html = f.read()
+    新条目先进入约占 1% 容量的窗口 LRU；被挤出窗口的条目与主区试用段中最久未用的条目
+    比较访问频率，频率更高者留下。主区分为试用段与保护段（分段 LRU），试用段中再次命中的
+    条目晋升到保护段。被淘汰的条目降级回磁盘层，磁盘上的副本已被清理时重新写回。
+    """
+    def __init__(self, capacity, max_age, writeback=None):
+        self.capacity = capacity
+        self.max_age = max_age
+        self.writeback = writeback  # 降级回磁盘层时调用，由磁盘层判断是否需要写回
+        self.window_capacity = max(capacity // 100, 1)
+        self.protected_capacity = (capacity - self.window_capacity) * 4 // 5
+        # 单个条目超过该大小时不进入内存层，避免少数大文件挤占热点小对象
+        self.max_item_size = min(capacity // 8, 1024 * 1024)
+        self.window = collections.OrderedDict()
+        self.probation = collections.OrderedDict()
+        self.protected = collections.OrderedDict()
+        self.window_size = self.probation_size = self.protected_size = 0
+        self.sketch = FrequencySketch()
+        self.lock = Lock()
 
-        # 加载404页面模板
+    @property
+    def size(self):
+        return self.window_size + self.probation_size + self.protected_size
+
+    def get(self, key):
+        """查找条目，命中时按所在分段调整位置，在内存中停留超过缓存时间的条目直接删除"""
+        with self.lock:
+            self.sketch.increment(key)
+            if key in self.window:
+                entry = self.window[key]
+                self.window.move_to_end(key)
+            elif key in self.protected:
+                entry = self.protected[key]
+                self.protected.move_to_end(key)
+            elif key in self.probation:
+                # 试用段再次命中，晋升到保护段，保护段超出预算时最久未用的条目降回试用段
+                entry = self.probation.pop(key)
+                self.probation_size -= entry.size
+                self.protected[key] = entry
+                self.protected_size += entry.size
+                while self.protected_size > self.protected_capacity and len(self.protected) > 1:
+                    demoted_key, demoted = self.protected.popitem(last=False)
+                    self.protected_size -= demoted.size
+                    self.probation[demoted_key] = demoted
+                    self.probation_size += demoted.size
+            else:
+                return None
+            if time.time() - entry.loaded_at > self.max_age:
+                self._remove(key)
+                return None
+            return entry
+
+    def put(self, key, entry):
+        """从磁盘层晋升条目"""
+        if entry.size > self.max_item_size:
+            return
+        with self.lock:
+            self._remove(key)
+            self.window[key] = entry
+            self.window_size += entry.size
+            evicted = self._evict()
+        self._demote(evicted)
+
+    def discard(self, key):
+        """删除条目（缓存内容已更新或被清除时调用）"""
+        with self.lock:
+            self._remove(key)
+
+    def clear(self):
+        """删除所有条目（清除全部缓存时调用），被删除的条目不写回磁盘"""
+        with self.lock:
+            self.window.clear()
+            self.probation.clear()
+            self.protected.clear()
+            self.window_size = self.probation_size = self.protected_size = 0
+
+    def _remove(self, key):
+        for segment, attr in ((self.window, 'window_size'), (self.probation, 'probation_size'),
+                              (self.protected, 'protected_size')):
+            entry = segment.pop(key, None)
+            if entry is not None:
+                setattr(self, attr, getattr(self, attr) - entry.size)
+                return
+
+    def _evict(self):
+        """窗口超出预算时按 TinyLFU 决定候选条目的去留，返回被淘汰的条目"""
+        evicted = []
+        main_capacity = self.capacity - self.window_capacity
+        while self.window_size > self.window_capacity and self.window:
+            key, candidate = self.window.popitem(last=False)
+            self.window_size -= candidate.size
+            self.probation[key] = candidate
+            self.probation_size += candidate.size
+            candidate_freq = self.sketch.estimate(key)
+            while self.probation_size + self.protected_size > main_capacity:
+                if key in self.probation:
+                    # 候选者访问频率不高于试用段最久未用的条目时，淘汰候选者本身
+                    victim_key = next((k for k in self.probation if k != key), key)
+                    if victim_key != key and self.sketch.estimate(victim_key) >= candidate_freq:
+                        victim_key = key
+                    segment, attr = self.probation, 'probation_size'
+                elif self.probation:
+                    victim_key, segment, attr = next(iter(self.probation)), self.probation, 'probation_size'
+                else:
+                    victim_key, segment, attr = next(iter(self.protected)), self.protected, 'protected_size'
+                victim = segment.pop(victim_key)
+                setattr(self, attr, getattr(self, attr) - victim.size)
+                evicted.append(victim)
+        return evicted
+
+    def _demote(self, evicted):
+        """淘汰的条目降级到磁盘层：磁盘副本仍在时直接丢弃，已被清理时写回"""
+        if self.writeback is None:
+            return
+        for entry in evicted:
+            if entry.cache_path and time.time() - entry.loaded_at <= self.max_age:
+                self.writeback(entry)
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'capacity': self.capacity,
+                'size': self.size,
+                'entries': len(self.window) + len(self.probation) + len(self.protected),
+                'window_entries': len(self.window),
+                'probation_entries': len(self.probation),
+                'protected_entries': len(self.protected),
+            }
+
+# 缓存记录文件格式：4 字节标识 + 4 字节头部块长度 + 头部块（响应头与新鲜度信息的 JSON，以空格补齐）+ 响应体
+CACHE_RECORD_MAGIC = b'SRC1'
+CACHE_RECORD_PREFIX = struct.Struct('>4sI')
+
+def encode_cache_header(headers, meta, block_size=None):
+    """编码缓存记录的头部，预留空间使刷新新鲜期时可以原地改写；超出指定的块大小时返回 None"""
+    data = json.dumps({'headers': dict(headers or {}), 'meta': meta or {}}).encode()
+    if block_size is None:
+        block_size = (len(data) + 256 + 511) // 512 * 512
+    elif len(data) > block_size:
+        return None
+    return CACHE_RECORD_PREFIX.pack(CACHE_RECORD_MAGIC, block_size) + data.ljust(block_size, b' ')
+
+def read_cache_header(f):
+    """从文件开头读取缓存记录的头部，返回 (响应头, 元数据, 响应体偏移)，格式不符时抛出 ValueError"""
+    prefix = f.read(CACHE_RECORD_PREFIX.size)
+    if len(prefix) != CACHE_RECORD_PREFIX.size:
+        raise ValueError("缓存记录不完整")
+    magic, block_size = CACHE_RECORD_PREFIX.unpack(prefix)
+    if magic != CACHE_RECORD_MAGIC:
+        raise ValueError("不是缓存记录文件")
+    data = json.loads(f.read(block_size))
+    return data['headers'], data['meta'] or {}, CACHE_RECORD_PREFIX.size + block_size
+
+def write_cache_record(cache_path, headers, meta, content):
+    """写入完整的缓存记录（先写临时文件再原子替换），返回文件大小"""
+    tmp_path = f"{cache_path}.{os.getpid()}.{get_ident()}.tmp"
+    header = encode_cache_header(headers, meta)
+    with open(tmp_path, 'wb') as f:
+        f.write(header)
+        f.write(content)
+    os.replace(tmp_path, cache_path)
+    return len(header) + len(content)
+
+def rewrite_cache_header(cache_path, headers, meta):
+    """改写缓存记录的头部：预留空间足够时原地覆盖，否则连同响应体重写整个文件
+
+    返回 (文件大小, 响应体偏移)。
+    """
+    with open(cache_path, 'r+b') as f:
+        _, _, body_offset = read_cache_header(f)
+        header = encode_cache_header(headers, meta, body_offset - CACHE_RECORD_PREFIX.size)
+        if header is not None:
+            f.seek(0)
+            f.write(header)
+            return os.fstat(f.fileno()).st_size, body_offset
+        tmp_path = f"{cache_path}.{os.getpid()}.{get_ident()}.tmp"
+        header = encode_cache_header(headers, meta)
+        with open(tmp_path, 'wb') as out:
+            out.write(header)
+            f.seek(body_offset)
+            shutil.copyfileobj(f, out)
+            size = out.tell()
+    os.replace(tmp_path, cache_path)
+    return size, len(header)
+
+def cache_sidecar_path(cache_path):
+    """缓存数据文件对应的元数据文件路径（区间缓存为 .json，旧格式的完整响应缓存为 .headers）"""
+    return cache_path[:-5] + ".json" if cache_path.endswith(".part") else cache_path + ".headers"
+
+class CacheIndexEntry:
+    __slots__ = ('path', 'size', 'last_access', 'expires_at', 'heap_access')
+
+    def __init__(self, path, size, last_access, expires_at=None):
+        self.path = path  # 相对缓存根目录的路径
+        self.size = size
+        self.last_access = last_access
+        self.expires_at = expires_at
+        self.heap_access = last_access  # 堆中有效记录对应的访问时间
+
+class CacheIndex:
+    """磁盘缓存索引：记录每个条目的文件、大小、最近访问时间与过期时间
+
+    索引常驻内存并累计缓存总大小，写入新条目后超出上限时按最近访问时间逐个淘汰，无需遍历目录。
+    变更追加写入 temp/cache.journal（每行一条以制表符分隔的记录），启动时重放日志即可恢复索引；
+    访问时间的更新先在内存中合并、定期批量写入，日志记录数明显多于条目数时重写为快照。
+    """
+    def __init__(self, base_dir, max_size):
+        self.base_dir = base_dir
+        # 多进程模式下每个工作进程各自维护索引日志
+        self.journal_path = os.path.join(base_dir, "cache.journal" if WORKER_ID is None else f"cache.{WORKER_ID}.journal")
+        self.max_size = max_size
+        self.entries = {}
+        # 按访问时间排序的最小堆 (访问时间, 键)；访问时间更新后不调整堆，出堆时再惰性修正
+        self.heap = []
+        self.total_size = 0
+        self.touched = set()  # 访问时间已更新但尚未写入日志的键
+        self.journal = None
+        self.journal_records = 0
+        self.evictions = 0
+        self.load_time = 0.0
+        self.lock = Lock()
+
+    def load(self):
+        """重放日志恢复索引，日志不存在时扫描缓存目录重建"""
+        start = time.time()
+        with self.lock:
+            self.entries, self.total_size = {}, 0
+            records = 0
+            try:
+                with open(self.journal_path, 'r', encoding='utf-8') as f:
+                    for line in f:
+                        try:
+                            self._apply(line.rstrip('\n').split('\t'))
+                        except (ValueError, IndexError):
+                            # 异常退出时最后一行可能只写了一半
+                            continue
+                        records += 1
+                rebuilt = False
+            except OSError:
+                self._rebuild()
+                rebuilt = True
+            self._remove_temp_files()
+            self.journal_records = records
+            if rebuilt or records > 2 * len(self.entries) + 1024:
+                self._compact()
+            else:
+                self._rebuild_heap()
+                self._open_journal()
+            victims = self._evict()
+        self._delete_files(victims)
+        self.load_time = time.time() - start
+        logger.info(f"缓存索引已{'重建' if rebuilt else '加载'}: {len(self.entries)} 个条目, "
+                    f"{self.total_size / 1024 / 1024:.2f}MB, 耗时 {self.load_time * 1000:.1f}ms")
+
+    def _apply(self, fields):
+        """重放一条日志记录：put 键 路径 大小 访问时间 过期时间 / touch 键 访问时间 / del 键"""
+        op, key = fields[0], fields[1]
+        if op == 'put':
+            entry = CacheIndexEntry(fields[2], int(fields[3]), float(fields[4]),
+                                    float(fields[5]) if fields[5] else None)
+        elif op == 'touch':
+            entry = self.entries.get(key)
+            if entry is None:
+                return
+            entry.last_access = float(fields[2])
+            return
+        elif op != 'del':
+            raise ValueError(op)
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.total_size -= old.size
+        if op == 'del':
+            return
+        self.entries[key] = entry
+        self.total_size += entry.size
+
+    def _rebuild(self):
+        """没有日志时（首次启动或日志被删除）扫描缓存目录，以修改时间作为最近访问时间"""
+        for name in ("html", "media", "responses", "ranges"):
+            dir_path = os.path.join(self.base_dir, name)
+            try:
+                files = os.listdir(dir_path)
+            except OSError:
+                continue
+            for file in files:
+                if file.endswith((".headers", ".json", ".tmp")):
+                    continue
+                path = os.path.join(dir_path, file)
+                try:
+                    file_stat = os.stat(path)
+                    size = file_stat.st_size
+                    sidecar = cache_sidecar_path(path)
+                    if os.path.exists(sidecar):
+                        size += os.path.getsize(sidecar)
+                except OSError:
+                    continue
+                key = os.path.splitext(file)[0]
+                if name == "ranges":
+                    # 区间缓存的文件名为 哈希.版本.part
+                    key = "r:" + file.split('.', 1)[0]
+                self.entries[key] = CacheIndexEntry(os.path.join(name, file), size, file_stat.st_mtime)
+                self.total_size += size
+
+    def _remove_temp_files(self):
+        """删除异常退出时遗留的未完成写入的临时文件"""
+        # 多进程模式下其他工作进程可能正在写入，只删除较早的临时文件
+        cutoff = time.time() - 3600 if WORKER_ID is not None else None
+        for path in glob.glob(os.path.join(self.base_dir, "*", "*.tmp")):
+            try:
+                if cutoff is not None and os.path.getmtime(path) > cutoff:
+                    continue
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _open_journal(self):
         try:
-            with open(config['NOT_FOUND_FILE'], encoding=encoding) as f:
-                self.not_found_html = f.read()
-        except FileNotFoundError:
-            # 如果404页面文件不存在，创建一个简单的默认404页面
-            self.not_found_html = """
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <title>404 - 页面未找到</title>
-                <style>
-                    body { font-family: Arial, sans-serif; text-align: center; padding: 50px; }
-                    h1 { font-size: 36px; color: #333; }
-                    p { font-size: 18px; color: #666; }
-                    a { color: #0066cc; text-decoration: none; }
-                    a:hover { text-decoration: underline; }
-                </style>
-            </head>
-            <body>
-                <h1>404 - 页面未找到</h1>
-                <p>抱歉，您请求的页面不存在。</p>
-                <p><a href="/">返回首页</a></p>
-            </body>
-            </html>
+            # 按行缓冲，条目的写入与删除在进程异常退出时也不会丢失
+            self.journal = open(self.journal_path, 'a', encoding='utf-8', buffering=1)
+        except OSError as e:
+            logger.warning(f"无法打开缓存索引日志，索引变更将不会保存: {e}")
+            self.journal = None
+
+    @staticmethod
+    def _put_record(key, entry):
+        return "put\t%s\t%s\t%d\t%r\t%s\n" % (key, entry.path, entry.size, entry.last_access,
+                                               '' if entry.expires_at is None else repr(entry.expires_at))
+
+    def _append(self, record):
+        if self.journal is None:
+            return
+        try:
+            self.journal.write(record)
+            self.journal_records += record.count('\n')
+        except OSError as e:
+            logger.warning(f"写入缓存索引日志失败: {e}")
+
+    def _compact(self):
+        """将当前索引重写为快照，替换原日志"""
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        tmp_path = self.journal_path + ".tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                for key, entry in self.entries.items():
+                    f.write(self._put_record(key, entry))
+            os.replace(tmp_path, self.journal_path)
+            self.journal_records = len(self.entries)
+            self.touched.clear()
+        except OSError as e:
+            logger.warning(f"压缩缓存索引日志失败: {e}")
+        self._rebuild_heap()
+        self._open_journal()
+
+    def _rebuild_heap(self):
+        self.heap = []
+        for key, entry in self.entries.items():
+            entry.heap_access = entry.last_access
+            self.heap.append((entry.last_access, key))
+        heapq.heapify(self.heap)
+
+    def get(self, key):
+        return self.entries.get(key)
+
+    def path(self, entry):
+        return os.path.join(self.base_dir, entry.path)
+
+    def put(self, key, path, size, expires_at=None, content_type=None):
+        """登记新写入或更新的条目，超出容量上限时淘汰最久未访问的条目（内容类型只记录在 SQLite 索引中）"""
+        now = time.time()
+        rel_path = os.path.relpath(path, self.base_dir)
+        with self.lock:
+            old = self.entries.get(key)
+            if old is not None:
+                self.total_size -= old.size
+            entry = CacheIndexEntry(rel_path, size, now, expires_at)
+            self.entries[key] = entry
+            self.total_size += size
+            self.touched.discard(key)
+            heapq.heappush(self.heap, (now, key))
+            self._append(self._put_record(key, entry))
+            victims = self._evict()
+        if old is not None and old.path != rel_path:
+            # 内容类型变化后写到了另一个文件，旧文件不再被引用
+            victims.append(old.path)
+        self._delete_files(victims)
+
+    def touch(self, key):
+        """记录一次访问，只更新内存中的访问时间，定期批量写入日志"""
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                entry.last_access = time.time()
+                self.touched.add(key)
+
+    def remove(self, key):
+        """删除条目及其缓存文件"""
+        with self.lock:
+            victims = [self._pop(key)] if key in self.entries else []
+        self._delete_files(victims)
+
+    def expire(self, cutoff):
+        """淘汰最近访问时间早于 cutoff 的条目，返回淘汰数量"""
+        with self.lock:
+            victims = []
+            while True:
+                key = self._pop_oldest(cutoff)
+                if key is None:
+                    break
+                victims.append(self._pop(key))
+        self._delete_files(victims)
+        return len(victims)
+
+    def _pop(self, key):
+        entry = self.entries.pop(key)
+        self.total_size -= entry.size
+        self.touched.discard(key)
+        self._append("del\t%s\n" % key)
+        return entry.path
+
+    def _pop_oldest(self, cutoff=None):
+        """从堆中找出最久未访问的条目键，跳过已删除或已被新记录取代的堆记录"""
+        while self.heap:
+            access, key = self.heap[0]
+            if cutoff is not None and access >= cutoff:
+                return None
+            heapq.heappop(self.heap)
+            entry = self.entries.get(key)
+            if entry is None or entry.heap_access != access:
+                continue
+            if entry.last_access > access:
+                # 出堆前又被访问过，按新的访问时间放回堆中
+                entry.heap_access = entry.last_access
+                heapq.heappush(self.heap, (entry.last_access, key))
+                continue
+            return key
+        return None
+
+    def _evict(self):
+        victims = []
+        while self.total_size > self.max_size:
+            key = self._pop_oldest()
+            if key is None:
+                break
+            victims.append(self._pop(key))
+            self.evictions += 1
+        return victims
+
+    def _delete_files(self, paths):
+        for rel_path in paths:
+            path = os.path.join(self.base_dir, rel_path)
+            for file_path in (path, cache_sidecar_path(path)):
+                try:
+                    os.remove(file_path)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logger.warning(f"无法删除缓存文件 {file_path}: {e}")
+
+    def flush(self):
+        """写入积累的访问时间，日志或堆中的过期记录过多时压缩"""
+        with self.lock:
+            records = ["touch\t%s\t%r\n" % (key, self.entries[key].last_access)
+                       for key in self.touched if key in self.entries]
+            self.touched.clear()
+            if records:
+                self._append(''.join(records))
+            if self.journal_records > 2 * len(self.entries) + 1024:
+                self._compact()
+            elif len(self.heap) > 2 * len(self.entries) + 1024:
+                self._rebuild_heap()
+            if self.journal is not None:
+                try:
+                    self.journal.flush()
+                except OSError as e:
+                    logger.warning(f"写入缓存索引日志失败: {e}")
+
+    def clear(self, remove_files):
+        """清空索引，remove_files 在持有锁时删除缓存目录，完成后重新创建空日志"""
+        with self.lock:
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+            self.entries, self.heap, self.total_size = {}, [], 0
+            self.touched.clear()
+            remove_files()
+            self._compact()
+
+    def close(self):
+        """程序退出前写入访问时间并关闭日志"""
+        self.flush()
+        with self.lock:
+            if self.journal is not None:
+                self.journal.close()
+                self.journal = None
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'size': self.total_size,
+                'max_size': self.max_size,
+                'evictions': self.evictions,
+                'journal_records': self.journal_records,
+                'load_ms': round(self.load_time * 1000, 1),
+            }
+
+# SQLite 缓存索引的数据库文件（不放在 temp 目录中，清空缓存时不会被删除）
+CACHE_INDEX_DB = 'databases/cache_index.db'
+# 累计的访问记录超过该数量时立即写入数据库
+CACHE_INDEX_TOUCH_BATCH = 1000
+
+class SqliteCacheIndex(CacheIndex):
+    """保存在 SQLite（WAL 模式）中的磁盘缓存索引，同一台机器上的多个进程共享
+
+    每个条目记录键、文件、内容类型、大小、过期时间、最近访问时间与命中次数；条目数与总大小由触发器维护，
+    写入与淘汰在同一个事务中完成，统计查询只需读取一行。任何进程写入的缓存都能被其他进程直接使用，
+    淘汰也不会在进程之间重复或冲突。访问记录与日志索引一样先在内存中合并，定期批量写入。
+    """
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS entries (
+            key TEXT PRIMARY KEY,
+            path TEXT NOT NULL,
+            content_type TEXT,
+            size INTEGER NOT NULL,
+            expires_at REAL,
+            last_access REAL NOT NULL,
+            hits INTEGER NOT NULL DEFAULT 0
+        );
+        CREATE INDEX IF NOT EXISTS entries_last_access ON entries (last_access);
+        CREATE TABLE IF NOT EXISTS totals (
+            id INTEGER PRIMARY KEY CHECK (id = 0),
+            entries INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            evictions INTEGER NOT NULL
+        );
+        INSERT OR IGNORE INTO totals VALUES (0, 0, 0, 0);
+        CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value);
+        CREATE TRIGGER IF NOT EXISTS entries_insert AFTER INSERT ON entries BEGIN
+            UPDATE totals SET entries = entries + 1, size = size + NEW.size WHERE id = 0;
+        END;
+        CREATE TRIGGER IF NOT EXISTS entries_delete AFTER DELETE ON entries BEGIN
+            UPDATE totals SET entries = entries - 1, size = size - OLD.size WHERE id = 0;
+        END;
+        CREATE TRIGGER IF NOT EXISTS entries_update AFTER UPDATE OF size ON entries BEGIN
+            UPDATE totals SET size = size - OLD.size + NEW.size WHERE id = 0;
+        END;
+    """
+
+    def __init__(self, base_dir, max_size, db_path=CACHE_INDEX_DB):
+        super().__init__(base_dir, max_size)
+        self.db_path = db_path
+        # sqlite3 连接不能跨线程使用，每个线程各自打开一个连接
+        self.local = local()
+        self.pending = {}  # 键 -> [最近访问时间, 新增命中次数]
+
+    def _connect(self):
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self.local.conn = conn
+        return conn
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        """写事务：BEGIN IMMEDIATE 立即取得写锁，其他进程的写入在 busy timeout 内等待"""
+        conn = self._connect()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def load(self):
+        """创建数据库结构；数据库首次使用时扫描缓存目录导入已有的缓存文件"""
+        start = time.time()
+        self._connect().executescript(self.SCHEMA)
+        with self._transaction() as conn:
+            rebuilt = conn.execute("SELECT value FROM meta WHERE name = 'initialized'").fetchone() is None
+            if rebuilt:
+                self._remove_temp_files()
+                self.entries, self.total_size = {}, 0
+                self._rebuild()
+                conn.executemany("INSERT OR IGNORE INTO entries (key, path, size, last_access) VALUES (?, ?, ?, ?)",
+                                 [(key, entry.path, entry.size, entry.last_access)
+                                  for key, entry in self.entries.items()])
+                conn.execute("INSERT INTO meta VALUES ('initialized', ?)", (time.time(),))
+                self.entries, self.total_size = {}, 0
+            victims = self._evict_locked(conn)
+        self._delete_files(victims)
+        self.load_time = time.time() - start
+        stats = self.get_stats()
+        logger.info(f"缓存索引已{'重建' if rebuilt else '加载'}（SQLite）: {stats['entries']} 个条目, "
+                    f"{stats['size'] / 1024 / 1024:.2f}MB, 耗时 {self.load_time * 1000:.1f}ms")
+
+    def get(self, key):
+        row = self._connect().execute(
+            "SELECT path, size, last_access, expires_at FROM entries WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        entry = CacheIndexEntry(row[0], row[1], row[2], row[3])
+        pending = self.pending.get(key)
+        if pending is not None and pending[0] > entry.last_access:
+            entry.last_access = pending[0]
+        return entry
+
+    def put(self, key, path, size, expires_at=None, content_type=None):
+        """登记新写入或更新的条目，超出容量上限时在同一事务中淘汰最久未访问的条目"""
+        now = time.time()
+        rel_path = os.path.relpath(path, self.base_dir)
+        with self.lock:
+            self.pending.pop(key, None)
+        with self._transaction() as conn:
+            old = conn.execute("SELECT path FROM entries WHERE key = ?", (key,)).fetchone()
+            conn.execute(
+                "INSERT INTO entries (key, path, content_type, size, expires_at, last_access) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (key) DO UPDATE SET path = excluded.path, content_type = coalesce(excluded.content_type, content_type), "
+                "size = excluded.size, expires_at = excluded.expires_at, last_access = excluded.last_access",
+                (key, rel_path, content_type, size, expires_at, now))
+            victims = self._evict_locked(conn, keep=key)
+        if old is not None and old[0] != rel_path:
+            # 内容类型变化后写到了另一个文件，旧文件不再被引用
+            victims.append(old[0])
+        self._delete_files(victims)
+
+    def _evict_locked(self, conn, keep=None):
+        """在写事务中淘汰最久未访问的条目直到总大小不超过上限，返回需要删除的文件"""
+        victims = []
+        total = conn.execute("SELECT size FROM totals WHERE id = 0").fetchone()[0]
+        while total > self.max_size:
+            rows = conn.execute("SELECT key, path, size FROM entries WHERE key != ? ORDER BY last_access LIMIT 64",
+                                (keep or '',)).fetchall()
+            if not rows:
+                break
+            keys = []
+            for key, path, size in rows:
+                keys.append((key,))
+                victims.append(path)
+                total -= size
+                if total <= self.max_size:
+                    break
+            conn.executemany("DELETE FROM entries WHERE key = ?", keys)
+            conn.execute("UPDATE totals SET evictions = evictions + ? WHERE id = 0", (len(keys),))
+            self.evictions += len(keys)
+        return victims
+
+    def touch(self, key):
+        """记录一次访问，先在内存中合并，积累到一定数量或定期维护时写入数据库"""
+        with self.lock:
+            pending = self.pending.get(key)
+            if pending is None:
+                self.pending[key] = [time.time(), 1]
+            else:
+                pending[0] = time.time()
+                pending[1] += 1
+            batch_full = len(self.pending) >= CACHE_INDEX_TOUCH_BATCH
+        if batch_full:
+            self.flush()
+
+    def remove(self, key):
+        """删除条目及其缓存文件"""
+        with self.lock:
+            self.pending.pop(key, None)
+        with self._transaction() as conn:
+            row = conn.execute("SELECT path FROM entries WHERE key = ?", (key,)).fetchone()
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+        self._delete_files([row[0]] if row is not None else [])
+
+    def expire(self, cutoff):
+        """淘汰最近访问时间早于 cutoff 的条目，返回淘汰数量"""
+        self.flush()
+        with self._transaction() as conn:
+            rows = conn.execute("SELECT key, path FROM entries WHERE last_access < ?", (cutoff,)).fetchall()
+            conn.executemany("DELETE FROM entries WHERE key = ?", [(key,) for key, _ in rows])
+        self._delete_files([path for _, path in rows])
+        return len(rows)
+
+    def flush(self):
+        """将积累的访问时间与命中次数写入数据库"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        if not pending:
+            return
+        try:
+            with self._transaction() as conn:
+                conn.executemany("UPDATE entries SET last_access = max(last_access, ?), hits = hits + ? WHERE key = ?",
+                                 [(access, hits, key) for key, (access, hits) in pending.items()])
+        except sqlite3.Error as e:
+            logger.warning(f"写入缓存索引失败: {e}")
+
+    def clear(self, remove_files):
+        """清空索引并删除缓存文件
+
+        先提交删除条目的事务再删除文件：删除大量文件耗时较长，不能一直持有数据库写锁阻塞其他进程。
+        提交之后其他进程新写入的条目如果文件被一并删除，读取时会按文件缺失处理并移除该条目。
+        """
+        with self.lock:
+            self.pending = {}
+            with self._transaction() as conn:
+                conn.execute("DELETE FROM entries")
+            remove_files()
+
+    def close(self):
+        """程序退出前写入访问记录"""
+        self.flush()
+
+    def get_stats(self):
+        entries, size, evictions = self._connect().execute(
+            "SELECT entries, size, evictions FROM totals WHERE id = 0").fetchone()
+        return {
+            'backend': 'sqlite',
+            'entries': entries,
+            'size': size,
+            'max_size': self.max_size,
+            'evictions': evictions,
+            'pending_touches': len(self.pending),
+            'load_ms': round(self.load_time * 1000, 1),
+        }
+
+class CacheManager:
+    """管理系统缓存的类"""
+    def __init__(self):
+        # 使用程序所在目录
+        self.base_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "temp")
+        self.html_cache_dir = os.path.join(self.base_dir, "html")
+        self.media_cache_dir = os.path.join(self.base_dir, "media")
+        self.response_cache_dir = os.path.join(self.base_dir, "responses")
+        self.max_cache_size = 500 * 1024 * 1024  # 500MB
+        self.max_cache_age = 24 * 60 * 60  # 24小时
+        
+        # 从配置文件中读取缓存设置
+        self.cache_enabled = config.get("CACHE_ENABLED", True)  # 默认启用缓存
+        self.cache_html = config.get("CACHE_HTML", True)  # 默认缓存HTML
+        self.cache_media = config.get("CACHE_MEDIA", True)  # 默认缓存媒体文件
+        self.cache_other = config.get("CACHE_OTHER", True)  # 默认缓存其他响应
+        self.cache_large_files = config.get("CACHE_LARGE_FILES", False)  # 默认不缓存大文件
+        
+        # 磁盘缓存前的内存热点层，按字节预算管理
+        self.memory_cache = MemoryCache(int(config.get("MEMORY_CACHE_SIZE", 64)) * 1024 * 1024, self.max_cache_age,
+                                        self.write_back)
+        self.stats = {'lookups': 0, 'memory_hits': 0, 'disk_hits': 0, 'revalidations': 0, 'client_not_modified': 0}
+        self.stats_lock = Lock()
+        
+        # 确保缓存目录存在
+        self._ensure_cache_dirs()
+        
+        # 加载磁盘缓存索引，重启后沿用上次运行留下的缓存；CACHE_INDEX_BACKEND 为 sqlite 时多个进程共享同一个索引
+        if config.get("CACHE_INDEX_BACKEND", "journal") == "sqlite":
+            self.index = SqliteCacheIndex(self.base_dir, self.max_cache_size)
+        else:
+            self.index = CacheIndex(self.base_dir, self.max_cache_size)
+        self.index.load()
+        
+        # 启动定期清理任务
+        self._schedule_cleanup()
+        
+        logger.info(f"缓存状态: {'启用' if self.cache_enabled else '禁用'}")
+        if self.cache_enabled:
+            logger.info(f"缓存配置: HTML({'启用' if self.cache_html else '禁用'}), "
+                       f"媒体文件({'启用' if self.cache_media else '禁用'}), "
+                       f"其他响应({'启用' if self.cache_other else '禁用'}), "
+                       f"大文件({'启用' if self.cache_large_files else '禁用'})")
+    def _ensure_cache_dirs(self):
+        """确保所有缓存目录存在"""
+        for dir_path in [self.base_dir, self.html_cache_dir, 
+                         self.media_cache_dir, self.response_cache_dir]:
+            if not os.path.exists(dir_path):
+                os.makedirs(dir_path)
+                logger.debug(f"创建缓存目录: {dir_path}")
+    
+    def _schedule_cleanup(self):
+        """安排定期清理任务"""
+        cleanup_interval = 60  # 每分钟维护一次索引
+        start_timer(cleanup_interval, self._cleanup_cache)
+    
+    def _cleanup_cache(self):
+        """淘汰长时间未访问的缓存，并将积累的访问时间写入索引日志
+
+        缓存总大小在每次写入时由索引维护，这里不需要遍历缓存目录。
+        """
+        try:
+            removed = self.index.expire(time.time() - self.max_cache_age)
+            self.index.flush()
+            if removed:
+                logger.info(f"缓存清理完成，删除 {removed} 个过期条目，"
+                            f"当前缓存大小: {self.index.get_stats()['size'] / 1024 / 1024:.2f}MB")
+        except Exception as e:
+            logger.error(f"缓存清理过程中出错: {e}")
+        # 重新安排下一次清理
+        self._schedule_cleanup()
+    
+    def close(self):
+        """程序退出前保存缓存索引"""
+        self.index.close()
+    
+    def cache_key(self, url):
+        """规范化缓存键：协议与主机名转为小写，去掉默认端口与 URL 片段"""
+        parts = parse.urlsplit(url)
+        scheme, netloc = parts.scheme.lower(), parts.netloc.lower()
+        if (scheme == 'http' and netloc.endswith(':80')) or (scheme == 'https' and netloc.endswith(':443')):
+            netloc = netloc.rsplit(':', 1)[0]
+        return parse.urlunsplit((scheme, netloc, parts.path or '/', parts.query, ''))
+
+    def url_hash(self, url):
+        """规范化缓存键的哈希值，用作缓存文件名与索引键，避免路径过长或包含非法字符"""
+        return hashlib.md5(self.cache_key(url).encode()).hexdigest()
+
+    def get_cache_path(self, url, content_type=None):
+        """根据URL和内容类型获取缓存路径"""
+        url_hash = self.url_hash(url)
+        
+        # 根据内容类型选择缓存目录
+        if content_type and "text/html" in content_type:
+            cache_dir = self.html_cache_dir
+            ext = ".html"
+        elif content_type and ("image/" in content_type or "video/" in content_type or "audio/" in content_type):
+            cache_dir = self.media_cache_dir
+            # 从content_type中提取扩展名
+            ext = "." + content_type.split("/")[-1].split(";")[0]
+        else:
+            cache_dir = self.response_cache_dir
+            ext = ".dat"
+        
+        return os.path.join(cache_dir, url_hash + ext)
+    
+    def is_type_cacheable(self, content_type):
+        """根据内容类型与缓存配置判断是否允许缓存"""
+        if not self.cache_enabled:
+            return False
+        if not content_type:
+            return True
+        if "text/html" in content_type:
+            return self.cache_html
+        if "image/" in content_type or "video/" in content_type or "audio/" in content_type:
+            return self.cache_media
+        return self.cache_other
+
+    def open_cache_writer(self, url, content_type=None, headers=None, meta=None):
+        """打开流式缓存写入器，不满足缓存条件时返回None"""
+        if not self.is_type_cacheable(content_type):
+            return None
+        # 未启用大文件缓存时，超过1MB的响应在写入过程中自动放弃
+        size_limit = None if self.cache_large_files else 1024 * 1024
+        try:
+            return CacheWriter(self, url, content_type, headers, size_limit, meta)
+        except OSError as e:
+            logger.warning(f"打开缓存写入器失败 {url}: {e}")
+            return None
+
+    def save_to_cache(self, url, content, content_type=None, headers=None):
+        """保存响应内容到缓存"""
+        # 如果缓存被全局禁用，直接返回
+        if not self.cache_enabled:
+            return False
+            
+        # 根据内容类型决定是否缓存
+        if not self.is_type_cacheable(content_type):
+            return False
+                
+        # 检查文件大小，如果是大文件且未启用大文件缓存，则不缓存
+        if len(content) > 1024 * 1024 and not self.cache_large_files:  # 大于1MB
+            return False
+            
+        try:
+            cache_path = self.get_cache_path(url, content_type)
+            
+            # 响应头与内容保存在同一个缓存记录中
+            size = write_cache_record(cache_path, headers, None, content)
+            self.memory_cache.discard(self.cache_key(url))
+            self.index.put(self.url_hash(url), cache_path, size, content_type=content_type)
+            
+            logger.debug(f"已缓存: {url} -> {cache_path}")
+            return True
+        except Exception as e:
+            logger.warning(f"缓存保存失败 {url}: {e}")
+            return False
+    
+    def count(self, name):
+        with self.stats_lock:
+            self.stats[name] += 1
+
+    def get_stats(self):
+        """返回内存层与磁盘层各自的命中率"""
+        with self.stats_lock:
+            stats = dict(self.stats)
+        lookups = stats['lookups']
+        disk_lookups = lookups - stats['memory_hits']
+        stats['memory_hit_ratio'] = round(stats['memory_hits'] / lookups, 4) if lookups else None
+        stats['disk_hit_ratio'] = round(stats['disk_hits'] / disk_lookups, 4) if disk_lookups else None
+        stats['overall_hit_ratio'] = (round((stats['memory_hits'] + stats['disk_hits']) / lookups, 4)
+                                      if lookups else None)
+        stats['memory'] = self.memory_cache.get_stats()
+        stats['disk'] = self.index.get_stats()
+        return stats
+
+    def get_from_cache(self, url, content_type=None):
+        """从缓存获取仍在新鲜期内的响应内容
+
+        返回的响应头字典与内存层共享，调用方不应修改。
+        """
+        entry = self.get_entry(url, content_type)
+        if entry is None or not entry.is_fresh():
+            return None, None
+        return entry.read_body(), entry.headers
+
+    def has_fresh_entry(self, url):
+        """只查询索引判断是否已有仍在新鲜期内的缓存，不读取磁盘也不计入命中统计"""
+        indexed = self.index.get(self.url_hash(url))
+        return indexed is not None and indexed.expires_at is not None and indexed.expires_at > time.time()
+
+    def get_entry(self, url, content_type=None, request_headers=None):
+        """查找缓存条目（可能已过新鲜期，由调用方决定直接使用还是重新验证）
+
+        先查内存层，未命中再读取磁盘并晋升到内存层；Vary 请求头取值不一致时视为未命中。
+        """
+        # 如果缓存被全局禁用，直接返回None
+        if not self.cache_enabled:
+            return None
+            
+        # 根据内容类型决定是否使用缓存
+        if content_type and not self.is_type_cacheable(content_type):
+            return None
+        
+        self.count('lookups')
+        key = self.cache_key(url)
+        url_hash = self.url_hash(url)
+        entry = self.memory_cache.get(key)
+        if entry is not None:
+            if request_headers is not None and not entry.matches_vary(request_headers):
+                return None
+            self.index.touch(url_hash)
+            self.count('memory_hits')
+            return entry
+        
+        # 索引中没有的条目不访问磁盘
+        indexed = self.index.get(url_hash)
+        if indexed is None:
+            return None
+        cache_path = self.index.path(indexed)
+        try:
+            if time.time() - indexed.last_access > self.max_cache_age:
+                # 长时间未被访问，删除并返回None
+                self.index.remove(url_hash)
+                return None
+            
+            # 读取响应头与新鲜度信息；小文件连同内容读入内存，大文件命中时直接从缓存文件发送
+            with open(cache_path, 'rb') as f:
+                headers, meta, body_offset = read_cache_header(f)
+                body_length = os.fstat(f.fileno()).st_size - body_offset
+                content = f.read() if body_length <= self.memory_cache.max_item_size else None
+            
+            # 更新访问时间
+            self.index.touch(url_hash)
+            
+            entry = CacheEntry(content, headers, meta, cache_path, body_offset=body_offset, body_length=body_length)
+            # 晋升到内存层，之后的命中不再访问磁盘
+            if content is not None:
+                self.memory_cache.put(key, entry)
+            if request_headers is not None and not entry.matches_vary(request_headers):
+                return None
+            self.count('disk_hits')
+            logger.debug(f"缓存命中: {url}")
+            return entry
+        except (FileNotFoundError, ValueError):
+            # 缓存文件已在索引之外被删除，或是无法识别的旧格式
+            self.index.remove(url_hash)
+            return None
+        except Exception as e:
+            logger.warning(f"读取缓存失败 {url}: {e}")
+            return None
+
+    def cache_meta(self, response_headers, request_headers):
+        """按响应的缓存语义生成条目元数据，不允许存储时返回 None
+
+        缓存由所有用户共享：带 Set-Cookie 的响应不存储，避免把一个用户的会话 Cookie 发给其他用户；
+        带 Authorization 的请求只有在响应明确允许共享（public、s-maxage 或 must-revalidate）时才存储。
+        """
+        if 'set-cookie' in response_headers:
+            return None
+        if 'authorization' in request_headers:
+            cache_control = parse_cache_control(response_headers.get('Cache-Control'))
+            if not ('public' in cache_control or 's-maxage' in cache_control or 'must-revalidate' in cache_control):
+                return None
+        lifetime = cache_lifetime(response_headers, self.max_cache_age)
+        if lifetime is None:
+            return None
+        now = time.time()
+        vary = {}
+        for name in response_headers.get('Vary', '').split(','):
+            name = name.strip().lower()
+            # 内容编码在读取缓存时按客户端能力单独处理
+            if name and name != 'accept-encoding':
+                vary[name] = request_headers.get(name) or ''
+        return {'stored_at': now, 'expires_at': now + lifetime, 'vary': vary}
+
+    def refresh_entry(self, entry, response_headers, request_headers):
+        """上游返回 304 后用新的响应头刷新条目的新鲜期，返回是否刷新成功"""
+        meta = self.cache_meta(response_headers, request_headers)
+        if meta is None:
+            return False
+        for name in ('cache-control', 'expires', 'date', 'etag', 'last-modified', 'vary'):
+            if name in response_headers:
+                entry.headers[name] = response_headers[name]
+        entry.meta = meta
+        entry.loaded_at = time.time()
+        try:
+            size, entry.body_offset = rewrite_cache_header(entry.cache_path, entry.headers, entry.meta)
+            self.index.put(self.index_key(entry.cache_path), entry.cache_path, size, meta['expires_at'])
+        except (OSError, ValueError) as e:
+            logger.warning(f"刷新缓存元数据失败 {entry.cache_path}: {e}")
+        return True
+
+    def index_key(self, cache_path):
+        """由缓存文件路径得到索引键（文件名中的哈希值）"""
+        return os.path.splitext(os.path.basename(cache_path))[0]
+
+    def write_back(self, entry):
+        """内存层淘汰的条目在磁盘副本已被索引淘汰时写回磁盘层"""
+        key = self.index_key(entry.cache_path)
+        if self.index.get(key) is not None:
+            return
+        try:
+            size = write_cache_record(entry.cache_path, entry.headers, entry.meta, entry.content)
+            self.index.put(key, entry.cache_path, size, (entry.meta or {}).get('expires_at'))
+        except OSError as e:
+            logger.warning(f"内存缓存写回磁盘失败 {entry.cache_path}: {e}")
+
+    def clear_cache(self, url=None, content_type=None):
+        """清除特定URL的缓存或所有缓存"""
+        if url:
+            try:
+                self.memory_cache.discard(self.cache_key(url))
+                self.index.remove(self.url_hash(url))
+                logger.debug(f"已清除缓存: {url}")
+            except Exception as e:
+                logger.warning(f"清除缓存失败 {url}: {e}")
+        else:
+            # 清除所有缓存
+            def remove_files():
+                clear_temp_cache()
+                self._ensure_cache_dirs()
+            self.index.clear(remove_files)
+            # 索引清空后内存层不会再晋升新条目，其中的旧条目不能继续使用，也不能在淘汰时写回磁盘
+            self.memory_cache.clear()
+            logger.info("已清除所有缓存")
+
+class CacheWriter:
+    """边转发边写入缓存的写入器，响应体不需要完整保留在内存中"""
+    def __init__(self, manager, url, content_type, headers, size_limit=None, meta=None):
+        self.manager = manager
+        self.url = url
+        self.headers = headers
+        self.meta = meta
+        self.size_limit = size_limit
+        self.size = 0
+        self.content_type = content_type
+        self.cache_path = manager.get_cache_path(url, content_type)
+        # 先写入临时文件，完成后再原子替换，避免读到写了一半的缓存
+        self.tmp_path = f"{self.cache_path}.{os.getpid()}.{get_ident()}.tmp"
+        self.file = open(self.tmp_path, 'wb')
+        # 缓存记录以响应头开头，响应体随后边转发边追加
+        self.header_size = self.file.write(encode_cache_header(headers, meta))
+
+    def write(self, chunk):
+        """追加一块响应数据，超出大小限制时放弃本次缓存"""
+        if self.file is None:
+            return
+        self.size += len(chunk)
+        if self.size_limit is not None and self.size > self.size_limit:
+            logger.debug(f"响应超过缓存大小限制，放弃缓存: {self.url}")
+            self.abort()
+            return
+        try:
+            self.file.write(chunk)
+        except OSError as e:
+            logger.warning(f"写入缓存失败 {self.url}: {e}")
+            self.abort()
+
+    def commit(self):
+        """完成写入并将缓存文件放到最终位置"""
+        if self.file is None:
+            return False
+        try:
+            self.file.close()
+            self.file = None
+            os.replace(self.tmp_path, self.cache_path)
+            size = self.header_size + self.size
+            # 内存层中的旧版本已失效
+            self.manager.memory_cache.discard(self.manager.cache_key(self.url))
+            self.manager.index.put(self.manager.index_key(self.cache_path), self.cache_path, size,
+                                   (self.meta or {}).get('expires_at'), self.content_type)
+            logger.debug(f"已缓存: {self.url} -> {self.cache_path}")
+            return True
+        except OSError as e:
+            logger.warning(f"缓存保存失败 {self.url}: {e}")
+            self.abort()
+            return False
+
+    def abort(self):
+        """放弃本次缓存并删除临时文件"""
+        if self.file is not None:
+            try:
+                self.file.close()
+            except OSError:
+                pass
+            self.file = None
+        try:
+            os.remove(self.tmp_path)
+        except OSError:
+            pass
+
+def parse_range_header(value, total_length):
+    """解析单一区间的 Range 请求头，返回 (起始, 结束, 是否为开放区间)，结束位置包含在内"""
+    if not value or not value.startswith('bytes=') or ',' in value:
+        return None
+    start_text, sep, end_text = value[6:].strip().partition('-')
+    if not sep:
+        return None
+    try:
+        if start_text:
+            start = int(start_text)
+            open_ended = not end_text
+            end = total_length - 1 if open_ended else min(int(end_text), total_length - 1)
+        else:
+            # bytes=-n 表示最后 n 个字节
+            suffix = int(end_text)
+            if suffix <= 0:
+                return None
+            start, end, open_ended = max(0, total_length - suffix), total_length - 1, False
+    except ValueError:
+        return None
+    if start > end or start >= total_length:
+        return None
+    return start, end, open_ended
+
+class RangeCacheEntry:
+    """单个媒体文件的稀疏缓存：数据文件按原始偏移写入，并记录已缓存的字节区间"""
+    def __init__(self, data_path, meta_path, total_length, content_type, etag, last_modified, expires_at=None):
+        self.data_path = data_path
+        self.meta_path = meta_path
+        self.total_length = total_length
+        self.content_type = content_type
+        self.etag = etag
+        self.last_modified = last_modified
+        # 新鲜期的截止时间，过期后不再直接使用，重新从上游获取时刷新
+        self.expires_at = expires_at
+        self.intervals = []  # 已缓存区间列表 [起始, 结束)，有序且互不重叠
+        self.lock = Lock()
+
+    def add_interval(self, start, end):
+        """登记一段已写入的区间，并与相邻区间合并"""
+        if end <= start:
+            return
+        with self.lock:
+            merged = []
+            for a, b in self.intervals:
+                if b < start or a > end:
+                    merged.append([a, b])
+                else:
+                    start, end = min(a, start), max(b, end)
+            merged.append([start, end])
+            merged.sort()
+            self.intervals = merged
+
+    def cached_bytes(self):
+        with self.lock:
+            return sum(b - a for a, b in self.intervals)
+
+    def covered_until(self, start):
+        """返回包含 start 的已缓存区间的结束位置，未缓存时返回 None"""
+        for a, b in self.intervals:
+            if a <= start < b:
+                return b
+        return None
+
+    def matches(self, total_length, etag, last_modified):
+        """判断上游响应与缓存条目是否为同一版本的文件"""
+        if total_length != self.total_length:
+            return False
+        if etag and self.etag:
+            return etag == self.etag
+        if last_modified and self.last_modified:
+            return last_modified == self.last_modified
+        return not etag and not last_modified and not self.etag and not self.last_modified
+
+    def save_meta(self):
+        """将区间等元数据写入磁盘"""
+        with self.lock:
+            meta = {
+                'total_length': self.total_length,
+                'content_type': self.content_type,
+                'etag': self.etag,
+                'last_modified': self.last_modified,
+                'expires_at': self.expires_at,
+                'intervals': self.intervals,
+            }
+        tmp_path = f"{self.meta_path}.{os.getpid()}.{get_ident()}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(meta, f)
+        os.replace(tmp_path, self.meta_path)
+
+class RangeCache:
+    """媒体文件的稀疏字节区间缓存，使视频拖动时已下载过的部分可直接从本地返回"""
+    def __init__(self, manager):
+        self.manager = manager
+        self.cache_dir = os.path.join(manager.base_dir, "ranges")
+        self.entries = {}
+        self.lock = Lock()
+
+    @property
+    def enabled(self):
+        return self.manager.cache_enabled and self.manager.cache_media
+
+    def _paths(self, url):
+        """为文件的一个新版本生成数据文件与元数据文件路径，不同版本使用不同的文件，互不覆盖"""
+        name = f"{self.manager.url_hash(url)}.{secrets.token_hex(4)}"
+        return os.path.join(self.cache_dir, name + ".part"), os.path.join(self.cache_dir, name + ".json")
+
+    def index_key(self, url):
+        """区间缓存在磁盘缓存索引中的键，与完整响应的缓存区分"""
+        return "r:" + self.manager.url_hash(url)
+
+    def get_entry(self, url):
+        """获取URL对应的缓存条目，首次访问时从磁盘加载元数据"""
+        indexed = self.manager.index.get(self.index_key(url))
+        with self.lock:
+            entry = self.entries.get(url)
+            if entry is not None:
+                if indexed is not None:
+                    return entry
+                # 数据文件已被索引淘汰删除
+                del self.entries[url]
+            if indexed is None:
+                return None
+            data_path = self.manager.index.path(indexed)
+            meta_path = cache_sidecar_path(data_path)
+            try:
+                with open(meta_path, 'r', encoding='utf-8') as f:
+                    meta = json.load(f)
+            except (OSError, ValueError):
+                return None
+            if not os.path.exists(data_path):
+                return None
+            entry = RangeCacheEntry(data_path, meta_path, meta['total_length'], meta.get('content_type'),
+                                    meta.get('etag'), meta.get('last_modified'), meta.get('expires_at'))
+            entry.intervals = meta.get('intervals', [])
+            self.entries[url] = entry
+            return entry
+
+    def lookup(self, url, range_header, if_range=None):
+        """查找可以完全由本地缓存满足的区间请求，返回 (条目, 起始, 结束) 或 None"""
+        if not self.enabled or not range_header:
+            return None
+        entry = self.get_entry(url)
+        if entry is None:
+            return None
+        # 已过新鲜期（或没有新鲜期信息的旧条目）交给上游，上游返回同一版本时刷新新鲜期
+        if entry.expires_at is None or entry.expires_at <= time.time():
+            return None
+        # If-Range 与缓存版本不一致时交给上游处理
+        if if_range and if_range not in (entry.etag, entry.last_modified):
+            return None
+        parsed = parse_range_header(range_header, entry.total_length)
+        if parsed is None:
+            return None
+        start, end, open_ended = parsed
+        covered_end = entry.covered_until(start)
+        if covered_end is None:
+            return None
+        if covered_end <= end:
+            # 开放区间（bytes=N-）可以只返回已缓存的连续部分，浏览器会继续请求后续数据
+            if not open_ended:
+                return None
+            end = covered_end - 1
+        self.manager.index.touch(self.index_key(url))
+        return entry, start, end
+
+    def open_writer(self, url, r, request_headers):
+        """为 200 或 206 媒体响应打开区间写入器，不满足条件时返回 None
+
+        与完整响应缓存使用同样的存储规则（cache_meta）：带 Set-Cookie 的响应、no-store/private 响应、
+        未明确允许共享的带 Authorization 请求的响应都不缓存；区间缓存不区分 Vary 变体，带 Vary 的响应也不缓存。
+        """
+        if not self.enabled or r.headers.get('Content-Encoding'):
+            return None
+        meta = self.manager.cache_meta(r.headers, request_headers)
+        if meta is None or meta['vary'] or meta['expires_at'] <= meta['stored_at']:
+            return None
+        if r.status_code == 206:
+            match = re.match(r'bytes (\d+)-(\d+)/(\d+)', r.headers.get('Content-Range', ''))
+            if match is None:
+                return None
+            start, total_length = int(match.group(1)), int(match.group(3))
+        elif r.status_code == 200 and r.headers.get('Content-Length', '').isdigit():
+            start, total_length = 0, int(r.headers['Content-Length'])
+        else:
+            return None
+        if total_length > 1024 * 1024 and not self.manager.cache_large_files:
+            return None
+        content_type = r.headers.get('Content-Type')
+        etag, last_modified = r.headers.get('ETag'), r.headers.get('Last-Modified')
+        try:
+            self.get_entry(url)  # 确保磁盘上已有的元数据已加载
+            with self.lock:
+                entry = self.entries.get(url)
+                if entry is None or not entry.matches(total_length, etag, last_modified):
+                    # 新文件或上游文件已变化，新版本写入新的文件；索引指向新文件后旧版本的文件被删除，
+                    # 仍在写入旧版本的写入器不再登记区间
+                    os.makedirs(self.cache_dir, exist_ok=True)
+                    data_path, meta_path = self._paths(url)
+                    with open(data_path, 'wb'):
+                        pass
+                    entry = RangeCacheEntry(data_path, meta_path, total_length, content_type, etag, last_modified)
+                    self.entries[url] = entry
+                    self.manager.index.put(self.index_key(url), data_path, 0, content_type=content_type)
+                entry.expires_at = meta['expires_at']
+            return RangeCacheWriter(self, url, entry, start)
+        except OSError as e:
+            logger.warning(f"打开区间缓存失败 {url}: {e}")
+            return None
+
+class RangeCacheWriter:
+    """将转发中的响应数据按原始偏移写入稀疏缓存文件"""
+    def __init__(self, cache, url, entry, start):
+        self.cache = cache
+        self.url = url
+        self.entry = entry
+        self.index = cache.manager.index
+        self.index_key = cache.index_key(url)
+        self.start = start
+        self.position = start
+        self.file = open(entry.data_path, 'r+b', buffering=0)
+        self.file.seek(start)
+
+    def is_current(self):
+        """写入的版本是否仍是该 URL 当前的缓存条目（上游文件变化后旧版本的写入器失效）"""
+        return self.cache.entries.get(self.url) is self.entry
+
+    def write(self, chunk):
+        if self.file is None:
+            return
+        if not self.is_current():
+            self.close()
+            return
+        try:
+            self.file.write(chunk)
+            self.position += len(chunk)
+        except OSError as e:
+            logger.warning(f"写入区间缓存失败: {e}")
+            self.close()
+
+    def close(self):
+        """登记已写入的区间（客户端中途断开时已下载的部分同样保留）"""
+        if self.file is None:
+            return
+        try:
+            self.file.close()
+        except OSError:
+            pass
+        self.file = None
+        if not self.is_current():
+            return
+        self.entry.add_interval(self.start, self.position)
+        try:
+            self.entry.save_meta()
+        except OSError as e:
+            logger.warning(f"保存区间缓存元数据失败: {e}")
+            return
+        # 稀疏文件只按实际缓存的字节计入缓存总大小
+        self.index.put(self.index_key, self.entry.data_path, self.entry.cached_bytes(),
+                       content_type=self.entry.content_type)
+
+# 创建缓存管理器实例
+cache_manager = CacheManager()
+range_cache = RangeCache(cache_manager)
+
+# 退出时保存缓存索引，下次启动继续使用已有缓存
+atexit.register(cache_manager.close)
+
+# 添加系统自检和缓存清理函数
+def system_check_and_cleanup():
+    """系统启动时的自检和缓存清理"""
+    logger.info("开始系统自检和缓存清理...")
+    
+    # 1. 检查必要的目录是否存在，不存在则创建
+    required_dirs = ["temp", "databases", "templates"]
+    for dir_name in required_dirs:
+        dir_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), dir_name)
+        if not os.path.exists(dir_path):
+            os.makedirs(dir_path)
+            logger.info(f"创建目录: {dir_path}")
+    
+    # 2. 清除自身缓存
+    # 网站缓存由缓存索引管理，重启后继续使用，不再清除临时文件夹
+    # 清除__pycache__文件夹
+    pycache_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "__pycache__")
+    if os.path.exists(pycache_dir):
+        shutil.rmtree(pycache_dir)
+        logger.info("清除 __pycache__ 目录")
+    
+    # 3. 检查配置文件完整性
+    try:
+        required_configs = ["SERVER", "DOMAIN", "PORT", "BIND_IP", "SCHEME", 
+                           "LOGIN_PATH", "FAVICON_PATH", "INDEX_FILE", "LOGIN_FILE", "CHAT_FILE",
+                           "FAVICON_FILE", "SESSION_COOKIE_NAME", "SERVER_NAME", "LOG_FILE"]
+        missing_configs = [cfg for cfg in required_configs if cfg not in config]
+        if missing_configs:
+            logger.warning(f"配置文件缺少以下项: {', '.join(missing_configs)}")
+    except Exception as e:
+        logger.error(f"检查配置文件时出错: {e}")
+    
+    # 4. 初始化缓存目录结构
+    cache_manager._ensure_cache_dirs()
+    
+    logger.info("系统自检和缓存清理完成")
+
+
+def exit_confirmation():
+    """退出程序时弹出确认对话框"""
+    # 在Windows系统上使用tkinter创建图形化对话框
+    if platform.system() == "Windows":
+        try:
+            import tkinter as tk
+            from tkinter import messagebox
+            
+            # 创建隐藏的根窗口
+            root = tk.Tk()
+            root.withdraw()
+            
+            # 显示确认对话框
+            result = messagebox.askyesno("退出确认", "是否退出程序？")
+            root.destroy()
+            return result
+        except ImportError:
+            # 如果tkinter不可用，回退到控制台输入
+            pass
+    
+    # 非Windows系统或tkinter不可用时使用控制台输入
+    print("\n检测到退出信号。是否退出程序？(y/N): ", end='', flush=True)
+    response = sys.stdin.readline().strip().lower()
+    return response == 'y'
+
+def signal_handler(sig, frame):
+    if exit_confirmation():
+        logger.info("程序退出，正在保存缓存索引...")
+        cache_manager.close()
+        # 强制终止所有线程并退出
+        os._exit(0)
+    else:
+        logger.info("继续运行程序。")
+
+def worker_exit_handler(sig, frame):
+    logger.info("收到停止信号，正在保存缓存索引...")
+    cache_manager.close()
+    os._exit(0)
+
+if WORKER_ID is None:
+    # 注册SIGINT信号处理器（Ctrl+C）
+    signal.signal(signal.SIGINT, signal_handler)
+else:
+    # 工作进程由主进程统一停止：忽略终端发给整个进程组的 Ctrl+C，收到 SIGTERM 时保存缓存索引后退出
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, worker_exit_handler)
+
+# 在Windows上使用更可靠的方法捕获窗口关闭事件
+if platform.system() == "Windows":
+    try:
+        import ctypes
+        
+        # Windows API常量
+        CTRL_CLOSE_EVENT = 2
+        CTRL_C_EVENT = 0
+        
+        # 定义控制台处理函数类型
+        @ctypes.WINFUNCTYPE(ctypes.c_int, ctypes.c_uint)
+        def console_ctrl_handler(ctrl_type):
+            # 处理窗口关闭事件
+            if ctrl_type in (CTRL_CLOSE_EVENT, CTRL_C_EVENT):
+                if exit_confirmation():
+                    logger.info("程序退出，正在保存缓存索引...")
+                    cache_manager.close()
+                    # 使用os._exit()强制终止进程
+                    os._exit(0)
+                else:
+                    logger.info("继续运行程序")
+                return 1
+            return 0
+        
+        # 设置控制台控制处理器
+        if ctypes.windll.kernel32.SetConsoleCtrlHandler(console_ctrl_handler, 1) == 0:
+            logger.warning("无法设置控制台控制处理器")
+    except (ImportError, AttributeError) as e:
+        logger.warning(f"无法注册Windows控制台事件处理器: {e}")
+        # 回退到使用SIGBREAK
+        try:
+            signal.signal(signal.SIGBREAK, signal_handler)
+        except AttributeError:
+            logger.warning("无法注册SIGBREAK信号处理器")
+
+# ------------------ 会话与用户管理 ------------------
+class Sessions(object):
+    """登录会话存储
+
+    会话保存在 令牌 -> 最近活动时间 的字典中，查找为 O(1) 且不需要加锁；
+    过期时间按最近活动时间滑动，由最小堆按到期时间排列，回收时只处理已到期的堆顶。
+    会话被访问后堆中的到期时间不会立即更新，回收时发现会话仍然活跃再按新的到期时间放回堆中。
+    """
+    def __init__(self, length=64, age=604800, recycle_interval=3600, touch_interval=300):
+        self.length = length
+        self.age = age
+        self.recycle_interval = recycle_interval
+        # 距离上次记录的活动时间超过该值（秒）才更新，避免每个请求都写入
+        self.touch_interval = touch_interval
+        self.sessions = {}
+        self.expiry_heap = []
+        self.lock = Lock()
+        if recycle_interval:
+            start_timer(self.recycle_interval, self.recycle_session)
+
+    def generate_new_session(self):
+        # 使用 secrets 生成不可预测的令牌，长度为 length 个 URL 安全字符
+        new_session = secrets.token_urlsafe(self.length * 3 // 4)
+        current_time = time.time()
+        with self.lock:
+            self.sessions[new_session] = current_time
+            heapq.heappush(self.expiry_heap, (current_time + self.age, new_session))
+        return new_session
+
+    def is_session_exist(self, session):
+        # 快速检查：无效会话直接返回False
+        if not session:
+            return False
+        last_seen = self.sessions.get(session)
+        if last_seen is None:
+            return False
+        current_time = time.time()
+        if current_time - last_seen > self.age:
+            # 已过期但尚未被回收
+            return False
+        if current_time - last_seen > self.touch_interval:
+            with self.lock:
+                if session in self.sessions:
+                    self.sessions[session] = current_time
+        return True
+
+    def recycle_session(self):
+        """回收已过期的会话"""
+        try:
+            now = time.time()
+            with self.lock:
+                heap = self.expiry_heap
+                while heap and heap[0][0] <= now:
+                    _, session = heapq.heappop(heap)
+                    last_seen = self.sessions.get(session)
+                    if last_seen is None:
+                        continue
+                    if now - last_seen > self.age:
+                        del self.sessions[session]
+                    else:
+                        # 会话在此期间被访问过，按新的到期时间重新排队
+                        heapq.heappush(heap, (last_seen + self.age, session))
+        finally:
+            if self.recycle_interval:
+                start_timer(self.recycle_interval, self.recycle_session)
+
+    def get_stats(self):
+        return {'mode': 'memory', 'live': len(self.sessions), 'queued': len(self.expiry_heap)}
+
+# 签名会话模式下自动生成的密钥保存位置（未在配置中指定 SESSION_SECRET_KEYS 时使用）
+SESSION_KEY_FILE = 'databases/session_keys.json'
+# 已验证令牌的缓存数量
+SESSION_VERIFY_CACHE_SIZE = 4096
+
+class SignedSessions(object):
+    """无状态的签名会话
+
+    会话令牌为 密钥标识.到期时间.随机数.签名，签名为 HMAC-SHA256，服务端不保存任何会话状态，
+    多个进程或多台服务器只要使用相同的密钥即可互相验证，重启后已登录的用户也不会失效。
+    第一个密钥用于签发新令牌，其余密钥仍可用于验证，便于轮换密钥。最近验证过的令牌保存在 LRU 缓存中。
+    """
+    def __init__(self, keys=None, age=604800):
+        self.age = age
+        keys = keys or self._load_keys()
+        # 密钥标识取自密钥的哈希，调整密钥顺序或增删密钥不影响已签发的令牌
+        self.keys = {hashlib.sha256(key.encode('utf-8')).hexdigest()[:8]: key.encode('utf-8') for key in keys}
+        self.signing_kid = hashlib.sha256(keys[0].encode('utf-8')).hexdigest()[:8]
+        self._verify_cached = functools.lru_cache(maxsize=SESSION_VERIFY_CACHE_SIZE)(self._verify)
+
+    def _load_keys(self):
+        """读取自动生成的密钥，不存在时生成一个并保存"""
+        try:
+            with open(SESSION_KEY_FILE, 'r', encoding='utf-8') as f:
+                keys = json.load(f)
+            if keys:
+                return keys
+        except (OSError, ValueError):
+            pass
+        keys = [secrets.token_urlsafe(32)]
+        tmp_path = f"{SESSION_KEY_FILE}.{os.getpid()}.tmp"
+        try:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(keys, f)
+            # 以硬链接发布密钥文件，多个工作进程同时启动时只有一个能创建成功，其余读取已有的密钥
+            os.link(tmp_path, SESSION_KEY_FILE)
+            logger.warning(f"未配置 SESSION_SECRET_KEYS，已生成会话签名密钥并保存到 {SESSION_KEY_FILE}")
+        except FileExistsError:
+            with open(SESSION_KEY_FILE, 'r', encoding='utf-8') as f:
+                keys = json.load(f)
+        except OSError as e:
+            logger.warning(f"保存会话签名密钥失败，重启后已签发的会话将失效: {e}")
+        finally:
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+        return keys
+
+    def _sign(self, kid, payload):
+        digest = hmac.new(self.keys[kid], payload.encode('ascii'), hashlib.sha256).digest()
+        return base64.urlsafe_b64encode(digest).rstrip(b'=').decode('ascii')
+
+    def generate_new_session(self):
+        payload = f"{self.signing_kid}.{int(time.time() + self.age):x}.{secrets.token_urlsafe(12)}"
+        return f"{payload}.{self._sign(self.signing_kid, payload)}"
+
+    def _verify(self, session):
+        """验证令牌签名，返回到期时间，无效时返回 0"""
+        payload, _, signature = session.rpartition('.')
+        parts = payload.split('.')
+        if len(parts) != 3 or parts[0] not in self.keys:
+            return 0
+        if not hmac.compare_digest(signature, self._sign(parts[0], payload)):
+            return 0
+        try:
+            return int(parts[1], 16)
+        except ValueError:
+            return 0
+
+    def is_session_exist(self, session):
+        # 快速检查：无效会话直接返回False
+        if not session or len(session) > 256:
+            return False
+        return self._verify_cached(session) > time.time()
+
+    def get_stats(self):
+        info = self._verify_cached.cache_info()
+        return {'mode': 'signed', 'keys': len(self.keys), 'verify_cache_hits': info.hits,
+                'verify_cache_misses': info.misses, 'verify_cache_size': info.currsize}
+
+# SESSION_MODE 为 signed 时使用无状态的签名会话，否则会话保存在进程内存中；
+# 多进程模式下各工作进程之间无法共享内存中的会话，始终使用签名会话
+if config.get('SESSION_MODE', 'memory') == 'signed' or WORKER_ID is not None:
+    sessions = SignedSessions(config.get('SESSION_SECRET_KEYS'))
+else:
+    sessions = Sessions()
+
+class Users(object):
+    def __init__(self):
+        self.users = users_data
+
+    def is_effective_user(self, user_name, password):
+        return user_name in self.users and password == self.users.get(user_name)
+
+users = Users()
+
+# ------------------ 模板管理 ------------------
+# 编译结果缓存的模板数量上限（按模板内容区分）
+TEMPLATE_COMPILE_CACHE_SIZE = 64
+# 每个页面模板记忆的渲染结果数量上限（按引用到的上下文变量取值区分）
+TEMPLATE_RENDER_CACHE_SIZE = 256
+# 每次请求都会变化的上下文变量，模板引用到它们时渲染结果不记忆
+TEMPLATE_VOLATILE_NAMES = frozenset(('timestamp',))
+
+class CompiledTemplate:
+    """编译后的模板：模板内容只解析一次，渲染时按节点列表拼接
+
+    节点依次为文本、资源引用、变量、条件（if / if-else）与循环（for），条件表达式预先编译为代码对象。
+    各类标签的识别顺序与语义和逐次正则替换的处理方式保持一致。
+    """
+    TEXT, RESOURCE, VAR, IF, FOR, ERROR = range(6)
+    placeholder_pattern = re.compile(r'\{([A-Za-z_][A-Za-z0-9_]*)\}')
+
+    def __init__(self, owner, source):
+        self.owner = owner
+        # 渲染结果依赖的上下文变量名
+        self.names = set()
+        for pattern, replacement in owner.path_rewrites:
+            source = pattern.sub(replacement, source)
+        self.placeholders = sorted(set(self.placeholder_pattern.findall(source)))
+        self.names.update(self.placeholders)
+        self.nodes = self._parse(source)
+        self.names = tuple(sorted(self.names))
+
+    def _parse(self, text, stage=0):
+        """按 if-else、if、for 的顺序拆分块级标签，剩余文本再拆分资源引用与变量"""
+        owner = self.owner
+        patterns = (owner.if_else_pattern, owner.if_pattern, owner.for_pattern)
+        if stage == len(patterns):
+            return self._parse_text(text)
+        nodes = []
+        pos = 0
+        for match in patterns[stage].finditer(text):
+            nodes.extend(self._parse(text[pos:match.start()], stage + 1))
+            nodes.append(self._parse_block(stage, match))
+            pos = match.end()
+        nodes.extend(self._parse(text[pos:], stage + 1))
+        return nodes
+
+    def _parse_block(self, stage, match):
+        if stage == 2:
+            var_name, collection_name, loop_content = match.groups()
+            self.names.add(collection_name.split('.')[0])
+            return (self.FOR, var_name, collection_name, self._parse(loop_content))
+        condition = match.group(1).strip()
+        try:
+            code = compile(condition, '<template>', 'eval')
+        except SyntaxError as e:
+            logger.error(f"条件评估错误: {e}, 条件: {condition}")
+            return (self.ERROR, f"<!-- 条件评估错误: {condition} -->")
+        self.names.update(code.co_names)
+        else_nodes = self._parse(match.group(3)) if stage == 0 else []
+        return (self.IF, code, condition, self._parse(match.group(2)), else_nodes)
+
+    def _parse_text(self, text):
+        owner = self.owner
+        nodes = []
+        pos = 0
+        for match in owner.resource_pattern.finditer(text):
+            nodes.extend(self._parse_vars(text[pos:match.start()]))
+            nodes.append((self.RESOURCE, match.group(1), match.group(2)))
+            pos = match.end()
+        nodes.extend(self._parse_vars(text[pos:]))
+        return nodes
+
+    def _parse_vars(self, text):
+        nodes = []
+        pos = 0
+        for match in self.owner.var_pattern.finditer(text):
+            if match.start() > pos:
+                nodes.append((self.TEXT, text[pos:match.start()]))
+            var_path = match.group(1)
+            self.names.add(var_path.split('.')[0])
+            nodes.append((self.VAR, var_path))
+            pos = match.end()
+        if pos < len(text):
+            nodes.append((self.TEXT, text[pos:]))
+        return nodes
+
+    def memo_key(self, context):
+        """渲染结果的记忆键：模板引用到的上下文变量取值，引用了易变变量或含有不可哈希的值时返回 None"""
+        if not TEMPLATE_VOLATILE_NAMES.isdisjoint(self.names):
+            return None
+        key = tuple(context.get(name) for name in self.names)
+        for value in key:
+            if value is not None and not isinstance(value, (str, int, float, bool)):
+                return None
+        return key
+
+    def render(self, context):
+        return self._substitute(self._render(self.nodes, context), context)
+
+    def _substitute(self, content, context):
+        """替换简单的上下文变量 {key}（向后兼容）"""
+        for key in self.placeholders:
+            if key in context:
+                content = content.replace('{' + key + '}', str(context[key]))
+        return content
+
+    def _render(self, nodes, context):
+        owner = self.owner
+        parts = []
+        for node in nodes:
+            kind = node[0]
+            if kind == self.TEXT:
+                parts.append(node[1])
+            elif kind == self.RESOURCE:
+                parts.append(owner.resource_url(node[1], node[2]))
+            elif kind == self.VAR:
+                value = owner._get_nested_value(context, node[1])
+                parts.append(str(value) if value is not None else f"<!-- 未定义变量: {node[1]} -->")
+            elif kind == self.IF:
+                try:
+                    # 条件只能访问上下文变量，不提供内置函数
+                    result = eval(node[1], {"__builtins__": {}}, context)
+                except Exception as e:
+                    logger.error(f"条件评估错误: {e}, 条件: {node[2]}")
+                    parts.append(f"<!-- 条件评估错误: {node[2]} -->")
+                    continue
+                parts.append(self._render(node[3] if result else node[4], context))
+            elif kind == self.FOR:
+                collection = owner._get_nested_value(context, node[2])
+                if not collection or not isinstance(collection, (list, tuple, dict)):
+                    parts.append(f"<!-- 循环错误: {node[2]} 不是有效的集合 -->")
+                    continue
+                for item in collection:
+                    # 创建新的上下文，包含循环变量
+                    loop_context = context.copy()
+                    loop_context[node[1]] = item
+                    parts.append(self._substitute(self._render(node[3], loop_context), loop_context))
+            else:
+                parts.append(node[1])
+        return "".join(parts)
+
+class Template(object):
+    # 403页面不显示被拦截的地址，所有请求使用同一个渲染结果
+    FORBIDDEN_CONTEXT = {'requested_url': ''}
+
+    def __init__(self):
+        encoding = config.get("TEMPLATE_ENCODING", "utf-8")
+        self.encoding = encoding
+        self.template_dir = os.path.dirname(os.path.abspath(__file__))
+        self.static_dir = os.path.join(self.template_dir, "static")
+        
+        # 确保静态资源目录存在
+        if not os.path.exists(self.static_dir):
+            os.makedirs(self.static_dir)
+            logger.info(f"创建静态资源目录: {self.static_dir}")
+        
+        # 加载模板文件
+        with open(config['INDEX_FILE'], encoding=encoding) as f:
+            self.index_html = f.read()
+        with open(config['LOGIN_FILE'], encoding=encoding) as f:
+            self.login_html = f.read()
+        # 添加加载chat.html的代码
+        with open(config['CHAT_FILE'], encoding=encoding) as f:
+            self.chat_html = f.read()
+
+        # 加载404页面模板
+        try:
+            with open(config['NOT_FOUND_FILE'], encoding=encoding) as f:
+                self.not_found_html = f.read()
+        except FileNotFoundError:
+            # 如果404页面文件不存在，创建一个简单的默认404页面
+            self.not_found_html = """
+            <!DOCTYPE html>
+            <html>
+            <head>
+                <title>404 - 页面未找到</title>
+                <style>
+                    body { font-family: Arial, sans-serif; text-align: center; padding: 50px; }
+                    h1 { font-size: 36px; color: #333; }
+                    p { font-size: 18px; color: #666; }
+                    a { color: #0066cc; text-decoration: none; }
+                    a:hover { text-decoration: underline; }
+                </style>
+            </head>
+            <body>
+                <h1>404 - 页面未找到</h1>
+                <p>抱歉，您请求的页面不存在。</p>
+                <p><a href="/">返回首页</a></p>
+            </body>
+            </html>
+            """
+            logger.warning(f"404页面文件 {config['NOT_FOUND_FILE']} 不存在，使用默认模板")
+
+        # 加载403页面模板（访问黑名单中的网站时返回）
+        try:
+            with open(config['FORBIDDEN_FILE'], encoding=encoding) as f:
+                self.forbidden_html = f.read()
+        except FileNotFoundError:
+            self.forbidden_html = """
+            <!DOCTYPE html>
+            <html>
+            <head>
+                <title>403 - 访问被禁止</title>
+                <style>
+                    body { font-family: Arial, sans-serif; text-align: center; padding: 50px; }
+                    h1 { font-size: 36px; color: #333; }
+                    p { font-size: 18px; color: #666; }
+                    a { color: #0066cc; text-decoration: none; }
+                </style>
+            </head>
+            <body>
+                <h1>403 - 访问被禁止</h1>
+                <p>抱歉，您没有权限访问此页面。</p>
+                <p><a href="/">返回首页</a></p>
+            </body>
+            </html>
             """
-            logger.warning(f"404页面文件 {config['NOT_FOUND_FILE']} 不存在，使用默认模板")
+            logger.warning(f"403页面文件 {config['FORBIDDEN_FILE']} 不存在，使用默认模板")
         
         # 编译正则表达式用于解析模板标签
         self.resource_pattern = re.compile(r'\{\{path:"([^"]+)",\s*filename:"([^"]+)"\}\}')
@@ -662,260 +3078,1634 @@ class Template(object):
         self.if_else_pattern = re.compile(r'\{\%\s*if\s+(.+?)\s*\%\}(.*?)\{\%\s*else\s*\%\}(.*?)\{\%\s*endif\s*\%\}', re.DOTALL)  # 条件带else: {% if condition %}...{% else %}...{% endif %}
         self.for_pattern = re.compile(r'\{\%\s*for\s+([a-zA-Z0-9_]+)\s+in\s+([a-zA-Z0-9_\.]+)\s*\%\}(.*?)\{\%\s*endfor\s*\%\}', re.DOTALL)  # 循环: {% for item in items %}...{% endfor %}
 
-    def _process_template(self, template_content, context=None):
-        """处理模板内容，替换资源引用并应用上下文变量"""
-        if context is None:
-            context = {}
-        
-        # 替换资源引用
-        def replace_resource(match):
-            path_type = match.group(1)
-            filename = match.group(2)
-            
-            # 根据路径类型构建URL
-            if path_type == "static":
-                return f"{config.get('SERVER', '')}/static/{filename}"
-            elif path_type == "templates":
-                return f"{config.get('SERVER', '')}/templates/{filename}"
-            else:
-                return f"{config.get('SERVER', '')}/{path_type}/{filename}"
-        
-        # 替换资源引用 - 修复正则表达式匹配和替换逻辑
-        processed_content = self.resource_pattern.sub(replace_resource, template_content)
-        
-        # 添加更多的资源引用模式匹配
-        # 处理 src="static/xxx" 格式
-        processed_content = re.sub(r'src="static/([^"]+)"', 
-                                  f'src="{config.get("SERVER", "")}/static/\\1"', 
-                                  processed_content)
-        
-        # 处理 href="static/xxx" 格式
-        processed_content = re.sub(r'href="static/([^"]+)"', 
-                                  f'href="{config.get("SERVER", "")}/static/\\1"', 
-                                  processed_content)
-        
-        # 处理 src="templates/xxx" 格式
-        processed_content = re.sub(r'src="templates/([^"]+)"', 
-                                  f'src="{config.get("SERVER", "")}/templates/\\1"', 
-                                  processed_content)
-        
-        # 处理 href="templates/xxx" 格式
-        processed_content = re.sub(r'href="templates/([^"]+)"', 
-                                  f'href="{config.get("SERVER", "")}/templates/\\1"', 
-                                  processed_content)
-        
-        # 处理 url(static/xxx) 格式 (CSS中的URL引用)
-        processed_content = re.sub(r'url\([\'\"]?static/([^\'\"\)]+)[\'\"]?\)', 
-                                  f'url({config.get("SERVER", "")}/static/\\1)', 
-                                  processed_content)
-        
-        # 处理条件语句 (if-else)
-        def process_if_else(match):
-            condition = match.group(1).strip()
-            if_content = match.group(2)
-            else_content = match.group(3)
-            
-            # 评估条件
-            try:
-                # 安全地评估条件，只允许简单的比较和逻辑操作
-                # 替换变量为实际值
-                for var_name, var_value in context.items():
-                    condition = condition.replace(var_name, repr(var_value))
-                
-                # 评估条件
-                result = eval(condition, {"__builtins__": {}}, {})
-                return self._process_template(if_content if result else else_content, context)
-            except Exception as e:
-                logger.error(f"条件评估错误: {e}, 条件: {condition}")
-                return f"<!-- 条件评估错误: {condition} -->"
-        
-        # 处理条件语句 (if)
-        def process_if(match):
-            condition = match.group(1).strip()
-            content = match.group(2)
-            
-            # 评估条件
-            try:
-                # 替换变量为实际值
-                for var_name, var_value in context.items():
-                    condition = condition.replace(var_name, repr(var_value))
-                
-                # 评估条件
-                result = eval(condition, {"__builtins__": {}}, {})
-                return self._process_template(content, context) if result else ""
-            except Exception as e:
-                logger.error(f"条件评估错误: {e}, 条件: {condition}")
-                return f"<!-- 条件评估错误: {condition} -->"
-        
-        # 处理循环语句
-        def process_for(match):
-            var_name = match.group(1)
-            collection_name = match.group(2)
-            loop_content = match.group(3)
-            
-            # 获取集合
-            collection = self._get_nested_value(context, collection_name)
-            if not collection or not isinstance(collection, (list, tuple, dict)):
-                return f"<!-- 循环错误: {collection_name} 不是有效的集合 -->"
-            
-            # 处理循环
-            result = []
-            for item in collection:
-                # 创建新的上下文，包含循环变量
-                loop_context = context.copy()
-                loop_context[var_name] = item
-                # 递归处理循环内容
-                processed_loop = self._process_template(loop_content, loop_context)
-                result.append(processed_loop)
-            
-            return "".join(result)
-        
-        # 应用模板处理
-        processed_content = self.if_else_pattern.sub(process_if_else, processed_content)
-        processed_content = self.if_pattern.sub(process_if, processed_content)
-        processed_content = self.for_pattern.sub(process_for, processed_content)
-        
-        # 替换变量
-        def replace_var(match):
-            var_path = match.group(1)
-            value = self._get_nested_value(context, var_path)
-            return str(value) if value is not None else f"<!-- 未定义变量: {var_path} -->"
-        
-        processed_content = self.var_pattern.sub(replace_var, processed_content)
-        
-        # 替换简单的上下文变量 (向后兼容)
-        for key, value in context.items():
-            placeholder = '{' + key + '}'
-            processed_content = processed_content.replace(placeholder, str(value))
-        
-        return processed_content
-    
-    def _get_nested_value(self, context, var_path):
-        """获取嵌套字典中的值，支持点号访问，如 user.name"""
-        parts = var_path.split('.')
-        value = context
-        
-        for part in parts:
-            if isinstance(value, dict) and part in value:
-                value = value[part]
-            elif hasattr(value, part):
-                value = getattr(value, part)
+        # 模板中的相对资源路径改写为服务器上的绝对路径
+        server = config.get("SERVER", "")
+        self.path_rewrites = [
+            (re.compile(r'src="static/([^"]+)"'), f'src="{server}/static/\\1"'),  # src="static/xxx"
+            (re.compile(r'href="static/([^"]+)"'), f'href="{server}/static/\\1"'),  # href="static/xxx"
+            (re.compile(r'src="templates/([^"]+)"'), f'src="{server}/templates/\\1"'),  # src="templates/xxx"
+            (re.compile(r'href="templates/([^"]+)"'), f'href="{server}/templates/\\1"'),  # href="templates/xxx"
+            (re.compile(r'url\([\'\"]?static/([^\'\"\)]+)[\'\"]?\)'), f'url({server}/static/\\1)'),  # CSS中的 url(static/xxx)
+        ]
+
+        # 模板编译结果与渲染结果缓存
+        self.sources = {
+            'index': self.index_html,
+            'login': self.login_html,
+            'chat': self.chat_html,
+            'not_found': self.not_found_html,
+            'forbidden': self.forbidden_html,
+        }
+        self.compiled = {}
+        self.rendered = {}
+        self.render_lock = Lock()
+
+    def compile(self, template_content):
+        """返回模板内容对应的编译结果，同一内容只解析一次"""
+        compiled = self.compiled.get(template_content)
+        if compiled is None:
+            compiled = CompiledTemplate(self, template_content)
+            with self.render_lock:
+                if len(self.compiled) >= TEMPLATE_COMPILE_CACHE_SIZE:
+                    self.compiled.clear()
+                self.compiled[template_content] = compiled
+        return compiled
+
+    def resource_url(self, path_type, filename):
+        """根据资源引用标签构建URL"""
+        if path_type == "static":
+            url = f"{config.get('SERVER', '')}/static/{filename}"
+        elif path_type == "templates":
+            url = f"{config.get('SERVER', '')}/templates/{filename}"
+        else:
+            url = f"{config.get('SERVER', '')}/{path_type}/{filename}"
+        # 本地静态资源附加内容版本参数，浏览器可以长期缓存
+        if path_type.split('/')[0] in ("static", "templates"):
+            url = asset_registry.url(url, os.path.join(self.template_dir, path_type, filename))
+        return url
+
+    def _process_template(self, template_content, context=None):
+        """处理模板内容，替换资源引用并应用上下文变量"""
+        return self.compile(template_content).render(context or {})
+
+    def render(self, name, context=None):
+        """渲染已加载的页面模板（index/login/chat/not_found/forbidden）"""
+        return self.compile(self.sources[name]).render(context or {})
+
+    def render_bytes(self, name, context=None, memoize=True):
+        """渲染页面模板并返回编码后的字节串
+
+        结果按模板实际引用的上下文变量与静态资源版本记忆，输入不变时直接返回同一个 bytes 对象，
+        首页、聊天页等固定页面的发送只是一次字典查找。上下文随请求变化（如404页面的请求地址）时
+        传入 memoize=False，避免一次性的渲染结果挤占记忆空间。
+        """
+        context = context or {}
+        compiled = self.compile(self.sources[name])
+        key = compiled.memo_key(context) if memoize else None
+        if key is None:
+            return compiled.render(context).encode(self.encoding)
+        memo = self.rendered.get(name)
+        generation = asset_registry.generation
+        if memo is not None:
+            encoded = memo.get((generation, key))
+            if encoded is not None:
+                return encoded
+        encoded = compiled.render(context).encode(self.encoding)
+        # 渲染过程中可能登记了新的静态资源，记忆时使用渲染之后的资源版本代数
+        generation = asset_registry.generation
+        with self.render_lock:
+            memo = self.rendered.setdefault(name, collections.OrderedDict())
+            memo[(generation, key)] = encoded
+            while len(memo) > TEMPLATE_RENDER_CACHE_SIZE:
+                memo.popitem(last=False)
+        return encoded
+    
+    def variant_key(self, name, context=None):
+        """内容固定的页面在预压缩变体缓存中的键：模板名、静态资源版本代数与记忆键，不能记忆时返回 None"""
+        key = self.compile(self.sources[name]).memo_key(context or {})
+        if key is None:
+            return None
+        return ('template', name, asset_registry.generation, key)
+
+    def _get_nested_value(self, context, var_path):
+        """获取嵌套字典中的值，支持点号访问，如 user.name"""
+        parts = var_path.split('.')
+        value = context
+        
+        for part in parts:
+            if isinstance(value, dict) and part in value:
+                value = value[part]
+            elif hasattr(value, part):
+                value = getattr(value, part)
+            else:
+                return None
+        
+        return value
+
+    def login_context(self, login_failed=False, error_message=None):
+        """登录页的上下文变量"""
+        return {
+            'login_failed': '1' if login_failed else '0',
+            'timestamp': str(int(time.time())),
+            'server_name': config.get('SERVER_NAME', 'SilkRoad'),
+            'error_message': error_message if error_message else '' # 添加错误消息
+        }
+
+    def not_found_context(self, requested_url=''):
+        """404页面的上下文变量"""
+        return {
+            'timestamp': str(int(time.time())),
+            'server_name': config.get('SERVER_NAME', 'SilkRoad'),
+            'requested_url': requested_url
+        }
+
+    def get_login_html(self, login_failed=False, error_message=None):
+        """获取处理后的登录页HTML"""
+        try:
+            return self.render('login', self.login_context(login_failed, error_message))
+        except Exception as e:
+            # 如果格式化失败，记录错误并返回原始模板
+            logger.error(f"登录页面格式化错误: {e}")
+            return self.login_html # 保持返回原始模板，避免因格式化失败导致无法登录
+
+    def get_login_bytes(self, login_failed=False, error_message=None):
+        """获取编码后的登录页HTML"""
+        try:
+            return self.render_bytes('login', self.login_context(login_failed, error_message))
+        except Exception as e:
+            logger.error(f"登录页面格式化错误: {e}")
+            return self.login_html.encode(self.encoding)
+
+    def get_index_html(self, context=None):
+        """获取处理后的首页HTML"""
+        return self.render('index', context)
+        
+    def get_chat_html(self, context=None):
+        """获取处理后的聊天页HTML"""
+        return self.render('chat', context)
+
+    def get_not_found_html(self, context=None):
+        """获取处理后的404页面HTML"""
+        if context is None:
+            context = self.not_found_context()
+        return self.render('not_found', context)
+
+    def get_forbidden_bytes(self):
+        """获取编码后的403页面，内容固定，渲染结果被记忆，每次只是一次字典查找"""
+        return self.render_bytes('forbidden', self.FORBIDDEN_CONTEXT)
+
+    def render_template(self, template_name, context=None):
+        """渲染指定的模板文件"""
+        if context is None:
+            context = {}
+        
+        template_path = os.path.join(self.template_dir, "templates", template_name)
+        if not os.path.exists(template_path):
+            logger.error(f"模板文件不存在: {template_path}")
+            return f"<!-- 模板文件不存在: {template_name} -->"
+        
+        try:
+            with open(template_path, encoding=self.encoding) as f:
+                template_content = f.read()
+            return self._process_template(template_content, context)
+        except Exception as e:
+            logger.error(f"渲染模板 {template_name} 失败: {e}")
+            return f"<!-- 渲染模板失败: {template_name}, 错误: {e} -->"
+    
+    def get_static_file(self, filename):
+        """获取静态文件内容"""
+        file_path = os.path.join(self.static_dir, filename)
+        if not os.path.exists(file_path):
+            return None, None
+        
+        # 根据文件扩展名确定内容类型
+        content_type = self._get_content_type(filename)
+        
+        try:
+            with open(file_path, 'rb') as f:
+                content = f.read()
+            return content, content_type
+        except Exception as e:
+            logger.error(f"读取静态文件失败 {filename}: {e}")
+            return None, None
+    
+    def _get_content_type(self, filename):
+        """根据文件扩展名确定内容类型"""
+        ext = os.path.splitext(filename)[1].lower()
+        content_types = {
+            '.css': 'text/css',
+            '.js': 'application/javascript',
+            '.jpg': 'image/jpeg',
+            '.jpeg': 'image/jpeg',
+            '.png': 'image/png',
+            '.gif': 'image/gif',
+            '.svg': 'image/svg+xml',
+            '.ico': 'image/x-icon',
+            '.woff': 'font/woff',
+            '.woff2': 'font/woff2',
+            '.ttf': 'font/ttf',
+            '.eot': 'application/vnd.ms-fontobject',
+            '.otf': 'font/otf',
+            '.json': 'application/json',
+            '.xml': 'application/xml',
+            '.pdf': 'application/pdf',
+            '.txt': 'text/plain',
+        }
+        return content_types.get(ext, 'application/octet-stream')
+
+template = Template()
+
+# ------------------ 浏览器信息伪装 ------------------
+USER_AGENTS = [
+    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36",
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 13_4) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.5 Safari/605.1.15",
+    "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36"
+]
+
+# ------------------ 响应压缩 ------------------
+# brotli 为可选依赖（pip install brotli），未安装时只使用 gzip
+try:
+    import brotli
+except ImportError:
+    try:
+        import brotlicffi as brotli
+    except ImportError:
+        brotli = None
+
+# 值得压缩的文本类内容类型
+COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/x-javascript', 'application/json',
+                      'application/xml', 'application/xhtml+xml', 'application/rss+xml', 'image/svg+xml',
+                      'application/manifest+json', 'application/vnd.ms-fontobject', 'font/ttf', 'font/otf')
+# 小于该字节数的响应压缩收益不明显，直接原样发送
+COMPRESSION_MIN_SIZE = 1024
+
+def parse_accept_encoding(value):
+    """解析 Accept-Encoding 请求头，返回客户端接受的编码集合（忽略 q=0 的项）"""
+    accepted = set()
+    for item in (value or '').split(','):
+        name, _, params = item.strip().partition(';')
+        name = name.strip().lower()
+        if not name:
+            continue
+        q = params.strip()
+        if q.startswith('q='):
+            try:
+                if float(q[2:]) <= 0:
+                    continue
+            except ValueError:
+                continue
+        accepted.add(name)
+    return accepted
+
+def client_accepts_encoding(accept_encoding, encoding):
+    """判断客户端是否接受指定的内容编码"""
+    accepted = parse_accept_encoding(accept_encoding)
+    return encoding.lower() in accepted or '*' in accepted
+
+def is_compressible(content_type):
+    """判断内容类型是否值得压缩"""
+    content_type = (content_type or '').lower()
+    return any(content_type.startswith(t) for t in COMPRESSIBLE_TYPES)
+
+def negotiate_encoding(accept_encoding):
+    """根据客户端 Accept-Encoding 选择响应压缩格式，优先 brotli，不支持时返回 None"""
+    if not config.get('COMPRESSION_ENABLED', True):
+        return None
+    accepted = parse_accept_encoding(accept_encoding)
+    if brotli is not None and 'br' in accepted:
+        return 'br'
+    if 'gzip' in accepted or '*' in accepted:
+        return 'gzip'
+    return None
+
+def compress_bytes(content, encoding, best=False):
+    """压缩完整内容，best 为 True 时使用最高压缩级别（用于只压缩一次的预压缩变体）"""
+    if encoding == 'br':
+        return brotli.compress(content, quality=11 if best else 5)
+    compressor = zlib.compressobj(9 if best else 6, zlib.DEFLATED, 31)
+    return compressor.compress(content) + compressor.flush()
+
+def add_vary(headers, name):
+    """向响应头字典的 Vary 中追加一项"""
+    vary = headers.get('Vary')
+    if not vary:
+        headers['Vary'] = name
+    elif name.lower() not in [v.strip().lower() for v in vary.split(',')]:
+        headers['Vary'] = vary + ', ' + name
+
+def add_compression_headers(headers, encoding):
+    """为压缩后的响应添加 Content-Encoding 与 Vary 响应头"""
+    if encoding:
+        headers['Content-Encoding'] = encoding
+        add_vary(headers, 'Accept-Encoding')
+
+class StreamCompressor:
+    """流式压缩器：每块数据压缩后立即同步刷新，浏览器可以边接收边渲染"""
+    def __init__(self, encoding):
+        self.encoding = encoding
+        if encoding == 'br':
+            self.compressor = brotli.Compressor(quality=4)
+        else:
+            self.compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    def compress(self, data):
+        if self.encoding == 'br':
+            return self.compressor.process(data) + self.compressor.flush()
+        return self.compressor.compress(data) + self.compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    def finish(self):
+        if self.encoding == 'br':
+            return self.compressor.finish()
+        return self.compressor.flush()
+
+class CompressedVariantCache:
+    """预压缩变体缓存：静态文件、模板与固定页面每种编码只压缩一次
+
+    键为调用方提供的内容标识（文件为路径、修改时间与大小），文件变化后键随之改变，
+    旧变体按 LRU 顺序被淘汰。
+    """
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, content, encoding):
+        """返回内容的压缩变体，压缩后没有变小时返回 None
+
+        content 也可以是返回内容的函数，只在变体尚未缓存、需要压缩时才调用。
+        """
+        cache_key = (key, encoding)
+        with self.lock:
+            if cache_key in self.entries:
+                self.entries.move_to_end(cache_key)
+                self.hits += 1
+                return self.entries[cache_key]
+            self.misses += 1
+        if callable(content):
+            content = content()
+        compressed = compress_bytes(content, encoding, best=True)
+        if len(compressed) >= len(content):
+            compressed = None
+        with self.lock:
+            self.entries[cache_key] = compressed
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return compressed
+
+    def file_key(self, file_path):
+        """以路径、修改时间与大小作为文件内容标识"""
+        stat = os.stat(file_path)
+        return file_path, stat.st_mtime_ns, stat.st_size
+
+    def warm(self, directories):
+        """启动时预先压缩目录中的文本文件，首个请求无需等待压缩"""
+        encodings = ['gzip'] + (['br'] if brotli is not None else [])
+        count = 0
+        for directory in directories:
+            for root, _, files in os.walk(directory):
+                for name in files:
+                    file_path = os.path.join(root, name)
+                    if not is_compressible(template._get_content_type(name)):
+                        continue
+                    try:
+                        with open(file_path, 'rb') as f:
+                            content = f.read()
+                        if len(content) < COMPRESSION_MIN_SIZE:
+                            continue
+                        key = self.file_key(file_path)
+                        for encoding in encodings:
+                            self.get(key, content, encoding)
+                        count += 1
+                    except OSError as e:
+                        logger.warning(f"预压缩文件失败 {file_path}: {e}")
+        logger.info(f"已预压缩 {count} 个静态资源文件")
+
+    def get_stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / total, 4) if total else None,
+            }
+
+compressed_variants = CompressedVariantCache()
+
+# ------------------ 静态资源服务 ------------------
+ASSET_CHECK_INTERVAL = 2  # 同一文件两次检查是否被修改的最小间隔（秒）
+ASSET_IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+class Asset:
+    """静态资源文件的元数据，ETag 由文件内容的哈希得到"""
+    __slots__ = ('path', 'size', 'mtime_ns', 'content_type', 'digest', 'etag', 'last_modified', 'checked_at')
+
+    def __init__(self, path, file_stat, content_type, digest):
+        self.path = path
+        self.size = file_stat.st_size
+        self.mtime_ns = file_stat.st_mtime_ns
+        self.content_type = content_type
+        self.digest = digest
+        self.etag = f'"{digest}"'
+        self.last_modified = email.utils.formatdate(file_stat.st_mtime, usegmt=True)
+        self.checked_at = time.time()
+
+    @property
+    def key(self):
+        """预压缩变体的键，与 CompressedVariantCache.file_key 一致"""
+        return self.path, self.mtime_ns, self.size
+
+    @property
+    def version(self):
+        """资源 URL 中的版本参数"""
+        return self.digest[:12]
+
+    def read(self):
+        with open(self.path, 'rb') as f:
+            return f.read()
+
+class AssetRegistry:
+    """静态资源注册表：保存文件元数据与内容哈希，用于强验证器、304 响应和带版本号的资源 URL
+
+    文件在首次使用时登记，之后最多每 ASSET_CHECK_INTERVAL 秒检查一次修改时间与大小，变化时重新计算哈希。
+    URL 带有与当前内容一致的 ?v= 版本参数时，内容不会再变化，浏览器可以长期缓存而无需重新验证。
+    """
+    def __init__(self):
+        self.assets = {}
+        self.lock = Lock()
+        self.stats = {'requests': 0, 'not_modified': 0, 'immutable': 0}
+        # 资源登记、内容变化或删除时递增，模板渲染结果以此判断版本号是否过期
+        self.generation = 0
+
+    def get(self, path, refresh=False):
+        """返回文件的元数据，文件不存在或不是普通文件时返回 None"""
+        now = time.time()
+        asset = self.assets.get(path)
+        if asset is not None and not refresh and now - asset.checked_at < ASSET_CHECK_INTERVAL:
+            return asset
+        try:
+            file_stat = os.stat(path)
+        except OSError:
+            file_stat = None
+        if file_stat is None or not stat.S_ISREG(file_stat.st_mode):
+            with self.lock:
+                if self.assets.pop(path, None) is not None:
+                    self.generation += 1
+            return None
+        if asset is not None and asset.mtime_ns == file_stat.st_mtime_ns and asset.size == file_stat.st_size:
+            asset.checked_at = now
+            return asset
+        try:
+            digest = self._digest(path)
+        except OSError as e:
+            logger.warning(f"读取静态资源失败 {path}: {e}")
+            return None
+        asset = Asset(path, file_stat, template._get_content_type(path), digest)
+        with self.lock:
+            previous = self.assets.get(path)
+            if previous is None or previous.digest != digest:
+                self.generation += 1
+            self.assets[path] = asset
+        return asset
+
+    def _digest(self, path):
+        digest = hashlib.md5()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        return digest.hexdigest()
+
+    def url(self, url, path):
+        """为资源 URL 附加内容版本参数，文件不存在时原样返回"""
+        asset = self.get(path)
+        return f"{url}?v={asset.version}" if asset is not None else url
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.stats, entries=len(self.assets))
+
+asset_registry = AssetRegistry()
+
+# ------------------ 代理处理 ------------------
+# 需要逐事件实时转发的流式响应类型
+STREAMING_CONTENT_TYPES = ('text/event-stream', 'application/x-ndjson', 'application/stream+json')
+# 非 HTML 响应需要原样转发的区间请求相关响应头
+RANGE_PASSTHROUGH_HEADERS = ('Accept-Ranges', 'ETag', 'Last-Modified')
+# 转发给浏览器的缓存控制与验证器响应头
+CLIENT_CACHE_HEADERS = ('Cache-Control', 'Expires', 'Age', 'ETag', 'Last-Modified')
+
+# 可以向上游声明接受的压缩格式：gzip/deflate 始终可解码，br 与 zstd 依赖可选库
+UPSTREAM_ENCODINGS = ['gzip', 'deflate']
+if brotli is not None:
+    UPSTREAM_ENCODINGS.append('br')
+try:
+    import zstandard  # noqa: F401
+    UPSTREAM_ENCODINGS.append('zstd')
+except ImportError:
+    pass
+
+def decode_content(content, encoding):
+    """一次性解码压缩过的完整响应体"""
+    return httpx.Response(200, headers={'Content-Encoding': encoding}, content=content).content
+
+def sendfile_to_socket(sock, f, offset, count, chunk_size=64 * 1024):
+    """将文件中的一段直接发送到套接字
+
+    普通 TCP 套接字由 os.sendfile 在内核中完成拷贝；TLS 套接字无法使用 sendfile，
+    改为把 mmap 的内存视图分块交给 SSL 层加密，同样不需要把文件内容读成 bytes 对象。
+    """
+    if count <= 0:
+        return
+    if not isinstance(sock, ssl.SSLSocket) and hasattr(os, 'sendfile'):
+        sock.sendfile(f, offset, count)
+        return
+    with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+        view = memoryview(m)
+        try:
+            for pos in range(offset, offset + count, chunk_size):
+                sock.sendall(view[pos:min(pos + chunk_size, offset + count)])
+        finally:
+            view.release()
+
+class CachedResponse:
+    """由缓存内容构造的响应对象，接口与 httpx.Response 的常用部分保持一致
+
+    响应体在内存中（content），或者只在磁盘缓存记录中（content 为 None，由 entry 给出位置）。
+    """
+    def __init__(self, content, headers, entry=None):
+        self.content = content
+        self.entry = entry
+        # 缓存的是上游原始字节，未被客户端接受的内容编码已在读取缓存时解码
+        self.headers = httpx.Headers(headers or {})
+        self.headers['Content-Length'] = str(len(content) if content is not None else entry.body_length)
+        self.status_code = 200
+        self.encoding = 'utf-8'
+
+    def read(self):
+        if self.content is None:
+            self.content = self.entry.read_body()
+        return self.content
+
+    def iter_bytes(self, chunk_size):
+        """分块产出响应体：内存中的内容按内存视图切片，磁盘上的内容通过 mmap 读取"""
+        chunk_size = chunk_size or PERFORMANCE_CONFIG['STREAM_CHUNK_SIZE']
+        if self.content is not None:
+            view = memoryview(self.content)
+            for pos in range(0, len(view), chunk_size):
+                yield view[pos:pos + chunk_size]
+            return
+        entry = self.entry
+        if not entry.body_length:
+            return
+        end = entry.body_offset + entry.body_length
+        with entry.open_body() as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            for pos in range(entry.body_offset, end, chunk_size):
+                yield m[pos:min(pos + chunk_size, end)]
+
+    def iter_raw(self, chunk_size):
+        return self.iter_bytes(chunk_size)
+
+def link_rules(scheme, site):
+    """返回链接修正规则列表 [(原始字节串, 替换字节串), ...]"""
+    # 示例规则，可根据需求扩展更多解析规则
+    rules = [
+        ("'{}http://", config['SERVER']),
+        ('"{}http://', config['SERVER']),
+        ("'{}https://", config['SERVER']),
+        ('"{}https://', config['SERVER']),
+        ('"{}//', config['SERVER'] + scheme + ':'),
+        ("'{}//", config['SERVER'] + scheme + ':'),
+        ('"{}/', config['SERVER'] + site),
+        ("'{}/", config['SERVER'] + site),
+    ]
+    return [(rule[0].replace('{}', '').encode('utf-8'), rule[0].format(rule[1]).encode('utf-8'))
+            for rule in rules]
+
+class LinkRewriteEngine:
+    """由规则表编译出的单遍链接修正引擎
+
+    所有规则的匹配串合并为一个字节正则（按长度从长到短排列，保证 "// 优先于 "/），
+    与 </body> 插入点一起在一次扫描中完成全部替换，UTF-8 页面全程不需要转换为 str。
+    每个 (scheme, site) 只编译一次，引擎本身无状态，可在多个线程间共享。
+    """
+    BODY_END = b'</body>'
+
+    def __init__(self, rules, script_tags=b''):
+        self.replacements = dict(rules)
+        self.replacements[self.BODY_END] = self.BODY_END
+        self.script_tags = script_tags
+        tokens = sorted(self.replacements, key=len, reverse=True)
+        # 使用捕获分组，split 后奇数位置即为匹配到的规则串，避免逐个匹配回调 Python 函数
+        self.pattern = re.compile(b'(' + b'|'.join(re.escape(token) for token in tokens) + b')')
+        # 需要跨块保留的最大字节数（最长匹配串长度减一）
+        self.hold_size = max(len(token) for token in tokens) - 1
+
+@functools.lru_cache(maxsize=1024)
+def get_rewrite_engine(scheme, site, script_tags=b'', scripts_version=0):
+    """按 (scheme, site, 脚本版本) 缓存已编译的链接修正引擎"""
+    return LinkRewriteEngine(link_rules(scheme, site), script_tags)
+
+class StreamingLinkRewriter:
+    """分块修正 HTML 中的链接并插入自定义脚本
+
+    所有修正规则都以引号开头，插入点为 </body>。每次处理时把末尾可能是
+    规则前缀的少量字节留到下一块，保证跨块边界的链接也能被正确修正，
+    因此每个请求只需保留几块数据，而不是整个页面的多份副本。
+    """
+    def __init__(self, engine, encoding='utf-8', origins=None, subresources=None):
+        self.engine = engine
+        self.injected = not engine.script_tags
+        self.tail = b''
+        # 收集页面引用的源站（OriginCollector），用于预连接
+        self.origins = origins
+        # 收集页面的关键子资源（SubresourceCollector），用于预取
+        self.subresources = subresources
+        # 非 UTF-8 页面先增量解码再转为 UTF-8，UTF-8 页面直接按字节处理
+        self.decoder = None
+        try:
+            if codecs.lookup(encoding).name != 'utf-8':
+                self.decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+        except LookupError:
+            logger.warning(f"未知的页面编码 {encoding}，按UTF-8处理")
+
+    def feed(self, chunk):
+        """处理一块数据，返回可以立即发送的修正后内容"""
+        if self.decoder is not None:
+            chunk = self.decoder.decode(chunk).encode('utf-8')
+        buf = self.tail + chunk
+        cut = len(buf)
+        window = self.engine.hold_size
+        for marker in (b'"', b"'", b'<'):
+            pos = buf.rfind(marker, max(0, len(buf) - window))
+            if pos != -1 and pos < cut:
+                cut = pos
+        self.tail = buf[cut:]
+        return self._rewrite(buf[:cut])
+
+    def flush(self):
+        """处理剩余数据，在响应体结束时调用"""
+        buf = self.tail
+        if self.decoder is not None:
+            buf += self.decoder.decode(b'', final=True).encode('utf-8')
+        self.tail = b''
+        return self._rewrite(buf)
+
+    def _rewrite(self, data):
+        if not data:
+            return data
+        if self.origins is not None:
+            self.origins.feed(data)
+        if self.subresources is not None:
+            self.subresources.feed(data)
+        parts = self.engine.pattern.split(data)
+        if len(parts) == 1:
+            return data
+        tokens = parts[1::2]
+        parts[1::2] = map(self.engine.replacements.__getitem__, tokens)
+        # 只在第一个</body>标签后插入脚本
+        if not self.injected and LinkRewriteEngine.BODY_END in tokens:
+            index = tokens.index(LinkRewriteEngine.BODY_END) * 2 + 1
+            parts[index] = LinkRewriteEngine.BODY_END + self.engine.script_tags
+            self.injected = True
+        return b''.join(parts)
+
+# 共享缓冲区的上限（字节）：接受新跟随者期间最多缓冲这么多数据，之后跟随者落后超过该值时领头请求暂停读取上游
+INFLIGHT_MAX_BUFFER = 8 * 1024 * 1024
+# 领头请求等待落后的跟随者读取的最长时间（秒），超时后断开最慢的跟随者
+INFLIGHT_LAG_TIMEOUT = 10
+
+def _resolve_future(future):
+    if not future.done():
+        future.set_result(None)
+
+class InflightFetch:
+    """一次正在进行的可缓存上游请求，相同缓存键的并发请求共享它的响应体
+
+    发起请求的领头请求在转发的同时把上游原始数据块追加到缓冲区，跟随请求从缓冲区
+    起点开始读取，并各自完成解码、链接修正与压缩。同步与异步引擎的跟随者都可以等待。
+    停止接受新的跟随者后，所有跟随者都已读过的数据块立即释放；没有跟随者时不再缓冲，
+    跟随者落后太多时领头请求暂停读取上游，等待超时仍未跟上的跟随者被断开，每个请求占用的内存始终有上限。
+    """
+    def __init__(self, key, buffer_limit=None, cookie=None):
+        self.key = key
+        self.buffer_limit = buffer_limit
+        # 领头请求携带的 Cookie，响应可能因用户而异
+        self.cookie = cookie
+        self.cond = Condition()
+        self.async_waiters = []
+        self.status_code = None
+        self.headers = None
+        self.shareable = None  # None 表示尚未收到上游响应头
+        # 缓冲区中的数据块，base 为第一个数据块的序号，buffered 为缓冲的字节数
+        self.chunks = []
+        self.base = 0
+        self.buffered = 0
+        self.size = 0
+        self.done = False
+        self.error = None
+        # 缓冲超过上限后不再接受新的跟随者，已加入的跟随者不受影响
+        self.accepting = True
+        # 已加入但尚未开始读取的跟随者数量，以及正在读取的跟随者 -> 下一个要读取的数据块序号
+        self.joined = 0
+        self.followers = {}
+        self.detached = set()
+
+    def _notify(self):
+        """唤醒所有等待者，调用方需持有 self.cond"""
+        self.cond.notify_all()
+        waiters, self.async_waiters = self.async_waiters, []
+        for loop, future in waiters:
+            loop.call_soon_threadsafe(_resolve_future, future)
+
+    def publish(self, r, shareable):
+        """领头请求收到上游响应头，可共享时返回一边读取一边写入缓冲区的响应"""
+        with self.cond:
+            self.status_code = r.status_code
+            self.headers = httpx.Headers(r.headers)
+            self.shareable = shareable
+            if not shareable:
+                self.accepting = False
+            self._notify()
+        if not shareable:
+            return r
+        return httpx.Response(r.status_code, headers=self.headers, stream=InflightStream(self, upstream=r))
+
+    def append(self, chunk):
+        with self.cond:
+            self.chunks.append(chunk)
+            self.size += len(chunk)
+            self.buffered += len(chunk)
+            limit = INFLIGHT_MAX_BUFFER if self.buffer_limit is None else min(self.buffer_limit, INFLIGHT_MAX_BUFFER)
+            if self.size > limit:
+                self.accepting = False
+            self._trim_locked()
+            self._notify()
+
+    def _trim_locked(self):
+        """释放所有跟随者都已读取的数据块，调用方需持有 self.cond"""
+        if self.accepting or self.joined:
+            # 仍可能有跟随者从头开始读取
+            return
+        end = min(self.followers.values(), default=self.base + len(self.chunks))
+        count = end - self.base
+        if count > 0:
+            self.buffered -= sum(len(chunk) for chunk in self.chunks[:count])
+            del self.chunks[:count]
+            self.base = end
+
+    def has_room(self):
+        with self.cond:
+            return self.buffered <= INFLIGHT_MAX_BUFFER
+
+    def wait_room(self, timeout=INFLIGHT_LAG_TIMEOUT):
+        """缓冲区超过上限时领头请求等待跟随者读取，超时后断开落后的跟随者"""
+        with self.cond:
+            if not self.cond.wait_for(lambda: self.buffered <= INFLIGHT_MAX_BUFFER, timeout):
+                self._detach_lagging_locked()
+
+    async def wait_room_async(self, timeout=INFLIGHT_LAG_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        while not self.has_room():
+            if time.monotonic() >= deadline:
+                with self.cond:
+                    self._detach_lagging_locked()
+                return
+            await asyncio.sleep(0.05)
+
+    def _detach_lagging_locked(self):
+        """从最慢的跟随者开始断开，直到缓冲区回到上限以内，调用方需持有 self.cond"""
+        while self.buffered > INFLIGHT_MAX_BUFFER and self.followers:
+            slowest = min(self.followers, key=self.followers.get)
+            del self.followers[slowest]
+            self.detached.add(slowest)
+            logger.warning(f"合并请求的跟随者读取过慢，已断开: {self.key}")
+            self._trim_locked()
+        self._notify()
+
+    def add_joined(self):
+        """记录新加入的跟随者，调用方需持有 SingleFlight 的锁"""
+        with self.cond:
+            self.joined += 1
+
+    def leave(self):
+        """已加入的跟随者放弃共享响应（等待超时或响应不可共享）"""
+        with self.cond:
+            self.joined -= 1
+            self._trim_locked()
+            self.cond.notify_all()
+
+    def start_follower(self):
+        """已加入的跟随者开始从缓冲区起点读取，返回跟随者标识"""
+        follower = object()
+        with self.cond:
+            self.joined -= 1
+            self.followers[follower] = 0
+            self._trim_locked()
+        return follower
+
+    def read_from(self, follower, index):
+        """返回跟随者从序号 index 开始可以读取的数据块，调用方需持有 self.cond"""
+        if follower in self.detached:
+            raise httpx.ReadError("跟随请求读取过慢，已断开共享的上游响应")
+        new_chunks = self.chunks[index - self.base:]
+        self.followers[follower] = index + len(new_chunks)
+        if new_chunks:
+            self._trim_locked()
+            # 唤醒可能在等待缓冲区空间的领头请求
+            self.cond.notify_all()
+        return new_chunks
+
+    def stop_follower(self, follower):
+        with self.cond:
+            self.followers.pop(follower, None)
+            self.detached.discard(follower)
+            self._trim_locked()
+            self.cond.notify_all()
+
+    def finish(self, error=None):
+        with self.cond:
+            if self.shareable is None:
+                self.shareable = False
+            self.done = True
+            self.error = error
+            self.accepting = False
+            self._notify()
+
+    def wait_head(self, timeout):
+        """等待领头请求的响应头，返回响应是否可以共享"""
+        with self.cond:
+            self.cond.wait_for(lambda: self.shareable is not None, timeout)
+            return bool(self.shareable)
+
+    async def wait_head_async(self, timeout):
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        while True:
+            with self.cond:
+                if self.shareable is not None:
+                    return bool(self.shareable)
+                future = loop.create_future()
+                self.async_waiters.append((loop, future))
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return False
+            try:
+                await asyncio.wait_for(future, remaining)
+            except asyncio.TimeoutError:
+                return False
+
+    def shareable_with(self, cookie):
+        """跟随请求的 Cookie 与领头请求相同，或响应明确声明 public 时才可以使用共享的响应"""
+        if cookie == self.cookie:
+            return True
+        return 'public' in parse_cache_control(self.headers.get('Cache-Control') if self.headers else None)
+
+    def follower_response(self):
+        """为跟随请求构造从缓冲区读取的响应"""
+        return httpx.Response(self.status_code, headers=self.headers,
+                              stream=InflightStream(self, follower=self.start_follower()))
+
+class InflightStream(httpx.SyncByteStream, httpx.AsyncByteStream):
+    """共享响应体的数据流：领头请求从上游读取并写入缓冲区，跟随请求从缓冲区读取"""
+    wait_timeout = 60
+
+    def __init__(self, fetch, upstream=None, follower=None):
+        self.fetch = fetch
+        self.upstream = upstream
+        self.upstream_iter = None
+        self.follower = follower
+
+    def __iter__(self):
+        fetch = self.fetch
+        if self.upstream is not None:
+            self.upstream_iter = self.upstream.iter_raw()
+            for chunk in self.upstream_iter:
+                fetch.append(chunk)
+                yield chunk
+                fetch.wait_room()
+            return
+        index = 0
+        try:
+            while True:
+                with fetch.cond:
+                    if not fetch.cond.wait_for(lambda: index < fetch.base + len(fetch.chunks) or fetch.done
+                                               or self.follower in fetch.detached, self.wait_timeout):
+                        raise httpx.ReadTimeout("等待共享的上游响应超时")
+                    new_chunks = fetch.read_from(self.follower, index)
+                    done, error = fetch.done, fetch.error
+                for chunk in new_chunks:
+                    yield chunk
+                index += len(new_chunks)
+                if done:
+                    if error is not None:
+                        raise httpx.ReadError(f"共享的上游请求失败: {error}")
+                    return
+        finally:
+            fetch.stop_follower(self.follower)
+
+    async def __aiter__(self):
+        fetch = self.fetch
+        if self.upstream is not None:
+            self.upstream_iter = self.upstream.aiter_raw()
+            async for chunk in self.upstream_iter:
+                fetch.append(chunk)
+                yield chunk
+                await fetch.wait_room_async()
+            return
+        loop = asyncio.get_running_loop()
+        index = 0
+        try:
+            while True:
+                future = None
+                with fetch.cond:
+                    new_chunks = fetch.read_from(self.follower, index)
+                    done, error = fetch.done, fetch.error
+                    if not new_chunks and not done:
+                        future = loop.create_future()
+                        fetch.async_waiters.append((loop, future))
+                if future is not None:
+                    try:
+                        await asyncio.wait_for(future, self.wait_timeout)
+                    except asyncio.TimeoutError:
+                        raise httpx.ReadTimeout("等待共享的上游响应超时")
+                    continue
+                for chunk in new_chunks:
+                    yield chunk
+                index += len(new_chunks)
+                if done:
+                    if error is not None:
+                        raise httpx.ReadError(f"共享的上游请求失败: {error}")
+                    return
+        finally:
+            fetch.stop_follower(self.follower)
+
+    def close(self):
+        """跟随请求结束（包括没有读取响应体的情况）时释放它在缓冲区中的位置"""
+        if self.follower is not None:
+            self.fetch.stop_follower(self.follower)
+
+    async def aclose(self):
+        self.close()
+
+    def drain(self):
+        """领头请求的客户端断开后，继续读完上游响应供跟随请求使用"""
+        if self.upstream_iter is None:
+            self.upstream_iter = self.upstream.iter_raw()
+        for chunk in self.upstream_iter:
+            self.fetch.append(chunk)
+            self.fetch.wait_room()
+
+    async def adrain(self):
+        if self.upstream_iter is None:
+            self.upstream_iter = self.upstream.aiter_raw()
+        async for chunk in self.upstream_iter:
+            self.fetch.append(chunk)
+            await self.fetch.wait_room_async()
+
+class SingleFlight:
+    """按规范化缓存键合并并发的可缓存 GET 请求，同一时刻每个键只有一个上游请求"""
+    def __init__(self):
+        self.inflight = {}
+        self.lock = Lock()
+        self.stats = {'origin': 0, 'coalesced': 0, 'declined': 0}
+
+    def join(self, key, buffer_limit=None, cookie=None):
+        """加入或发起请求，返回 (InflightFetch, 是否为领头请求)"""
+        with self.lock:
+            fetch = self.inflight.get(key)
+            if fetch is not None and fetch.accepting:
+                fetch.add_joined()
+                return fetch, False
+            fetch = self.inflight[key] = InflightFetch(key, buffer_limit, cookie)
+            self.stats['origin'] += 1
+            return fetch, True
+
+    def release(self, fetch, error=None):
+        """领头请求结束，唤醒跟随者并移除记录"""
+        fetch.finish(error)
+        with self.lock:
+            if self.inflight.get(fetch.key) is fetch:
+                del self.inflight[fetch.key]
+
+    def count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def get_stats(self):
+        with self.lock:
+            stats = dict(self.stats)
+            stats['inflight'] = len(self.inflight)
+        total = stats['origin'] + stats['coalesced']
+        stats['coalesced_ratio'] = round(stats['coalesced'] / total, 4) if total else None
+        return stats
+
+single_flight = SingleFlight()
+
+# ------------------ 域名分类 ------------------
+# 最近分类过的域名数量上限
+HOST_CLASSIFY_CACHE_SIZE = 4096
+# 由字母、数字和连字符组成、至少包含一个点号的域名
+DOMAIN_RE = re.compile(r'[a-zA-Z0-9][-a-zA-Z0-9]{0,62}(\.[a-zA-Z0-9][-a-zA-Z0-9]{0,62})+')
+
+def normalize_host(host):
+    """域名统一为小写、不带首尾点号的 ASCII（punycode）形式"""
+    host = host.strip().strip('.').lower()
+    if not host.isascii():
+        try:
+            host = host.encode('idna').decode('ascii')
+        except UnicodeError:
+            pass
+    return host
+
+class HostInfo:
+    """一个域名的分类结果"""
+    __slots__ = ('host', 'is_ip', 'is_domain', 'public_suffix', 'registrable_domain')
+
+    def __init__(self, host, is_ip, is_domain, public_suffix, registrable_domain):
+        self.host = host
+        self.is_ip = is_ip
+        # 语法正确且顶级域名在公共后缀列表中
+        self.is_domain = is_domain
+        self.public_suffix = public_suffix
+        # 可注册域名（eTLD+1），用于判断是否同站；域名本身是公共后缀时为 None，
+        # IP 地址、单标签主机名与未知顶级域名以主机本身作为站点
+        self.registrable_domain = registrable_domain
+
+class HostClassifier:
+    """进程内共享的域名分类服务
+
+    公共后缀列表只在启动时解析一次，顶级域名整理为集合；最近查询过的域名的分类结果保存在 LRU 中，
+    补全地址、代理请求、改写 Cookie 与黑名单共用同一份结果。
+    """
+    def __init__(self, cache_size=HOST_CLASSIFY_CACHE_SIZE):
+        start = time.perf_counter()
+        self.psl = PublicSuffixList()
+        # 规则中的最后一个标签即顶级域名（通配规则 *.ck 与例外规则 !www.ck 同样适用）
+        self.top_labels = frozenset(rule.rsplit('.', 1)[-1].lstrip('!*') for rule in self.psl.tlds)
+        self.load_ms = round((time.perf_counter() - start) * 1000, 1)
+        # 每个实例独立的缓存
+        self.classify = functools.lru_cache(maxsize=cache_size)(self._classify)
+
+    def _classify(self, host):
+        host = normalize_host(host or '')
+        try:
+            ipaddress.ip_address(host)
+            return HostInfo(host, True, False, None, host)
+        except ValueError:
+            pass
+        is_domain = (len(host) <= 255 and host.rsplit('.', 1)[-1] in self.top_labels
+                     and DOMAIN_RE.fullmatch(host) is not None)
+        public_suffix = self.psl.get_tld(host, strict=True) if '.' in host else None
+        if public_suffix is None:
+            registrable_domain = host
+        elif public_suffix == host:
+            registrable_domain = None
+        else:
+            registrable_domain = self.psl.get_sld(host, strict=True)
+        return HostInfo(host, False, is_domain, public_suffix, registrable_domain)
+
+    def is_domain(self, host):
+        """判断是否为公共后缀列表中顶级域名下的域名"""
+        return self.classify(host).is_domain
+
+    def registrable_domain(self, host):
+        """返回可注册域名（eTLD+1），域名本身是公共后缀时为 None"""
+        return self.classify(host).registrable_domain
+
+    def same_site(self, host, other):
+        """判断两个主机是否属于同一站点（可注册域名相同）"""
+        site = self.classify(host).registrable_domain
+        return site is not None and site == self.classify(other).registrable_domain
+
+    def get_stats(self):
+        info = self.classify.cache_info()
+        return {'load_ms': self.load_ms, 'cache_hits': info.hits, 'cache_misses': info.misses,
+                'cache_size': info.currsize}
+
+host_classifier = HostClassifier()
+
+# ------------------ 网站黑名单 ------------------
+BLACKLIST_FILE = 'databases/blacklist.json'
+# 检查黑名单文件是否修改的间隔（秒）
+BLACKLIST_WATCH_INTERVAL = 2
+# 前缀树节点的标记键（域名标签都是字符串，不会与整数键冲突），
+# 值为 True 表示整个域名（含子域名）被拦截，否则为该域名下 URL 模式的匹配函数
+BLACKLIST_MARK = 0
+# 整个域名被拦截的节点，所有这样的节点共用同一个字典，其下不再需要子节点
+BLACKLIST_BLOCKED_NODE = {BLACKLIST_MARK: True}
+
+def blacklist_host(entry):
+    """黑名单条目中的域名，去掉协议与开头的 *. 后规范化"""
+    host = entry.strip().lower()
+    if '://' in host:
+        host = host.split('://', 1)[1].split('/', 1)[0]
+    if host.startswith('*.'):
+        host = host[2:]
+    return normalize_host(host)
+
+def blacklist_glob(pattern, wildcard):
+    """把只含 * 通配符的模式转换为正则表达式"""
+    return wildcard.join(re.escape(part) for part in pattern.split('*'))
+
+class CompiledBlacklist:
+    """编译后的黑名单，创建后只读，重新加载时整体替换
+
+    域名按标签倒序存入前缀树（com -> example -> www），查找时从顶级域名逐级向下，
+    经过被拦截的节点即命中，耗时只与请求域名的标签数有关，与黑名单条目数量无关。
+    域名部分不含通配符的 URL 模式挂在对应域名的节点上，同一域名的模式合并为一个正则表达式；
+    域名部分含通配符的模式合并为一个全局正则表达式。
+    """
+    __slots__ = ('trie', 'pattern', 'domains', 'patterns')
+
+    def __init__(self, domains=(), patterns=()):
+        self.trie = {}
+        self.pattern = None
+        self.domains = 0
+        self.patterns = 0
+        for entry in domains:
+            host = blacklist_host(entry)
+            if host and self._insert(host, block=True) is not None:
+                self.domains += 1
+        host_patterns = {}
+        global_patterns = []
+        for entry in patterns:
+            entry = entry.strip()
+            if '://' in entry:
+                entry = entry.split('://', 1)[1]
+            host, sep, path = entry.partition('/')
+            path = blacklist_glob('/' + path, '.*') if sep else '.*'
+            key = blacklist_host(host)
+            if not key:
+                continue
+            if '*' in key:
+                global_patterns.append(blacklist_glob(host.lower(), '[^/]*') + path)
             else:
+                host_patterns.setdefault(key, []).append(path)
+            self.patterns += 1
+        for host, paths in host_patterns.items():
+            node = self._insert(host, block=False)
+            if node is not None:
+                node[BLACKLIST_MARK] = re.compile('|'.join(f'(?:{path})' for path in paths)).fullmatch
+        if global_patterns:
+            self.pattern = re.compile('|'.join(f'(?:{pattern})' for pattern in global_patterns)).fullmatch
+
+    def _insert(self, host, block):
+        """把域名加入前缀树，返回对应的节点；上级域名已被整体拦截时返回 None"""
+        labels = host.split('.')
+        node = self.trie
+        for label in reversed(labels[1:]):
+            child = node.get(label)
+            if child is None:
+                child = node[label] = {}
+            elif child.get(BLACKLIST_MARK) is True:
                 return None
-        
-        return value
+            node = child
+        if block:
+            # 子域名的条目与模式都已被覆盖，直接替换为共用的拦截节点
+            node[labels[0]] = BLACKLIST_BLOCKED_NODE
+            return BLACKLIST_BLOCKED_NODE
+        child = node.get(labels[0])
+        if child is None:
+            child = node[labels[0]] = {}
+        elif child.get(BLACKLIST_MARK) is True:
+            return None
+        return child
 
-    def get_login_html(self, login_failed=False, error_message=None):
-        """获取处理后的登录页HTML"""
+    def match(self, host, path):
+        """判断规范化后的域名与路径（含查询字符串）是否在黑名单中"""
+        node = self.trie
+        for label in reversed(host.split('.')):
+            node = node.get(label)
+            if node is None:
+                break
+            mark = node.get(BLACKLIST_MARK)
+            if mark is not None and (mark is True or mark(path) is not None):
+                return True
+        return self.pattern is not None and self.pattern(host + path) is not None
+
+class Blacklist:
+    """网站黑名单，从 databases/blacklist.json 加载
+
+    文件格式为 {"domains": [...], "patterns": [...]}：domains 中的域名连同其所有子域名一起拦截，
+    patterns 为 "域名/路径" 形式、可使用 * 通配符的 URL 模式（完整匹配路径与查询字符串）。
+    后台定时检查文件的修改时间，变化时编译出新的黑名单后整体替换，请求处理中的查找不加锁。
+    """
+    def __init__(self, path=BLACKLIST_FILE):
+        self.path = path
+        self.compiled = CompiledBlacklist()
+        self.signature = None
+        self.lock = Lock()
+        self.stats_lock = Lock()
+        self.stats = {'blocked': 0, 'reloads': 0, 'load_ms': 0}
+        self.reload()
+        start_timer(BLACKLIST_WATCH_INTERVAL, self._watch)
+
+    def _signature(self):
         try:
-            # 准备上下文变量
-            context = {
-                'login_failed': '1' if login_failed else '0',
-                'timestamp': str(int(time.time())),
-                'server_name': config.get('SERVER_NAME', 'SilkRoad'),
-                'error_message': error_message if error_message else '' # 添加错误消息
-            }
-            
-            return self._process_template(self.login_html, context)
-            
+            file_stat = os.stat(self.path)
+        except OSError:
+            return None
+        return file_stat.st_mtime_ns, file_stat.st_size
+
+    def _watch(self):
+        """检查黑名单文件是否变化"""
+        try:
+            if self._signature() != self.signature:
+                self.reload()
         except Exception as e:
-            # 如果格式化失败，记录错误并返回原始模板
-            logger.error(f"登录页面格式化错误: {e}")
-            # 返回一个包含错误信息的简单HTML，或者原始模板
-            # return f"<html><body>Login page error: {e}</body></html>"
-            return self.login_html # 保持返回原始模板，避免因格式化失败导致无法登录
+            logger.error(f"检查黑名单文件失败: {e}")
+        finally:
+            start_timer(BLACKLIST_WATCH_INTERVAL, self._watch)
 
-    def get_index_html(self, context=None):
-        """获取处理后的首页HTML"""
-        if context is None:
-            context = {}
-        return self._process_template(self.index_html, context)
-        
-    def get_chat_html(self, context=None):
-        """获取处理后的聊天页HTML"""
-        if context is None:
-            context = {}
-        return self._process_template(self.chat_html, context)
-    
-    def get_not_found_html(self, context=None):
-        """获取处理后的404页面HTML"""
-        if context is None:
-            context = {
-                'timestamp': str(int(time.time())),
-                'server_name': config.get('SERVER_NAME', 'SilkRoad'),
-                'requested_url': ''
-            }
-        return self._process_template(self.not_found_html, context)
+    def reload(self):
+        """重新加载黑名单文件，文件格式错误时保留当前黑名单"""
+        with self.lock:
+            self.signature = self._signature()
+            start = time.perf_counter()
+            try:
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+            except FileNotFoundError:
+                data = {}
+            except (OSError, ValueError) as e:
+                logger.error(f"加载黑名单 {self.path} 失败: {e}")
+                return
+            if isinstance(data, list):
+                domains, patterns = data, []
+            else:
+                domains, patterns = data.get('domains', []), data.get('patterns', [])
+            compiled = CompiledBlacklist(domains, patterns)
+            self.compiled = compiled
+            self.stats['reloads'] += 1
+            self.stats['load_ms'] = round((time.perf_counter() - start) * 1000, 1)
+        if compiled.domains or compiled.patterns:
+            logger.info(f"已加载黑名单: {compiled.domains} 个域名，{compiled.patterns} 个URL模式")
 
-    def render_template(self, template_name, context=None):
-        """渲染指定的模板文件"""
-        if context is None:
-            context = {}
-        
-        template_path = os.path.join(self.template_dir, "templates", template_name)
-        if not os.path.exists(template_path):
-            logger.error(f"模板文件不存在: {template_path}")
-            return f"<!-- 模板文件不存在: {template_name} -->"
-        
+    def is_blocked(self, host, path='/'):
+        """判断请求的域名（已由 host_classifier 规范化）与路径是否被拦截"""
+        if not host:
+            return False
+        if not self.compiled.match(host, path):
+            return False
+        with self.stats_lock:
+            self.stats['blocked'] += 1
+        return True
+
+    def get_stats(self):
+        compiled = self.compiled
+        return dict(self.stats, domains=compiled.domains, patterns=compiled.patterns)
+
+blacklist = Blacklist()
+# 预先渲染403页面
+template.get_forbidden_bytes()
+
+# ------------------ 子资源预取 ------------------
+# 每个页面最多预取的子资源数量，其中图片只取文档中靠前的几张（通常位于首屏）
+PREFETCH_MAX_PER_PAGE = 16
+PREFETCH_MAX_IMAGES = 4
+# 同时进行的预取总数与每个源站的并发上限
+PREFETCH_WORKERS = 4
+PREFETCH_MAX_PER_ORIGIN = 2
+# 等待预取的子资源数量上限，超出时丢弃新的预取
+PREFETCH_MAX_QUEUED = 64
+# 预取完成后在多长时间内被浏览器请求算作命中，超时未被请求计为浪费（秒）
+PREFETCH_HIT_WINDOW = 60
+# 标签不完整时最多保留的字节数，超出后放弃该标签
+PREFETCH_TAG_HOLD = 2048
+PREFETCH_TAG_RE = re.compile(rb'<(/?)(link|script|img)\b([^>]*)>', re.IGNORECASE)
+PREFETCH_ATTR_RE = re.compile(rb'([a-zA-Z-]+)\s*=\s*(?:"([^"]*)"|\'([^\']*)\'|([^\s"\'>]+))')
+# 预取响应的 Vary 只允许包含这些请求头，其余请求头（包括 Origin）的取值无法与浏览器保持一致
+PREFETCH_VARY_ALLOWED = frozenset(('accept-encoding',))
+
+class SubresourceCollector:
+    """从正在修正的 HTML 中找出关键子资源（样式表、脚本与首屏图片），发现后立即交给预取器
+
+    数据按修正前的原始内容分块传入，跨块的标签保留到下一块再解析。
+    """
+    def __init__(self, page_url, callback, limit=PREFETCH_MAX_PER_PAGE, images=PREFETCH_MAX_IMAGES):
+        self.page_url = page_url
+        self.callback = callback
+        self.remaining = limit
+        self.images = images
+        self.seen = set()
+        self.tail = b''
+        # 内联脚本中的字符串可能含有标签，不作为子资源
+        self.in_script = False
+
+    def feed(self, data):
+        if self.remaining <= 0:
+            return
+        buf = self.tail + data
+        end = 0
+        for match in PREFETCH_TAG_RE.finditer(buf):
+            end = match.end()
+            closing, tag = match.group(1), match.group(2).lower()
+            if closing or self.in_script:
+                self.in_script = self.in_script and not (closing and tag == b'script')
+                continue
+            if tag == b'script':
+                self.in_script = True
+            url = self._subresource(tag, match.group(3))
+            if url is None or url in self.seen:
+                continue
+            self.seen.add(url)
+            self.callback(url, self.page_url)
+            self.remaining -= 1
+            if self.remaining <= 0:
+                self.tail = b''
+                return
+        start = buf.rfind(b'<', end)
+        self.tail = buf[start:] if start != -1 and len(buf) - start <= PREFETCH_TAG_HOLD else b''
+
+    def _subresource(self, tag, attr_text):
+        """返回标签引用的需要预取的子资源绝对 URL，不需要预取时返回 None"""
+        attrs = {}
+        for match in PREFETCH_ATTR_RE.finditer(attr_text):
+            value = match.group(2) if match.group(2) is not None else match.group(3) if match.group(3) is not None else match.group(4)
+            attrs.setdefault(match.group(1).lower(), value)
+        if tag == b'link':
+            rel = attrs.get(b'rel', b'').lower().split()
+            if b'stylesheet' not in rel and not (b'preload' in rel and attrs.get(b'as', b'').lower() in (b'style', b'script')):
+                return None
+            value = attrs.get(b'href')
+        elif tag == b'script':
+            value = attrs.get(b'src')
+        else:
+            # 延迟加载的图片不在首屏
+            if self.images <= 0 or attrs.get(b'loading', b'').lower() == b'lazy':
+                return None
+            value = attrs.get(b'src')
+        if not value:
+            return None
         try:
-            with open(template_path, encoding=self.encoding) as f:
-                template_content = f.read()
-            return self._process_template(template_content, context)
+            url = parse.urljoin(self.page_url, html.unescape(value.decode('utf-8').strip()))
+        except (UnicodeDecodeError, ValueError):
+            return None
+        if not url.startswith(('http://', 'https://')):
+            return None
+        if tag == b'img':
+            self.images -= 1
+        return url.split('#', 1)[0]
+
+class SubresourcePrefetcher:
+    """把页面引用的关键子资源在后台预先取回并写入 CacheManager
+
+    浏览器解析页面后请求这些资源时直接命中缓存；仍在预取中的资源与浏览器的请求通过 single_flight 合并。
+    预取任务按源站排队，同时进行的预取不超过 PREFETCH_WORKERS 个、每个源站不超过 PREFETCH_MAX_PER_ORIGIN 个。
+    只保存无需 Cookie 即可共享的可缓存响应。预取完成后 PREFETCH_HIT_WINDOW 秒内被浏览器使用计为命中，
+    否则计为浪费，用于评估与调整预取策略。
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled and cache_manager.cache_enabled
+        # 源站 -> 等待预取的 (URL, 页面 URL) 队列
+        self.queues = {}
+        self.queued_keys = set()
+        # 源站 -> 正在预取的数量
+        self.active = {}
+        # 正在预取的缓存键 -> 是否已有浏览器请求合并使用
+        self.running = {}
+        # 已预取但尚未被使用的缓存键 -> (完成时间, 大小)
+        self.fetched = collections.OrderedDict()
+        self.lock = Lock()
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=PREFETCH_WORKERS,
+                                                              thread_name_prefix="SilkRoad-Prefetch")
+        self.stats = {'submitted': 0, 'prefetched': 0, 'prefetched_bytes': 0, 'hits': 0, 'wasted': 0,
+                      'wasted_bytes': 0, 'already_cached': 0, 'already_requested': 0, 'uncacheable': 0, 'failed': 0, 'dropped': 0}
+
+    def collector(self, page_url):
+        """为正在修正的页面创建子资源收集器，未启用预取时返回 None"""
+        if not self.enabled:
+            return None
+        return SubresourceCollector(page_url, self.submit)
+
+    def submit(self, url, referer):
+        """把子资源加入所在源站的预取队列"""
+        parts = parse.urlsplit(url)
+        info = host_classifier.classify(parts.hostname)
+        if not (info.is_domain or info.is_ip):
+            return
+        if blacklist.is_blocked(info.host, (parts.path or '/') + ('?' + parts.query if parts.query else '')):
+            return
+        key = cache_manager.cache_key(url)
+        origin = (parts.scheme, parts.netloc.lower())
+        with self.lock:
+            if key in self.queued_keys or key in self.running or key in self.fetched:
+                return
+            if len(self.queued_keys) >= PREFETCH_MAX_QUEUED:
+                self.stats['dropped'] += 1
+                return
+            self.queues.setdefault(origin, collections.deque()).append((url, referer))
+            self.queued_keys.add(key)
+            self.stats['submitted'] += 1
+            self._dispatch_locked()
+
+    def _dispatch_locked(self):
+        """在总数与每个源站的并发上限内开始排队的预取"""
+        for origin in list(self.queues):
+            pending = self.queues[origin]
+            while pending and self.active.get(origin, 0) < PREFETCH_MAX_PER_ORIGIN:
+                if sum(self.active.values()) >= PREFETCH_WORKERS:
+                    return
+                url, referer = pending.popleft()
+                self.active[origin] = self.active.get(origin, 0) + 1
+                self.executor.submit(self._run, origin, url, referer)
+            if not pending:
+                del self.queues[origin]
+
+    def _run(self, origin, url, referer):
+        key = cache_manager.cache_key(url)
+        try:
+            self._prefetch(key, url, referer)
         except Exception as e:
-            logger.error(f"渲染模板 {template_name} 失败: {e}")
-            return f"<!-- 渲染模板失败: {template_name}, 错误: {e} -->"
-    
-    def get_static_file(self, filename):
-        """获取静态文件内容"""
-        file_path = os.path.join(self.static_dir, filename)
-        if not os.path.exists(file_path):
-            return None, None
-        
-        # 根据文件扩展名确定内容类型
-        content_type = self._get_content_type(filename)
-        
+            self._count('failed')
+            logger.debug(f"预取失败 {url}: {e}")
+        finally:
+            with self.lock:
+                self.queued_keys.discard(key)
+                self.active[origin] -= 1
+                if not self.active[origin]:
+                    del self.active[origin]
+                self._dispatch_locked()
+
+    def _prefetch(self, key, url, referer):
+        if cache_manager.has_fresh_entry(url):
+            self._count('already_cached')
+            return
+        buffer_limit = None if cache_manager.cache_large_files else 1024 * 1024
+        fetch, leader = single_flight.join(key, buffer_limit)
+        if not leader:
+            # 浏览器已经在请求该资源
+            fetch.leave()
+            self._count('already_requested')
+            return
+        with self.lock:
+            self.running[key] = False
+        # 与浏览器加载普通子资源时一样不带 Origin，响应按 Origin 区分变体的资源不预取（见 _cache_meta）
+        headers = httpx.Headers({
+            'User-Agent': random.choice(USER_AGENTS) if config.get("RANDOM_UA_ENABLED", True) else 'Mozilla/5.0',
+            'Accept': '*/*',
+            'Accept-Encoding': ', '.join(UPSTREAM_ENCODINGS),
+            'Referer': referer,
+        })
+        error = None
+        size = None
         try:
-            with open(file_path, 'rb') as f:
-                content = f.read()
-            return content, content_type
+            with http_client_pool.stream('GET', url, headers=headers) as r:
+                meta = self._cache_meta(r, headers, buffer_limit)
+                r = fetch.publish(r, meta is not None)
+                if meta is None:
+                    return
+                cache_writer = cache_manager.open_cache_writer(url, r.headers.get('Content-Type'), r.headers, meta)
+                received = 0
+                for chunk in r.iter_raw():
+                    received += len(chunk)
+                    if cache_writer is not None:
+                        cache_writer.write(chunk)
+                if cache_writer is not None and cache_writer.commit():
+                    size = received
         except Exception as e:
-            logger.error(f"读取静态文件失败 {filename}: {e}")
-            return None, None
-    
-    def _get_content_type(self, filename):
-        """根据文件扩展名确定内容类型"""
-        ext = os.path.splitext(filename)[1].lower()
-        content_types = {
-            '.css': 'text/css',
-            '.js': 'application/javascript',
-            '.jpg': 'image/jpeg',
-            '.jpeg': 'image/jpeg',
-            '.png': 'image/png',
-            '.gif': 'image/gif',
-            '.svg': 'image/svg+xml',
-            '.ico': 'image/x-icon',
-            '.woff': 'font/woff',
-            '.woff2': 'font/woff2',
-            '.ttf': 'font/ttf',
-            '.eot': 'application/vnd.ms-fontobject',
-            '.otf': 'font/otf',
-            '.json': 'application/json',
-            '.xml': 'application/xml',
-            '.pdf': 'application/pdf',
-            '.txt': 'text/plain',
-        }
-        return content_types.get(ext, 'application/octet-stream')
+            error = e
+            raise
+        finally:
+            single_flight.release(fetch, error)
+            with self.lock:
+                used = self.running.pop(key, False)
+                if size is not None:
+                    self.stats['prefetched'] += 1
+                    self.stats['prefetched_bytes'] += size
+                    # 预取期间已被浏览器合并使用的资源直接计为命中
+                    if not used:
+                        self.fetched[key] = (time.monotonic(), size)
+                        self._sweep_locked()
+        if size is None and error is None:
+            self._count('uncacheable')
 
-template = Template()
+    @staticmethod
+    def _cache_meta(r, headers, buffer_limit):
+        """预取的响应可以被浏览器的请求使用时返回缓存元数据，否则返回 None"""
+        content_type = r.headers.get('Content-Type', '')
+        # HTML 在缓存中保存的是修正后的内容，不由预取写入
+        if r.status_code != 200 or 'set-cookie' in r.headers or 'text/html' in content_type:
+            return None
+        if not cache_manager.is_type_cacheable(content_type):
+            return None
+        content_length = r.headers.get('Content-Length', '')
+        if buffer_limit is not None and content_length.isdigit() and int(content_length) > buffer_limit:
+            return None
+        vary = {name.strip().lower() for name in r.headers.get('Vary', '').split(',') if name.strip()}
+        if not vary <= PREFETCH_VARY_ALLOWED:
+            return None
+        meta = cache_manager.cache_meta(r.headers, headers)
+        # 立即过期的响应浏览器仍需向源站确认，预取没有意义
+        if meta is None or meta['expires_at'] <= meta['stored_at']:
+            return None
+        return meta
 
-# ------------------ 浏览器信息伪装 ------------------
-USER_AGENTS = [
-    "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36",
-    "Mozilla/5.0 (Macintosh; Intel Mac OS X 13_4) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/16.5 Safari/605.1.15",
-    "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36"
-]
+    def record_use(self, url):
+        """浏览器的请求命中了缓存或合并到进行中的请求，属于预取结果时计为命中"""
+        if not (self.fetched or self.running):
+            return
+        key = cache_manager.cache_key(url)
+        with self.lock:
+            if key in self.running:
+                if not self.running[key]:
+                    self.running[key] = True
+                    self.stats['hits'] += 1
+            elif self.fetched.pop(key, None) is not None:
+                self.stats['hits'] += 1
+
+    def _sweep_locked(self):
+        """超过命中时间窗口仍未被使用的预取计为浪费"""
+        cutoff = time.monotonic() - PREFETCH_HIT_WINDOW
+        while self.fetched:
+            key, (fetched_at, size) = next(iter(self.fetched.items()))
+            if fetched_at > cutoff:
+                break
+            del self.fetched[key]
+            self.stats['wasted'] += 1
+            self.stats['wasted_bytes'] += size
+
+    def _count(self, name):
+        with self.lock:
+            self.stats[name] += 1
+
+    def get_stats(self):
+        with self.lock:
+            self._sweep_locked()
+            stats = dict(self.stats, enabled=self.enabled, queued=len(self.queued_keys) - len(self.running),
+                         running=len(self.running), awaiting_use=len(self.fetched))
+        decided = stats['hits'] + stats['wasted']
+        stats['hit_rate'] = round(stats['hits'] / decided, 4) if decided else None
+        stats['waste_rate'] = round(stats['wasted'] / decided, 4) if decided else None
+        return stats
+
+subresource_prefetcher = SubresourcePrefetcher(config.get('PREFETCH_ENABLED', False))
+
+# 客户端主动断开连接时出现的异常
+CLIENT_DISCONNECT_ERRORS = (BrokenPipeError, ConnectionAbortedError, ConnectionResetError)
+
+class ResponseRelay:
+    """响应体转发器：对上游数据块做链接修正，同时写入缓存并发送给客户端
+
+    同步与异步服务器引擎共用同一个转发器，只是驱动数据块的循环不同。
+    """
+    def __init__(self, proxy, chunk_size, rewriter=None, cache_writer=None, range_writer=None, flush_each=False,
+                 raw=False, compressor=None):
+        self.proxy = proxy
+        self.chunk_size = chunk_size
+        # raw 为 True 时按上游原始字节（可能是压缩数据）转发，不解码
+        self.raw = raw
+        # 发送给浏览器前的流式压缩器，缓存中保存的仍是未压缩内容
+        self.compressor = compressor
+        self.rewriter = rewriter
+        self.cache_writer = cache_writer
+        self.range_writer = range_writer
+        self.flush_each = flush_each
+
+    @property
+    def passthrough(self):
+        """响应体是否原样发送（不修正、不压缩、不写缓存）"""
+        return (self.rewriter is None and self.compressor is None and self.cache_writer is None
+                and self.range_writer is None)
+
+    @property
+    def writes_cache(self):
+        """是否同时写入缓存文件（异步引擎据此把 feed/finish 放到线程池中执行）"""
+        return self.cache_writer is not None or self.range_writer is not None
+
+    def feed(self, chunk):
+        """处理并转发一块上游数据"""
+        # 区间缓存按原始偏移保存上游数据
+        if self.range_writer is not None:
+            self.range_writer.write(chunk)
+        output = self.rewriter.feed(chunk) if self.rewriter is not None else chunk
+        self._emit(output)
+
+    def finish(self):
+        """响应体接收完毕：发送剩余数据并提交缓存"""
+        if self.rewriter is not None:
+            self._emit(self.rewriter.flush())
+        if self.compressor is not None:
+            self._write(self.compressor.finish())
+        self.proxy.finish_body()
+        if self.cache_writer is not None:
+            self.cache_writer.commit()
+        # 即使客户端中途断开，已写入的区间也会被保留（见 abort）
+        if self.range_writer is not None:
+            self.range_writer.close()
+
+    def abort(self):
+        """转发中断：丢弃未完成的缓存，保留已写入的区间"""
+        if self.cache_writer is not None:
+            self.cache_writer.abort()
+        if self.range_writer is not None:
+            self.range_writer.close()
+
+    def _emit(self, output):
+        if not output:
+            return
+        if self.cache_writer is not None:
+            self.cache_writer.write(output)
+        if self.compressor is not None:
+            output = self.compressor.compress(output)
+        self._write(output)
+
+    def _write(self, output):
+        if not output:
+            return
+        self.proxy.write_body_chunk(output)
+        if self.flush_each:
+            self.proxy.handler.wfile.flush()
+
+# Set-Cookie 中的 Domain 属性
+COOKIE_DOMAIN_RE = re.compile(r'(?:^|;)\s*domain=([^;]*)', re.IGNORECASE)
 
-# ------------------ 代理处理 ------------------
 class Proxy(object):
     def __init__(self, handler):
         self.handler = handler
@@ -937,94 +4727,311 @@ class Proxy(object):
         # 设置重试次数和超时时间
         self.max_retries = 3
         self.timeout = 30.0
+        # 响应头是否已发出（已发出后无法再重试或返回错误页面）以及是否使用分块传输
+        self.response_started = False
+        self.chunked = False
+        self.request_data = None
+        # 请求合并：领头请求持有进行中的上游请求，跟随请求只读取共享的响应体
+        self.inflight = None
+        self.coalesced = False
+        # 已过新鲜期、正在向上游重新验证的缓存条目
+        self.stale_entry = None
+        # 目标主机的分类结果（规范化域名与所属站点）
+        self.host_info = host_classifier.classify(parse_result.hostname)
+        # 黑名单中的网站在连接上游之前直接拒绝
+        target = (parse_result.path or '/') + ('?' + parse_result.query if parse_result.query else '')
+        self.blocked = blacklist.is_blocked(self.host_info.host, target)
 
     def proxy(self):
+        if self.blocked:
+            self.process_forbidden()
+            return
         # 判断是否为 WebSocket 请求，若是则调用占位处理
         if self.handler.headers.get('Upgrade', '').lower() == 'websocket':
             self.process_websocket()
             return
 
-        self.process_request()
-        content_length = int(self.handler.headers.get('Content-Length', 0))
-        data = self.handler.rfile.read(content_length) if content_length > 0 else None
-        # 只对GET请求尝试使用缓存，且缓存必须启用
-        if self.handler.command == 'GET' and cache_manager.cache_enabled:
-            # 尝试从缓存获取响应
-            cached_content, cached_headers = cache_manager.get_from_cache(self.url)
-            if cached_content is not None:
-                logger.info(f"使用缓存响应: {self.url}")
-                # 模拟一个响应对象
-                class CachedResponse:
-                    def __init__(self, content, headers):
-                        self.content = content
-                        self.headers = headers or {}
-                        self.status_code = 200
-                        self.encoding = 'utf-8'
-                    
-                    def iter_bytes(self, chunk_size):
-                        """模拟iter_bytes方法，用于分块传输"""
-                        remaining = self.content
-                        while remaining:
-                            chunk, remaining = remaining[:chunk_size], remaining[chunk_size:]
-                            yield chunk
-                
-                # 使用缓存的内容处理响应
-                self.process_response(CachedResponse(cached_content, cached_headers))
-                return
-        # 添加重试逻辑
-        retry_count = 0
-        # 从连接池获取客户端
-        client = http_client_pool.get_client()
+        data = self.prepare_request()
+        if self.serve_from_cache():
+            return
+        # 相同缓存键的并发请求只发起一次上游请求
+        fetch, leader = self.join_inflight()
+        if fetch is not None and not leader:
+            if fetch.wait_head(self.timeout) and fetch.shareable_with(self.handler.headers.get('Cookie')):
+                self.serve_coalesced(fetch)
+                return
+            # 领头请求的响应不可共享（或可能属于其他用户），自行请求上游
+            fetch.leave()
+            single_flight.count('declined')
+        error = None
+        try:
+            # 添加重试逻辑
+            retry_count = 0
+            while retry_count < self.max_retries:
+                headers = self.build_upstream_headers()
+                try:
+                    # 通过共享连接池以流式方式发送请求，响应体边接收边转发，不在内存中完整缓冲
+                    with http_client_pool.stream(self.handler.command, self.url, headers=headers, content=data) as r:
+                        self.process_response(r)
+                    error = None
+                    break
+                except Exception as e:
+                    error = e
+                    if not self.handle_upstream_error(e, retry_count, headers):
+                        break
+                    retry_count += 1
+                    time.sleep(1)  # 短暂延迟后重试
+        finally:
+            if self.inflight is not None:
+                # 领头请求的客户端断开时响应体已读完，跟随请求不受影响
+                single_flight.release(self.inflight, None if isinstance(error, CLIENT_DISCONNECT_ERRORS) else error)
+
+    def process_forbidden(self):
+        """返回预先渲染的403页面"""
+        # 读取并丢弃请求体，连接可以继续复用
+        self.prepare_request()
+        self.handler.return_html(template.get_forbidden_bytes(), HTTPStatus.FORBIDDEN,
+                                 template.variant_key('forbidden', Template.FORBIDDEN_CONTEXT))
+        logger.info(f"黑名单拦截: {self.url}")
+
+    def join_inflight(self):
+        """可合并的请求加入进行中的上游请求，返回 (InflightFetch, 是否为领头请求)"""
+        if not (self.handler.command == 'GET' and cache_manager.cache_enabled and not self.request_data
+                and 'Range' not in self.handler.headers and 'Authorization' not in self.handler.headers):
+            return None, False
+        buffer_limit = None if cache_manager.cache_large_files else 1024 * 1024
+        fetch, leader = single_flight.join(cache_manager.cache_key(self.url), buffer_limit,
+                                           self.handler.headers.get('Cookie'))
+        if leader:
+            self.inflight = fetch
+        return fetch, leader
+
+    def is_shareable(self, r):
+        """判断上游响应能否与并发的相同请求共享（条件与写入缓存一致）"""
+        if r.status_code != 200 or 'set-cookie' in r.headers:
+            return False
+        if cache_lifetime(r.headers, cache_manager.max_cache_age) is None:
+            return False
+        if not cache_manager.is_type_cacheable(r.headers.get('Content-Type')) or self.is_event_stream(r):
+            return False
+        content_length = r.headers.get('Content-Length', '')
+        limit = self.inflight.buffer_limit
+        return not (limit is not None and content_length.isdigit() and int(content_length) > limit)
+
+    def share_response(self, r):
+        """领头请求收到响应头时发布给跟随者，可共享时返回写入共享缓冲区的响应"""
+        if self.inflight is None or self.inflight.shareable is not None or isinstance(r, CachedResponse):
+            return r
+        return self.inflight.publish(r, self.is_shareable(r))
+
+    def serve_coalesced(self, fetch):
+        """跟随请求：从领头请求的共享响应体转发"""
+        self.coalesced = True
+        single_flight.count('coalesced')
+        subresource_prefetcher.record_use(self.url)
+        logger.debug(f"合并请求: {self.url}")
+        r = fetch.follower_response()
+        try:
+            self.process_response(r)
+        except Exception as error:
+            self.handle_upstream_error(error, self.max_retries - 1, None)
+        finally:
+            r.close()
+
+    def prepare_request(self):
+        """修正请求头并读取请求体"""
+        self.process_request()
+        content_length = int(self.handler.headers.get('Content-Length', 0))
+        data = self.handler.rfile.read(content_length) if content_length > 0 else None
+        self.request_data = data
+        return data
+
+    def build_upstream_headers(self):
+        """复制所有请求头，并随机设置 User-Agent 以伪装客户端信息"""
+        headers = {}
+        for k, v in self.handler.headers.items():
+            if k.lower() not in self.invalid_headers:
+               headers[k] = v
+        if config.get("RANDOM_UA_ENABLED", True):
+            headers['User-Agent'] = random.choice(USER_AGENTS)
+        if self.stale_entry is not None:
+            # 重新验证过期的缓存条目时，用缓存条目的验证器替换客户端自带的条件请求头
+            for name in [k for k in headers if k.lower() in ('if-none-match', 'if-modified-since')]:
+                del headers[name]
+            if self.stale_entry.etag:
+                headers['If-None-Match'] = self.stale_entry.etag
+            if self.stale_entry.last_modified:
+                headers['If-Modified-Since'] = self.stale_entry.last_modified
+        return headers
+
+    def serve_from_cache(self):
+        """尝试直接从本地缓存返回响应，已返回时为 True"""
+        range_header = self.handler.headers.get('Range')
+        try:
+            if self.handler.command == 'GET' and range_header:
+                # 区间请求（视频拖动等）优先从稀疏区间缓存中返回
+                hit = range_cache.lookup(self.url, range_header, self.handler.headers.get('If-Range'))
+                if hit is not None:
+                    logger.debug(f"区间缓存命中: {self.url} {range_header}")
+                    if self.process_range_hit(*hit):
+                        return True
+            # 只对GET请求尝试使用缓存，且缓存必须启用（完整响应缓存不用于区间请求）
+            elif self.handler.command == 'GET' and cache_manager.cache_enabled:
+                # 尝试从缓存获取响应
+                entry = cache_manager.get_entry(self.url, request_headers=self.handler.headers)
+                if entry is None:
+                    return False
+                # 浏览器强制刷新（Cache-Control/Pragma: no-cache）时总是向上游确认
+                forced = ('no-cache' in parse_cache_control(self.handler.headers.get('Cache-Control'))
+                          or 'no-cache' in self.handler.headers.get('Pragma', ''))
+                if entry.is_fresh() and not forced:
+                    subresource_prefetcher.record_use(self.url)
+                    return self.serve_cache_entry(entry)
+                if entry.etag or entry.last_modified:
+                    # 已过新鲜期：带上验证器向上游确认，304 时刷新新鲜期并直接使用缓存
+                    self.stale_entry = entry
+        except CLIENT_DISCONNECT_ERRORS as client_error:
+            logger.debug(f"客户端已断开连接: {self.url} ({client_error})")
+            self.handler.close_connection = True
+            return True
+        return False
+
+    def serve_cache_entry(self, entry):
+        """从缓存条目返回响应，客户端缓存的版本仍然有效时返回 304，已返回时为 True"""
+        if is_not_modified(self.handler.headers, entry.etag, entry.last_modified):
+            cache_manager.count('client_not_modified')
+            self.send_not_modified(entry)
+            return True
+        content, headers = self.decode_cached(entry)
+        if headers is None:
+            return False
+        headers['age'] = str(entry.age())
+        logger.info(f"使用缓存响应: {self.url}")
+        # 使用缓存的内容处理响应
+        self.process_response(CachedResponse(content, headers, entry))
+        return True
+
+    def send_cached_body(self, r):
+        """发送缓存响应的响应体：内存中的内容一次写出，磁盘上的内容用 sendfile 发送"""
+        if r.content is not None:
+            self.handler.wfile.write(r.content)
+            return
+        try:
+            f = r.entry.open_body()
+        except (OSError, ValueError) as e:
+            # 响应头已经发出，只能关闭连接
+            self.abort_response(e)
+            return
+        with f:
+            self.write_body_file(f, r.entry.body_offset, r.entry.body_length)
+
+    def send_not_modified(self, entry):
+        """浏览器缓存的版本仍然有效，只返回 304 与缓存相关响应头"""
+        headers = httpx.Headers(entry.headers)
+        headers['Age'] = str(entry.age())
+        content_type = headers.get('Content-Type', '')
+        # 经过修改或可能被重新压缩的内容只提供弱验证器，与完整响应保持一致
+        weak = 'text/html' in content_type or (is_compressible(content_type) and 'Content-Encoding' not in headers)
+        self.handler.send_response(HTTPStatus.NOT_MODIFIED)
+        self.response_started = True
+        for name, value in self.client_cache_headers(headers, weak).items():
+            self.handler.send_header(name, value)
+        client_conn = self.handler.headers.get('Connection', '').lower()
+        self.handler.send_header('Connection', 'keep-alive' if client_conn == 'keep-alive' else 'close')
+        self.handler.end_headers()
+
+    def client_cache_headers(self, headers, weak=False):
+        """提取转发给浏览器的缓存控制与验证器响应头
+
+        源站给出缓存策略时按其策略允许浏览器缓存，不再统一附加禁止缓存的响应头。
+        """
+        result = {name: headers[name] for name in CLIENT_CACHE_HEADERS if name in headers}
+        if weak and 'ETag' in result:
+            result['ETag'] = weak_etag(result['ETag'])
+        if 'Vary' in headers:
+            result['Vary'] = headers['Vary']
+        if 'Cache-Control' in headers or 'Expires' in headers:
+            self.handler.clear_client_cache = False
+        return result
+
+    def revalidated(self, r):
+        """上游确认过期的缓存条目仍然有效（304）时刷新条目并从缓存返回，已返回时为 True"""
+        entry = self.stale_entry
+        if entry is None or r.status_code != 304:
+            return False
+        self.stale_entry = None
+        if self.inflight is not None:
+            # 并发的相同请求无法共享 304 响应，让它们自行处理
+            self.inflight.publish(r, False)
+        cache_manager.count('revalidations')
+        if not cache_manager.refresh_entry(entry, r.headers, self.handler.headers):
+            # 新的响应头不再允许缓存，本次仍可使用已确认有效的内容
+            cache_manager.clear_cache(self.url, entry.headers.get('content-type'))
+        logger.debug(f"缓存重新验证成功: {self.url}")
+        if not self.serve_cache_entry(entry):
+            self.process_error("缓存内容解码失败")
+        return True
+
+    def decode_cached(self, entry):
+        """缓存内容的编码不被客户端接受时先解码，返回 (内容, 响应头)，解码失败时响应头为 None
+
+        不需要解码时内容为 entry.content（磁盘上的大文件为 None，发送时不读入内存）。
+        """
+        headers = dict(entry.headers)
+        encoding_key = next((k for k in headers if k.lower() == 'content-encoding'), None)
+        if encoding_key is None:
+            return entry.content, headers
+        encoding = headers[encoding_key]
+        if client_accepts_encoding(self.handler.headers.get('Accept-Encoding'), encoding):
+            return entry.content, headers
         try:
-            while retry_count < self.max_retries:
-                try:
-                    # 复制所有请求头，并随机设置 User-Agent 以伪装客户端信息
-                    headers = {}
-                    for k, v in self.handler.headers.items():
-                        if k.lower() not in self.invalid_headers:
-                           headers[k] = v
-                    if config.get("RANDOM_UA_ENABLED", True):
-                        headers['User-Agent'] = random.choice(USER_AGENTS)
-                    
-                    # 使用连接池中的客户端发送请求
-                    r = client.request(method=self.handler.command, url=self.url, headers=headers, content=data)
-                    # 如果请求成功，处理响应并退出重试循环
-                    self.process_response(r)
-                    break
-                except ssl.SSLError as ssl_error:
-                    # 特别处理 SSL 错误
-                    logger.warning(f"SSL Error on attempt {retry_count+1}/{self.max_retries}: {ssl_error}")
-                    if "EOF occurred in violation of protocol" in str(ssl_error) and retry_count < self.max_retries - 1:
-                        retry_count += 1
-                        time.sleep(1)  # 短暂延迟后重试
-                        continue
-                    else:
-                        self.process_error(f"SSL Error: {ssl_error}")
-                        break
-                except httpx.TimeoutException as timeout_error:
-                    # 处理超时错误
-                    logger.warning(f"Timeout on attempt {retry_count+1}/{self.max_retries}: {timeout_error}")
-                    if retry_count < self.max_retries - 1:
-                        retry_count += 1
-                        time.sleep(1)
-                        continue
-                    else:
-                        self.process_error(f"Request timed out after {self.max_retries} attempts")
-                        break
-                except Exception as error:
-                    # 处理其他错误，添加更多上下文信息
-                    error_context = {
-                        "url": self.url,
-                        "method": self.handler.command,
-                        "headers": str(headers)[:200] + "..." if len(str(headers)) > 200 else str(headers),
-                        "retry_count": retry_count
-                    }
-                    logger.error(f"Error on attempt {retry_count+1}/{self.max_retries}: {error}, Context: {error_context}")
-                    self.process_error(f"请求错误: {error}")
-                    break
-        finally:
-            # 请求完成后，将客户端归还到连接池
-            http_client_pool.release_client(client)
+            content = decode_content(entry.read_body(), encoding)
+        except (httpx.DecodingError, OSError, ValueError) as e:
+            logger.warning(f"缓存内容解码失败 {self.url}: {e}")
+            return None, None
+        del headers[encoding_key]
+        return content, headers
+
+    def handle_upstream_error(self, error, retry_count, headers):
+        """处理一次上游请求中出现的异常，返回是否应当重试"""
+        if isinstance(error, CLIENT_DISCONNECT_ERRORS):
+            # 客户端在传输过程中主动断开（如视频拖动、关闭页面），无需重试
+            logger.debug(f"客户端已断开连接: {self.url} ({error})")
+            self.handler.close_connection = True
+            return False
+        if isinstance(error, ssl.SSLError):
+            # 特别处理 SSL 错误
+            logger.warning(f"SSL Error on attempt {retry_count+1}/{self.max_retries}: {error}")
+            if self.response_started:
+                self.abort_response(error)
+                return False
+            if "EOF occurred in violation of protocol" in str(error) and retry_count < self.max_retries - 1:
+                return True
+            self.process_error(f"SSL Error: {error}")
+            return False
+        if isinstance(error, httpx.TimeoutException):
+            # 处理超时错误
+            logger.warning(f"Timeout on attempt {retry_count+1}/{self.max_retries}: {error}")
+            if self.response_started:
+                self.abort_response(error)
+                return False
+            if retry_count < self.max_retries - 1:
+                return True
+            self.process_error(f"Request timed out after {self.max_retries} attempts")
+            return False
+        # 处理其他错误，添加更多上下文信息
+        error_context = {
+            "url": self.url,
+            "method": self.handler.command,
+            "headers": str(headers)[:200] + "..." if len(str(headers)) > 200 else str(headers),
+            "retry_count": retry_count
+        }
+        logger.error(f"Error on attempt {retry_count+1}/{self.max_retries}: {error}, Context: {error_context}")
+        if self.response_started:
+            self.abort_response(error)
+            return False
+        self.process_error(f"请求错误: {error}")
+        return False
 
     def process_websocket(self):
         # 占位处理：后续可结合 websockets 库实现双向持续连接
@@ -1042,110 +5049,229 @@ class Proxy(object):
         # 保留或添加 Accept-Language、Cache-Control 等常见头（示例，可扩展）
         if 'Accept-Language' not in self.handler.headers:
             self.handler.headers.add_header('Accept-Language', 'zh-CN,cn;q=0.9')
-        self.modify_request_header('Accept-Encoding', 'identity')
+        # 只向上游声明客户端同样接受且本地能够解码的压缩格式：
+        # 需要修正链接的 HTML 在本地解码，其余响应原样转发压缩数据
+        accepted = parse_accept_encoding(self.handler.headers.get('Accept-Encoding'))
+        encodings = [e for e in UPSTREAM_ENCODINGS if e in accepted or '*' in accepted]
+        # 客户端未发送 Accept-Encoding 时也要明确声明，否则 httpx 会使用默认的 gzip 等编码
+        if 'Accept-Encoding' in self.handler.headers:
+            self.modify_request_header('Accept-Encoding', ', '.join(encodings) or 'identity')
+        else:
+            self.handler.headers.add_header('Accept-Encoding', ', '.join(encodings) or 'identity')
         self.modify_request_header('Connection', conn_value)
         # 如果存在 Range 请求头，保持不变（用于断点续传）
 
     def process_response(self, r):
+        if self.revalidated(r):
+            return
+        r = self.share_response(r)
+        relay = None
+        try:
+            relay = self.start_response(r)
+            if relay is None:
+                return
+            if isinstance(r, CachedResponse) and relay.passthrough:
+                # 缓存命中且不需要重新压缩时，响应体直接从内存或缓存文件发送
+                self.send_cached_body(r)
+            else:
+                chunks = r.iter_raw(relay.chunk_size) if relay.raw else r.iter_bytes(relay.chunk_size)
+                for chunk in chunks:
+                    relay.feed(chunk)
+            relay.finish()
+        except BaseException as error:
+            if relay is not None:
+                relay.abort()
+            # 领头请求的客户端断开时，仍需读完上游响应供跟随请求使用
+            if isinstance(error, CLIENT_DISCONNECT_ERRORS) and isinstance(r.stream, InflightStream):
+                r.stream.drain()
+            raise
+
+    def start_response(self, r):
+        """发送响应头并返回处理响应体的转发器，响应没有响应体时返回 None"""
         # 获取内容类型和URL
         content_type = r.headers.get('Content-Type', '')
         url = self.url
+        is_html = "text/html" in content_type
+        from_cache = isinstance(r, CachedResponse)
         
-        # 检查是否可缓存
-        cacheable = r.status_code == 200 and self.handler.command == 'GET' and cache_manager.cache_enabled
+        # 检查是否可缓存（来自缓存的响应无需再次写入）
+        cacheable = (r.status_code == 200 and self.handler.command == 'GET' and cache_manager.cache_enabled
+                     and not from_cache and not self.coalesced)
+        # 按源站的缓存语义（Cache-Control、Expires、Vary 等）决定是否存储以及新鲜期
+        cache_meta = cache_manager.cache_meta(r.headers, self.handler.headers) if cacheable else None
+        cacheable = cache_meta is not None
         
-        # 如果响应为 HTML，则进行链接修正处理
-        if "text/html" in content_type:
-            # 尝试使用UTF-8编码处理文本内容
-            content = self.revision_link(r.content, 'utf-8')
+        # HEAD 请求以及 204/304 响应没有响应体
+        has_body = self.handler.command != 'HEAD' and r.status_code not in (204, 304) and r.status_code >= 200
+        
+        # 事件流（SSE、大模型流式输出等）逐事件立即转发，不缓冲也不缓存
+        if has_body and self.is_event_stream(r):
+            # 关闭 Nagle 算法，避免小的事件包在内核中等待合并
             try:
-                # 尝试使用原始编码解码，然后转为UTF-8
-                content = content.decode(r.encoding or 'utf-8').encode('utf-8')
-                content_type = "text/html; charset=utf-8"
-            except UnicodeDecodeError:
-                # 如果UTF-8解码失败，回退到ASCII编码（忽略错误）
-                logger.warning(f"无法使用UTF-8解码内容，回退到ASCII编码: {self.url}")
-                content = content.decode('ascii', errors='ignore').encode('ascii')
-                content_type = "text/html; charset=ascii"
-            content_length = len(content)
-        else:
-            # 对于非 HTML 大文件或流媒体，采用流式传输，不做链接修改
-            content = r.content if r.content is not None else b''
-            content_length = len(content)
+                self.handler.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except (OSError, AttributeError):
+                pass
+            # 客户端缓存已由全局的 no-store 响应头禁止，这里只需关闭中间代理的缓冲
+            self.send_response_head(r, content_type, None, extra_headers={'X-Accel-Buffering': 'no'})
+            # 不指定块大小，httpx 收到多少数据就立即产出多少
+            return ResponseRelay(self, chunk_size=None, flush_each=True)
+        
+        chunk_size = PERFORMANCE_CONFIG['STREAM_CHUNK_SIZE']
+        # 如果响应为 HTML，则边接收边进行链接修正（缓存中的 HTML 已经修正过，直接转发）
+        if is_html and not from_cache:
+            content_type = "text/html; charset=utf-8"
+            # 修正后的长度无法预知，统一使用分块传输，客户端支持时边修正边压缩
+            encoding = negotiate_encoding(self.handler.headers.get('Accept-Encoding')) if has_body else None
+            # 修正后的内容与源站不同，只转发弱验证器
+            extra_headers = self.client_cache_headers(r.headers, weak=True)
+            add_compression_headers(extra_headers, encoding)
+            self.send_response_head(r, content_type, None if has_body else 0, extra_headers=extra_headers)
+            if not has_body:
+                return None
+            rewriter = StreamingLinkRewriter(self.rewrite_engine(), r.encoding or 'utf-8', self.origin_collector(),
+                                             subresource_prefetcher.collector(url))
+            cache_writer = None
+            if cacheable:
+                # 缓存的是修正后的 UTF-8 内容，响应头需要与之保持一致
+                cache_headers = dict(r.headers)
+                cache_headers['content-type'] = content_type
+                cache_headers.pop('content-encoding', None)
+                cache_writer = cache_manager.open_cache_writer(url, content_type, cache_headers, cache_meta)
+            return ResponseRelay(self, chunk_size, rewriter=rewriter, cache_writer=cache_writer,
+                                 compressor=StreamCompressor(encoding) if encoding else None)
+        
+        # 对于非 HTML 内容（图片、视频分片、字体等），边接收边转发，不做链接修改
+        # 压缩过的响应体不解码，连同原始 Content-Encoding 与 Content-Length 一起原样转发
+        content_length = None
+        if r.headers.get('Content-Length', '').isdigit():
+            content_length = int(r.headers['Content-Length'])
+        # 转发区间请求相关的响应头，使浏览器可以拖动进度条并使用 If-Range
+        extra_headers = {name: r.headers[name] for name in RANGE_PASSTHROUGH_HEADERS if name in r.headers}
+        content_encoding = r.headers.get('Content-Encoding')
+        # 上游未压缩的完整文本响应（包括缓存中已修正的 HTML）在转发时压缩
+        encoding = None
+        if (has_body and not content_encoding and r.status_code == 200 and is_compressible(content_type)
+                and (content_length is None or content_length >= COMPRESSION_MIN_SIZE)):
+            encoding = negotiate_encoding(self.handler.headers.get('Accept-Encoding'))
+            if encoding:
+                content_length = None
+        # 重新压缩过的内容只转发弱验证器
+        extra_headers.update(self.client_cache_headers(r.headers, weak=bool(encoding) or from_cache and is_html))
+        if content_encoding:
+            extra_headers['Content-Encoding'] = content_encoding
+            add_vary(extra_headers, 'Accept-Encoding')
+        add_compression_headers(extra_headers, encoding)
+        self.send_response_head(r, content_type, content_length if has_body or content_length is not None else 0,
+                                extra_headers=extra_headers)
+        if not has_body:
+            return None
+        
+        # 可缓存的响应在转发的同时写入缓存文件
+        cache_writer = cache_manager.open_cache_writer(url, content_type, r.headers, cache_meta) if cacheable else None
+        # 区间响应和音视频响应同时写入稀疏区间缓存，供后续拖动时直接使用
+        range_writer = None
+        if (self.handler.command == 'GET' and not from_cache and not self.coalesced
+                and (r.status_code == 206 or "video/" in content_type or "audio/" in content_type)):
+            range_writer = range_cache.open_writer(url, r, self.handler.headers)
+        return ResponseRelay(self, chunk_size, cache_writer=cache_writer, range_writer=range_writer, raw=True,
+                             compressor=StreamCompressor(encoding) if encoding else None)
+
+
+    def process_range_hit(self, entry, start, end):
+        """从稀疏区间缓存返回 206 Partial Content 响应，缓存文件已被替换为新版本时返回 False"""
+        length = end - start + 1
+        try:
+            f = open(entry.data_path, 'rb')
+        except FileNotFoundError:
+            return False
+        self.handler.send_response(HTTPStatus.PARTIAL_CONTENT)
+        self.response_started = True
+        if entry.content_type:
+            self.handler.send_header('Content-Type', entry.content_type)
+        self.handler.send_header('Content-Range', f'bytes {start}-{end}/{entry.total_length}')
+        self.handler.send_header('Content-Length', length)
+        self.handler.send_header('Accept-Ranges', 'bytes')
+        if entry.etag:
+            self.handler.send_header('ETag', entry.etag)
+        if entry.last_modified:
+            self.handler.send_header('Last-Modified', entry.last_modified)
+        client_conn = self.handler.headers.get('Connection', '').lower()
+        self.handler.send_header('Connection', 'keep-alive' if client_conn == 'keep-alive' else 'close')
+        self.handler.send_header('Access-Control-Allow-Origin', '*')
+        self.handler.end_headers()
+        
+        with f:
+            self.write_body_file(f, start, length)
+        return True
+
+    def is_event_stream(self, r):
+        """判断响应是否为需要实时转发的流式响应"""
+        if isinstance(r, CachedResponse):
+            return False
+        content_type = r.headers.get('Content-Type', '').lower()
+        if any(t in content_type for t in STREAMING_CONTENT_TYPES):
+            return True
+        # 请求体中带有 "stream": true 的 JSON 接口（如 chat/completions）按流式处理
+        if self.request_data and b'"stream"' in self.request_data and "text/html" not in content_type:
+            try:
+                payload = json.loads(self.request_data)
+            except (ValueError, UnicodeDecodeError):
+                return False
+            return isinstance(payload, dict) and payload.get('stream') is True
+        return False
 
-        # 发送响应头
+    def send_response_head(self, r, content_type, content_length=None, extra_headers=None):
+        """发送响应状态行与响应头，content_length 为 None 时使用分块传输编码"""
         self.handler.send_response(r.status_code)
+        self.response_started = True
         # 转发 Content-Range 等头，支持断点续传
         if "Content-Range" in r.headers:
             self.handler.send_header("Content-Range", r.headers["Content-Range"])
         if "location" in r.headers:
             self.handler.send_header('Location', self.revision_location(r.headers['location']))
-        if "content-type" in r.headers:
-            self.handler.send_header('Content-Type', r.headers['content-type'])
+        if content_type:
+            self.handler.send_header('Content-Type', content_type)
         if "set-cookie" in r.headers:
             self.revision_set_cookie(r.headers['set-cookie'])
-        # 如果为 HTML，则使用修正后的内容长度，否则转发原始 Content-Length（如果有）
-        self.handler.send_header('Content-Length', content_length)
+        if content_length is None:
+            self.chunked = True
+            self.handler.send_header('Transfer-Encoding', 'chunked')
+        else:
+            self.handler.send_header('Content-Length', content_length)
         # 根据客户端请求决定连接是否保持
         client_conn = self.handler.headers.get('Connection', '').lower()
-        conn_value = 'keep-alive' if client_conn.lower() == 'keep-alive' else 'close'
+        conn_value = 'keep-alive' if client_conn == 'keep-alive' else 'close'
         self.handler.send_header('Connection', conn_value)
         self.handler.send_header('Access-Control-Allow-Origin', '*')
-        
-        # 判断是否为大文件（例如超过 1MB）或非 HTML 内容
-        is_large_file = int(r.headers.get('Content-Length', 0)) > 1024 * 1024
-        is_html = "text/html" in content_type
-        
-        # 尝试缓存响应内容（如果是可缓存的响应）
-        if cacheable:
-            # 对于HTML内容，缓存修正后的内容
-            if is_html and cache_manager.cache_html:
-                cache_manager.save_to_cache(url, content, content_type, r.headers)
-            # 对于非HTML内容或小文件，直接缓存原始内容
-            elif not is_large_file:
-                if ("image/" in content_type or "video/" in content_type or "audio/" in content_type) and cache_manager.cache_media:
-                    cache_manager.save_to_cache(url, r.content, content_type, r.headers)
-                elif cache_manager.cache_other:
-                    cache_manager.save_to_cache(url, r.content, content_type, r.headers)
-            # 对于大文件，可以选择不缓存或仅缓存部分内容
-            elif is_large_file and cache_manager.cache_large_files:
-                logger.debug(f"缓存大文件: {url}")
-                cache_manager.save_to_cache(url, r.content, content_type, r.headers)
-        
-        if is_html and not is_large_file:
-            # 对 HTML 内容进行链接修正
-            content = self.revision_link(r.content, 'utf-8')
-            try:
-                content = content.decode(r.encoding or 'utf-8').encode('utf-8')
-                content_type = "text/html; charset=utf-8"
-            except UnicodeDecodeError:
-                logger.warning(f"无法使用UTF-8解码内容，回退到ASCII编码: {self.url}")
-                content = content.decode('ascii', errors='ignore').encode('ascii')
-                content_type = "text/html; charset=ascii"
-            
-            # 更新内容长度，确保反映插入脚本后的实际长度
-            content_length = len(content)
-            self.handler.send_header('Content-Length', content_length)
-            self.handler.end_headers()
-            self.handler.wfile.write(content)
+        if extra_headers:
+            for name, value in extra_headers.items():
+                self.handler.send_header(name, value)
+        self.handler.end_headers()
+
+    def write_body_chunk(self, chunk):
+        """向客户端写入一块响应体"""
+        if not chunk:
+            return
+        if self.chunked:
+            # 分块大小、数据与结尾合并为一次写入，减少系统调用
+            self.handler.wfile.write(b"%X\r\n%s\r\n" % (len(chunk), chunk))
         else:
-            # 对于大文件或非 HTML 内容，使用流式传输
-            # 不设置 Content-Length，使用分块传输编码
-            self.handler.send_header('Transfer-Encoding', 'chunked')
-            self.handler.end_headers()
-            
-            # 使用 8KB 的块大小进行流式传输
-            chunk_size = 8192
-            for chunk in r.iter_bytes(chunk_size):
-                # 写入分块大小（十六进制）
-                self.handler.wfile.write(f"{len(chunk):X}\r\n".encode('ascii'))
-                # 写入数据块
-                self.handler.wfile.write(chunk)
-                self.handler.wfile.write(b"\r\n")
-            
-            # 写入结束块
+            self.handler.wfile.write(chunk)
+
+    def write_body_file(self, f, offset, count):
+        """将文件中的一段作为响应体直接发送给客户端（不使用分块传输）"""
+        self.handler.send_file_body(f, offset, count)
+
+    def finish_body(self):
+        """结束响应体，分块传输时写入结束块"""
+        if self.chunked:
             self.handler.wfile.write(b"0\r\n\r\n")
 
+    def abort_response(self, error):
+        """响应头已发出后上游出错，只能关闭连接让客户端感知传输中断"""
+        logger.warning(f"转发响应过程中出错，关闭连接: {self.url} ({error})")
+        self.handler.close_connection = True
+
     def process_error(self, error):
         """处理代理请求错误"""
         # 对于404错误，使用自定义404页面
@@ -1159,9 +5285,8 @@ class Proxy(object):
                 'requested_url': requested_url,
                 'error_message': str(error)
             }
-            body = template.get_not_found_html(context)
+            encoded = template.render_bytes('not_found', context, memoize=False)
             self.handler.send_response(HTTPStatus.NOT_FOUND)
-            encoded = body.encode(config.get("TEMPLATE_ENCODING", "utf-8"))
             self.handler.send_header('Content-Length', len(encoded))
             self.handler.send_header('Content-Type', 'text/html; charset={}'.format(config.get("TEMPLATE_ENCODING", "utf-8")))
             self.handler.end_headers()
@@ -1197,41 +5322,19 @@ class Proxy(object):
         # 对响应体中出现的链接进行修正，包括同页跳转、内链跳转、自动格式化与纠正错误链接
         if coding is None:
             return body
-        # 示例规则，可根据需求扩展更多解析规则
-        rules = [
-            ("'{}http://", config['SERVER']),
-            ('"{}http://', config['SERVER']),
-            ("'{}https://", config['SERVER']),
-            ('"{}https://', config['SERVER']),
-            ('"{}//', config['SERVER'] + self.scheme + ':'),
-            ("'{}//", config['SERVER'] + self.scheme + ':'),
-            ('"{}/', config['SERVER'] + self.site),
-            ("'{}/", config['SERVER'] + self.site),
-        ]
-        for rule in rules:
-            pattern = rule[0].replace('{}', '')
-            replacement = rule[0].format(rule[1]).encode('utf-8')
-            body = body.replace(pattern.encode('utf-8'), replacement)
-            # 在HTML内容中插入自定义JS脚本
-        try:
-            # 只处理HTML内容
-            content_str = body.decode('utf-8', errors='ignore')
-            if "</body>" in content_str:
-                # 获取所有自定义脚本
-                scripts = script_manager.get_all_scripts()
-                if scripts:
-                    # 创建脚本标签
-                    script_tags = "\n<!-- 自定义JS脚本开始 -->\n"
-                    for script_name, script_content in scripts.items():
-                        script_tags += f"<script>/* {script_name} */\n{script_content}\n</script>\n"
-                    script_tags += "<!-- 自定义JS脚本结束 -->\n"
-                    
-                    # 在</body>标签前插入脚本
-                    content_str = content_str.replace("</body>", f"</body>{script_tags}")
-                    body = content_str.encode('utf-8')
-        except Exception as e:
-            logger.error(f"插入自定义JS脚本失败: {e}")
-        return body
+        rewriter = StreamingLinkRewriter(self.rewrite_engine())
+        return rewriter.feed(body) + rewriter.flush()
+
+    def origin_collector(self):
+        """页面引用的其他源站交给连接池在后台预连接，未启用预连接时返回 None"""
+        if http_client_pool.preconnector is None:
+            return None
+        return OriginCollector(self.scheme, http_client_pool.preconnect)
+
+    def rewrite_engine(self):
+        """获取当前站点对应的已编译链接修正引擎"""
+        script_tags, scripts_version = script_manager.get_script_tags()
+        return get_rewrite_engine(self.scheme, self.site, script_tags, scripts_version)
 
     def revision_set_cookie(self, cookies):
         # 将响应中的 set-cookie 进行调整，确保域名、路径等正确
@@ -1255,9 +5358,21 @@ class Proxy(object):
         # 过滤掉空值或格式不正确的 Cookie
         if not cookie or '=' not in cookie:
             return False
-        # 可以添加更多的验证规则，例如检查 Cookie 名称是否符合规范
+        # 与浏览器的规则一致：Domain 属性只能是目标域名本身或同一站点内的上级域名，不能是公共后缀
+        domain = COOKIE_DOMAIN_RE.search(cookie)
+        if domain is not None and not self.is_cookie_domain_allowed(domain.group(1)):
+            logger.debug(f"丢弃 Domain 不属于 {self.host_info.host} 的 Cookie: {cookie}")
+            return False
         return True
 
+    def is_cookie_domain_allowed(self, domain):
+        """判断 Set-Cookie 的 Domain 属性对当前目标主机是否有效"""
+        domain = normalize_host(domain)
+        host = self.host_info.host
+        if domain == host:
+            return True
+        return host.endswith('.' + domain) and host_classifier.same_site(domain, host)
+
     def revision_response_cookie(self, cookie):
         # 设置 Cookie 24小时过期
         cookie = re.sub(r'(expires\=[^,;]+)', 
@@ -1278,14 +5393,35 @@ class SilkRoadHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
     protocol_version = "HTTP/1.1"  # 支持持久连接
 
     def __init__(self, request, client_address, server):
+        self.init_settings()
+        super().__init__(request, client_address, server)
+
+    def log_message(self, format, *args):
+        # 多进程模式下访问日志中注明所属的工作进程
+        if WORKER_ID is not None:
+            format = f"[worker {WORKER_ID}] {format}"
+        super().log_message(format, *args)
+
+    def init_settings(self):
+        """初始化与连接无关的处理器配置"""
         self.login_path = config['LOGIN_PATH']
         self.favicon_path = config['FAVICON_PATH']
+        self.stats_path = config.get('STATS_PATH', '/__stats__')
         self.server_name = config['SERVER_NAME']
         self.session_cookie_name = config['SESSION_COOKIE_NAME']
-        self.domain_re = re.compile(r'(?=^.{3,255}$)[a-zA-Z0-9][-a-zA-Z0-9]{0,62}(\.[a-zA-Z0-9][-a-zA-Z0-9]{0,62})+')
-        with open(config['FAVICON_FILE'], 'rb') as f:
-            self.favicon_data = f.read()
-        super().__init__(request, client_address, server)
+
+    def start_proxy(self):
+        """执行代理请求（异步引擎会重写此方法，改为在事件循环中执行）"""
+        Proxy(self).proxy()
+
+    def send_error(self, code, message=None, explain=None):
+        # 状态行只能包含 latin-1 字符，中文错误说明改为放在响应正文中
+        if message is not None:
+            try:
+                message.encode('latin-1')
+            except UnicodeEncodeError:
+                message, explain = None, explain or message
+        super().send_error(code, message, explain)
 
     def do_GET(self):
         self.do_request()
@@ -1321,12 +5457,19 @@ class SilkRoadHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
         elif self.path.startswith('/templates/'):
             self.process_template_file()
             return
+        elif self.path.partition('?')[0] == SCRIPT_BUNDLE_PATH:
+            self.process_script_bundle()
+            return
 
         # 检查是否需要登录验证 - 如果配置禁用了登录验证，跳过验证
         if not config.get("LOGIN_VERIFICATION_ENABLED", True):
+            if self.path == self.stats_path:
+                self.process_stats()
+                return
+
             # 直接检查是否是代理请求，避免解析URL
             if self.path[1:].startswith('http://') or self.path[1:].startswith('https://'):
-                Proxy(self).proxy()
+                self.start_proxy()
                 return
                 
             # 解析查询参数，检查是否有url参数
@@ -1343,7 +5486,7 @@ class SilkRoadHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
                         target_url = 'https://' + target_url
                 self.path = '/' + target_url
                 try:
-                    Proxy(self).proxy()
+                    self.start_proxy()
                 finally:
                     self.path = original_path
                 return
@@ -1355,9 +5498,13 @@ class SilkRoadHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
         # 需要登录验证 - 检查会话
         session = self.get_request_cookie(self.session_cookie_name)
         if sessions.is_session_exist(session):
+            if self.path == self.stats_path:
+                self.process_stats()
+                return
+
             # 直接检查是否是代理请求，避免解析URL
             if self.path[1:].startswith('http://') or self.path[1:].startswith('https://'):
-                Proxy(self).proxy()
+                self.start_proxy()
                 return
                 
             # 解析查询参数，检查是否有url参数
@@ -1374,7 +5521,7 @@ class SilkRoadHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
                         target_url = 'https://' + target_url
                 self.path = '/' + target_url
                 try:
-                    Proxy(self).proxy()
+                    self.start_proxy()
                 finally:
                     self.path = original_path
                 return
@@ -1403,13 +5550,13 @@ class SilkRoadHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
 
             self.path = '/' + target_url # Prepend '/' as Proxy expects
             try:
-                Proxy(self).proxy() # Call proxy logic with modified path
+                self.start_proxy() # Call proxy logic with modified path
             finally:
                 self.path = original_path # Restore original path
         # 如果没有 'url' 参数，再执行原来的判断逻辑 (基于路径 like /http://...)
         elif self.path[1:].startswith('http://') or self.path[1:].startswith('https://'):
             logger.debug("Request needs proxy based on path structure (direct check).")
-            Proxy(self).proxy() # 执行代理逻辑
+            self.start_proxy() # 执行代理逻辑
         else:
             logger.debug("Request does not need proxy. Processing original.")
             self.process_original() # 处理本地资源或特殊路径
@@ -1472,18 +5619,19 @@ class SilkRoadHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
                     self.send_header('Set-Cookie',
                                      '{}={}; expires={}; path=/; HttpOnly'
                                      .format(self.session_cookie_name, session, expires))
+                    self.send_header('Content-Length', 0)
                     self.end_headers()
                     logger.info(f"User '{user}' logged in successfully.")
                     return 
                 else:
                      logger.warning(f"Login failed for user '{user}'. Invalid credentials or missing data.")
-                     body = template.get_login_html(login_failed=True)
+                     body = template.get_login_bytes(login_failed=True)
                      self.return_html(body) # 返回登录页并提示失败
 
             except Exception as e:
                  logger.error(f"Error processing login POST data: {e}. Raw data: {raw_data}")
                  # 即使解析出错，也返回登录页面，避免卡住
-                 body = template.get_login_html(login_failed=True, error_message="登录请求处理失败")
+                 body = template.get_login_bytes(login_failed=True, error_message="登录请求处理失败")
                  self.return_html(body, status_code=HTTPStatus.BAD_REQUEST)
 
 
@@ -1493,19 +5641,18 @@ class SilkRoadHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
                 logger.debug("Logged-in user accessed login page, redirecting to root.")
                 self.send_response(HTTPStatus.FOUND)
                 self.send_header('Location', '/')
+                self.send_header('Content-Length', 0)
                 self.end_headers()
             else:
                 logger.debug("Serving login page to non-logged-in user.")
-                body = template.get_login_html(login_failed=False)
+                body = template.get_login_bytes(login_failed=False)
                 self.return_html(body) # 确保这里返回 200 OK
 
     def process_index(self):
-        body = template.get_index_html()
-        self.return_html(body)
+        self.return_html(template.render_bytes('index'), variant_key=template.variant_key('index'))
 
     def process_chat(self):
-        body = template.get_chat_html()
-        self.return_html(body)
+        self.return_html(template.render_bytes('chat'), variant_key=template.variant_key('chat'))
 
     def process_not_found(self):
         """处理404页面请求"""
@@ -1519,95 +5666,84 @@ class SilkRoadHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
             'timestamp': str(int(time.time())),
             'server_name': self.server_name
         }
-        body = template.get_not_found_html(context)
-        self.send_response(HTTPStatus.NOT_FOUND)
-        encoded = body.encode(config.get("TEMPLATE_ENCODING", "utf-8"))
-        self.send_header('Content-Length', len(encoded))
-        self.send_header('Content-Type', 'text/html; charset={}'.format(config.get("TEMPLATE_ENCODING", "utf-8")))
-        self.end_headers()
-        self.wfile.write(encoded)
+        encoded = template.render_bytes('not_found', context, memoize=False)
+        self.send_content(encoded, 'text/html; charset={}'.format(config.get("TEMPLATE_ENCODING", "utf-8")),
+                          HTTPStatus.NOT_FOUND)
         logger.info(f"返回404页面: {self.path}")
 
     def process_static_file(self):
         """处理静态资源文件请求"""
-        try:
-            # 从路径中提取文件名
-            filename = self.path[8:]  # 去掉 '/static/' 前缀
-            
-            # 确保文件名不包含路径遍历攻击
-            if '..' in filename or filename.startswith('/'):
-                self.send_error(HTTPStatus.FORBIDDEN, "非法的文件路径")
-                return
-            
-            # 构建静态文件路径
-            file_path = os.path.join(template.static_dir, filename)
-            
-            if not os.path.exists(file_path) or not os.path.isfile(file_path):
-                self.send_error(HTTPStatus.NOT_FOUND, "静态文件未找到")
-                logger.warning(f"静态文件未找到: {file_path}")
-                return
-            
-            # 确定内容类型
-            content_type = template._get_content_type(filename)
-            
-            # 读取文件内容
-            with open(file_path, 'rb') as f:
-                content = f.read()
-            
-            # 发送文件内容
-            self.send_response(200)
-            self.send_header('Content-Type', content_type)
-            self.send_header('Content-Length', len(content))
-            self.send_header('Cache-Control', 'max-age=86400')  # 缓存1天
-            self.end_headers()
-            self.wfile.write(content)
-            logger.debug(f"成功提供静态文件: {filename}")
-        except Exception as e:
-            logger.error(f"处理静态文件失败 {self.path}: {e}")
-            self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR, "处理静态文件失败")
+        self.process_asset_file(template.static_dir, '/static/', "静态文件")
     
     def process_template_file(self):
         """处理模板资源文件请求"""
+        templates_dir = os.path.join(template.template_dir, "templates")
+        if not os.path.exists(templates_dir):
+            os.makedirs(templates_dir)
+            logger.info(f"创建模板目录: {templates_dir}")
+        self.process_asset_file(templates_dir, '/templates/', "模板文件")
+
+    def process_asset_file(self, base_dir, prefix, kind):
+        """从资源目录返回文件，URL 中的 ?v= 版本参数与文件内容一致时允许浏览器长期缓存"""
         try:
-            # 从路径中提取文件名
-            filename = self.path[11:]  # 去掉 '/templates/' 前缀
+            # 从路径中提取文件名与版本参数
+            path, _, query = self.path.partition('?')
+            filename = parse.unquote(path[len(prefix):])
             
             # 确保文件名不包含路径遍历攻击
             if '..' in filename or filename.startswith('/'):
                 self.send_error(HTTPStatus.FORBIDDEN, "非法的文件路径")
                 return
             
-            # 构建模板文件路径
-            templates_dir = os.path.join(template.template_dir, "templates")
-            if not os.path.exists(templates_dir):
-                os.makedirs(templates_dir)
-                logger.info(f"创建模板目录: {templates_dir}")
-            
-            file_path = os.path.join(templates_dir, filename)
-            
-            if not os.path.exists(file_path) or not os.path.isfile(file_path):
-                self.send_error(HTTPStatus.NOT_FOUND, "模板文件未找到")
-                logger.warning(f"模板文件未找到: {file_path}")
+            file_path = os.path.join(base_dir, filename)
+            version = parse.parse_qs(query).get('v', [None])[0]
+            if not self.send_asset(file_path, version):
+                self.send_error(HTTPStatus.NOT_FOUND, f"{kind}未找到")
+                logger.warning(f"{kind}未找到: {file_path}")
                 return
-            
-            # 确定内容类型
-            content_type = template._get_content_type(filename)
-            
-            # 读取文件内容
-            with open(file_path, 'rb') as f:
-                content = f.read()
-            
-            # 发送文件内容
-            self.send_response(200)
-            self.send_header('Content-Type', content_type)
-            self.send_header('Content-Length', len(content))
-            self.send_header('Cache-Control', 'max-age=86400')  # 缓存1天
-            self.end_headers()
-            self.wfile.write(content)
-            logger.debug(f"成功提供模板文件: {filename}")
+            logger.debug(f"成功提供{kind}: {filename}")
+        except CLIENT_DISCONNECT_ERRORS:
+            self.close_connection = True
         except Exception as e:
-            logger.error(f"处理模板文件失败 {self.path}: {e}")
-            self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR, "处理模板文件失败")
+            logger.error(f"处理{kind}失败 {self.path}: {e}")
+            self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR, f"处理{kind}失败")
+
+    def process_script_bundle(self):
+        """返回合并压缩后的自定义脚本，URL 中的版本参数与内容一致时允许浏览器长期缓存"""
+        bundle = script_manager.bundle
+        if bundle is None or not bundle.script_tags:
+            self.send_error(HTTPStatus.NOT_FOUND, "脚本未找到")
+            return
+        # 缓存中的旧页面可能引用旧版本号，此时返回当前内容但要求浏览器每次重新验证
+        version = parse.parse_qs(self.path.partition('?')[2]).get('v', [None])[0]
+        content_type = 'application/javascript; charset=utf-8'
+        encoding = None
+        if len(bundle.content) >= COMPRESSION_MIN_SIZE:
+            encoding = negotiate_encoding(self.headers.get('Accept-Encoding'))
+        body = compressed_variants.get(bundle.etag, bundle.content, encoding) if encoding else None
+        if body is None:
+            encoding, body = None, bundle.content
+        headers = {'ETag': f'"{bundle.digest}-{encoding}"' if encoding else bundle.etag,
+                   'Last-Modified': bundle.last_modified,
+                   'Cache-Control': ASSET_IMMUTABLE_CACHE_CONTROL if version == bundle.version else 'no-cache',
+                   'Vary': 'Accept-Encoding'}
+        self.clear_client_cache = False
+        if is_not_modified(self.headers, headers['ETag'], bundle.last_modified):
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            return
+        self.send_response(HTTPStatus.OK)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', len(body))
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
 
     def return_favicon(self):
         """返回favicon.ico"""
@@ -1615,47 +5751,141 @@ class SilkRoadHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
         favicon_file_path = config.get('FAVICON_FILE', 'templates/favicon.ico') 
         # 构建绝对路径
         favicon_full_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), favicon_file_path)
-
-        if os.path.exists(favicon_full_path):
-            try:
-                with open(favicon_full_path, 'rb') as f:
-                    content = f.read()
-                self.send_response(HTTPStatus.OK)
-                # 根据文件扩展名确定 Content-Type
-                content_type = 'image/x-icon' # 默认
-                if favicon_full_path.lower().endswith('.png'):
-                    content_type = 'image/png'
-                elif favicon_full_path.lower().endswith('.svg'):
-                    content_type = 'image/svg+xml'
-                elif favicon_full_path.lower().endswith('.jpg') or favicon_full_path.lower().endswith('.jpeg'):
-                    content_type = 'image/jpeg'
-                # 可以根据需要添加更多类型
-                self.send_header('Content-type', content_type)
-                self.send_header('Content-Length', str(len(content)))
-                self.end_headers()
-                self.wfile.write(content)
+        try:
+            if self.send_asset(favicon_full_path):
                 logger.debug(f"Served favicon from {favicon_full_path}")
-            except IOError as e:
-                logger.error(f"IOError serving favicon {favicon_full_path}: {e}")
-                self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR, "Error reading favicon")
-            except Exception as e:
-                logger.error(f"Unexpected error serving favicon {favicon_full_path}: {e}")
-                self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR, "Error serving favicon")
+                return
+        except CLIENT_DISCONNECT_ERRORS:
+            self.close_connection = True
+            return
+        except Exception as e:
+            logger.error(f"Unexpected error serving favicon {favicon_full_path}: {e}")
+            self.send_error(HTTPStatus.INTERNAL_SERVER_ERROR, "Error serving favicon")
+            return
+        logger.warning(f"Favicon file not found at {favicon_full_path}. Sending 404.")
+        # 发送一个明确的 404 Not Found 响应
+        self.send_response(HTTPStatus.NOT_FOUND)
+        self.send_header('Content-type', 'text/plain')
+        self.send_header('Content-Length', len(b'Favicon not found'))
+        self.end_headers()
+        self.wfile.write(b'Favicon not found')
+
+    def send_asset(self, file_path, version=None):
+        """发送静态资源文件，文件不存在时返回 False
+
+        响应带有基于内容哈希的强 ETag 与 Last-Modified，浏览器缓存的版本仍然有效时返回 304；
+        文本文件按客户端能力发送预压缩变体，其余文件通过 sendfile 直接发送。
+        """
+        asset = asset_registry.get(file_path)
+        if asset is None:
+            return False
+        asset_registry.count('requests')
+        encoding = None
+        if asset.size >= COMPRESSION_MIN_SIZE and is_compressible(asset.content_type):
+            encoding = negotiate_encoding(self.headers.get('Accept-Encoding'))
+        body = compressed_variants.get(asset.key, asset.read, encoding) if encoding else None
+        if body is None:
+            encoding = None
+        # 同一文件的不同压缩编码是不同的表示，各自使用不同的 ETag
+        headers = {'ETag': f'"{asset.digest}-{encoding}"' if encoding else asset.etag,
+                   'Last-Modified': asset.last_modified}
+        if version == asset.version:
+            asset_registry.count('immutable')
+            headers['Cache-Control'] = ASSET_IMMUTABLE_CACHE_CONTROL
         else:
-            logger.warning(f"Favicon file not found at {favicon_full_path}. Sending 404.")
-            # 发送一个明确的 404 Not Found 响应
-            self.send_response(HTTPStatus.NOT_FOUND)
-            self.send_header('Content-type', 'text/plain')
+            # 没有版本参数的 URL 每次使用前向服务器确认，文件未变时只返回 304
+            headers['Cache-Control'] = 'no-cache'
+        if is_compressible(asset.content_type):
+            headers['Vary'] = 'Accept-Encoding'
+        # 资源自带缓存策略，不再附加全局的禁止缓存响应头
+        self.clear_client_cache = False
+
+        if is_not_modified(self.headers, headers['ETag'], asset.last_modified):
+            asset_registry.count('not_modified')
+            self.send_response(HTTPStatus.NOT_MODIFIED)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            return True
+
+        if body is not None:
+            self.send_response(HTTPStatus.OK)
+            self.send_header('Content-Type', asset.content_type)
+            self.send_header('Content-Length', len(body))
+            self.send_header('Content-Encoding', encoding)
+            for name, value in headers.items():
+                self.send_header(name, value)
+            self.end_headers()
+            if self.command != 'HEAD':
+                self.wfile.write(body)
+            return True
+
+        with open(asset.path, 'rb') as f:
+            file_stat = os.fstat(f.fileno())
+            if file_stat.st_size != asset.size or file_stat.st_mtime_ns != asset.mtime_ns:
+                # 文件刚被修改，按新内容重新登记
+                return self.send_asset(file_path) if asset_registry.get(file_path, refresh=True) else False
+            self.send_response(HTTPStatus.OK)
+            self.send_header('Content-Type', asset.content_type)
+            self.send_header('Content-Length', asset.size)
+            for name, value in headers.items():
+                self.send_header(name, value)
             self.end_headers()
-            self.wfile.write(b'Favicon not found')
+            if self.command != 'HEAD':
+                self.send_file_body(f, 0, asset.size)
+        return True
+
+    def send_file_body(self, f, offset, count):
+        """将文件中的一段作为响应体直接发送给客户端"""
+        sendfile = getattr(self.wfile, 'sendfile', None)
+        if sendfile is not None:
+            # 异步引擎由事件循环发送
+            sendfile(f, offset, count)
+        else:
+            sendfile_to_socket(self.connection, f, offset, count, PERFORMANCE_CONFIG['STREAM_CHUNK_SIZE'])
+
+    def process_stats(self):
+        """返回运行状态统计（JSON），需要登录验证时仅对已登录用户开放"""
+        encoded = json.dumps(collect_stats(), ensure_ascii=False, indent=2).encode('utf-8')
+        self.send_content(encoded, 'application/json; charset=utf-8')
+
+    def return_html(self, body, status_code=HTTPStatus.OK, variant_key=None):
+        """发送 HTML 页面；内容固定的页面（首页、聊天页、403页面）提供 variant_key，只压缩一次，
+        登录页、错误页等每次请求可能不同的页面按需快速压缩"""
+        # 模板渲染结果已经是编码后的字节串时直接发送
+        encoded = body if isinstance(body, bytes) else body.encode(config.get("TEMPLATE_ENCODING", "utf-8"))
+        content_type = 'text/html; charset={}'.format(config.get("TEMPLATE_ENCODING", "utf-8"))
+        self.send_content(encoded, content_type, status_code, variant_key=variant_key)
+
+    def send_content(self, content, content_type, status_code=HTTPStatus.OK, variant_key=None, extra_headers=None):
+        """发送完整响应，客户端支持时压缩文本内容
 
-    def return_html(self, body, status_code=HTTPStatus.OK):
-        encoded = body.encode(config.get("TEMPLATE_ENCODING", "utf-8"))
+        提供 variant_key 的内容只压缩一次并保存在预压缩变体缓存中，其余内容按需快速压缩。
+        """
+        encoding = None
+        if len(content) >= COMPRESSION_MIN_SIZE and is_compressible(content_type):
+            encoding = negotiate_encoding(self.headers.get('Accept-Encoding'))
+        if encoding:
+            if variant_key is not None:
+                compressed = compressed_variants.get(variant_key, content, encoding)
+            else:
+                compressed = compress_bytes(content, encoding)
+            if compressed is not None and len(compressed) < len(content):
+                content = compressed
+            else:
+                encoding = None
         self.send_response(status_code)
-        self.send_header('Content-Length', len(encoded))
-        self.send_header('Content-Type', 'text/html; charset={}'.format(config.get("TEMPLATE_ENCODING", "utf-8")))
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', len(content))
+        if encoding:
+            self.send_header('Content-Encoding', encoding)
+        if is_compressible(content_type):
+            self.send_header('Vary', 'Accept-Encoding')
+        if extra_headers:
+            for name, value in extra_headers.items():
+                self.send_header(name, value)
         self.end_headers()
-        self.wfile.write(encoded)
+        self.wfile.write(content)
 
     def pre_process_path(self):
         # 支持通过 URL 参数进行跳转
@@ -1703,14 +5933,12 @@ class SilkRoadHTTPRequestHandler(http.server.BaseHTTPRequestHandler):
     def redirect_to_login(self):
         self.send_response(HTTPStatus.FOUND)
         self.send_header('Location', self.login_path)
+        self.send_header('Content-Length', 0)
         self.end_headers()
 
     def is_start_with_domain(self, string):
-        domain = self.domain_re.match(string)
-        psl = PublicSuffixList()
-        if domain is None or domain.group(1)[1:] not in psl.tlds:
-            return False
-        return True
+        domain = DOMAIN_RE.match(string)
+        return domain is not None and host_classifier.is_domain(domain.group(0))
 
 # ------------------ 多线程 HTTP 服务器 ------------------
 class ThreadingHttpServer(ThreadingMixIn, http.server.HTTPServer):
@@ -1738,17 +5966,466 @@ class ThreadingHttpServer(ThreadingMixIn, http.server.HTTPServer):
         # 使用线程池处理请求，而不是为每个请求创建新线程
         self._thread_pool.submit(self.process_request_thread, request, client_address)
 
+# ------------------ 异步 HTTP 服务器 ------------------
+class AsyncResponseWriter:
+    """异步引擎中替代 wfile 的写入器
+
+    在事件循环线程中直接写入传输层缓冲区，由调用方 await drain() 实现背压；
+    在线程池中执行的同步处理代码（登录、模板、静态文件、缓存命中）调用 write 时，
+    会等待数据交给事件循环并排空缓冲区后再返回，与阻塞套接字的行为一致。
+    """
+    def __init__(self, server, writer):
+        self.server = server
+        self.writer = writer
+
+    def write(self, data):
+        if self.writer.is_closing():
+            raise ConnectionResetError("客户端连接已关闭")
+        if get_ident() == self.server.loop_thread_id:
+            self.writer.write(data)
+        else:
+            asyncio.run_coroutine_threadsafe(self._write_and_drain(data), self.server.loop).result()
+        return len(data)
+
+    async def _write_and_drain(self, data):
+        self.writer.write(data)
+        await self.writer.drain()
+
+    def sendfile(self, f, offset, count):
+        """在线程池中发送文件的一段：明文连接由事件循环使用 os.sendfile，TLS 连接自动回退为分块读取"""
+        if self.writer.is_closing():
+            raise ConnectionResetError("客户端连接已关闭")
+        if count > 0:
+            asyncio.run_coroutine_threadsafe(
+                self.server.loop.sendfile(self.writer.transport, f, offset, count), self.server.loop).result()
+
+    def flush(self):
+        pass
+
+    async def drain(self):
+        await self.writer.drain()
+
+class AsyncRequestHandler(SilkRoadHTTPRequestHandler):
+    """异步引擎的请求处理器，复用同步处理器的路由、登录、模板与静态文件逻辑"""
+    def __init__(self, server, reader, writer, client_address):
+        # 不调用父类构造函数：父类会在套接字上同步读取并处理请求
+        self.init_settings()
+        self.server = server
+        self.reader = reader
+        self.client_address = client_address
+        self.connection = writer.get_extra_info('socket')
+        self.wfile = AsyncResponseWriter(server, writer)
+        self.pending_proxy = None
+        self.close_connection = True
+
+    async def handle_one_request_async(self):
+        """读取并处理一个请求，返回连接是否可以继续复用"""
+        try:
+            head = await asyncio.wait_for(self.reader.readuntil(b'\r\n\r\n'), self.server.keepalive_timeout)
+        except asyncio.IncompleteReadError:
+            return False
+        except asyncio.LimitOverrunError:
+            self.send_error(HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE)
+            await self.wfile.drain()
+            return False
+        request_line, _, header_block = head.partition(b'\r\n')
+        self.raw_requestline = request_line + b'\r\n'
+        self.rfile = io.BytesIO(header_block)
+        if not self.parse_request():
+            await self.wfile.drain()
+            return False
+        
+        try:
+            content_length = int(self.headers.get('Content-Length') or 0)
+        except ValueError:
+            self.send_error(HTTPStatus.BAD_REQUEST, "Bad Content-Length")
+            await self.wfile.drain()
+            return False
+        body = await self.reader.readexactly(content_length) if content_length > 0 else b''
+        self.rfile = io.BytesIO(body)
+        
+        # 非代理请求在线程池中按同步方式处理，代理请求在事件循环中异步转发
+        await self.server.loop.run_in_executor(self.server.executor, self.dispatch)
+        if self.pending_proxy is not None:
+            await self.pending_proxy.proxy_async()
+        await self.wfile.drain()
+        return not self.close_connection
+
+    def dispatch(self):
+        """按请求方法分发（在线程池中执行）"""
+        method = getattr(self, 'do_' + self.command, None)
+        if method is None:
+            self.send_error(HTTPStatus.NOT_IMPLEMENTED, "Unsupported method (%r)" % self.command)
+            return
+        method()
+
+    def start_proxy(self):
+        # 记录代理请求，由事件循环在 dispatch 返回后异步执行
+        self.pending_proxy = AsyncProxy(self)
+
+class AsyncProxy(Proxy):
+    """异步引擎使用的代理，通过连接池共享的 httpx.AsyncClient 流式转发上游响应"""
+    async def proxy_async(self):
+        if self.blocked:
+            self.process_forbidden()
+            return
+        # 判断是否为 WebSocket 请求，若是则调用占位处理
+        if self.handler.headers.get('Upgrade', '').lower() == 'websocket':
+            self.process_websocket()
+            return
+
+        server = self.handler.server
+        data = self.prepare_request()
+        # 缓存命中需要读取磁盘，放到线程池中执行，避免阻塞事件循环
+        if await server.loop.run_in_executor(server.executor, self.serve_from_cache):
+            return
+        fetch, leader = self.join_inflight()
+        if fetch is not None and not leader:
+            if (await fetch.wait_head_async(self.timeout)
+                    and fetch.shareable_with(self.handler.headers.get('Cookie'))):
+                await self.serve_coalesced_async(fetch)
+                return
+            fetch.leave()
+            single_flight.count('declined')
+        error = None
+        try:
+            retry_count = 0
+            while retry_count < self.max_retries:
+                headers = self.build_upstream_headers()
+                try:
+                    async with http_client_pool.astream(self.handler.command, self.url,
+                                                        headers=headers, content=data) as r:
+                        await self.process_response_async(r)
+                    error = None
+                    break
+                except Exception as e:
+                    error = e
+                    if not self.handle_upstream_error(e, retry_count, headers):
+                        break
+                    retry_count += 1
+                    await asyncio.sleep(1)  # 短暂延迟后重试
+        finally:
+            if self.inflight is not None:
+                # 领头请求的客户端断开时响应体已读完，跟随请求不受影响
+                single_flight.release(self.inflight, None if isinstance(error, CLIENT_DISCONNECT_ERRORS) else error)
+
+    async def serve_coalesced_async(self, fetch):
+        self.coalesced = True
+        single_flight.count('coalesced')
+        subresource_prefetcher.record_use(self.url)
+        logger.debug(f"合并请求: {self.url}")
+        r = fetch.follower_response()
+        try:
+            await self.process_response_async(r)
+        except Exception as error:
+            self.handle_upstream_error(error, self.max_retries - 1, None)
+        finally:
+            await r.aclose()
+
+    async def process_response_async(self, r):
+        if self.stale_entry is not None and r.status_code == 304:
+            # 刷新缓存元数据并从缓存返回需要读写磁盘，放到线程池中执行
+            server = self.handler.server
+            await server.loop.run_in_executor(server.executor, self.revalidated, r)
+            return
+        r = self.share_response(r)
+        relay = None
+        pending = None
+        try:
+            relay = self.start_response(r)
+            if relay is None:
+                return
+            # 写缓存的响应在线程池中处理数据块：缓存文件写入、提交时的 os.replace 与索引事务都不阻塞事件循环
+            executor = self.handler.server.executor if relay.writes_cache else None
+            chunks = r.aiter_raw(relay.chunk_size) if relay.raw else r.aiter_bytes(relay.chunk_size)
+            async for chunk in chunks:
+                if executor is None:
+                    relay.feed(chunk)
+                else:
+                    pending = executor.submit(relay.feed, chunk)
+                    await asyncio.wrap_future(pending)
+                # 等待客户端接收，慢速客户端不会让数据在内存中无限堆积
+                await self.handler.wfile.drain()
+            if executor is None:
+                relay.finish()
+            else:
+                pending = executor.submit(relay.finish)
+                await asyncio.wrap_future(pending)
+        except BaseException as error:
+            if relay is not None:
+                if relay.writes_cache:
+                    # 协程被取消时线程池中的 feed 可能仍在执行，丢弃缓存前先等待它结束
+                    await asyncio.wrap_future(self.handler.server.executor.submit(self.abort_relay, relay, pending))
+                else:
+                    relay.abort()
+            if isinstance(error, CLIENT_DISCONNECT_ERRORS) and isinstance(r.stream, InflightStream):
+                await r.stream.adrain()
+            raise
+
+    @staticmethod
+    def abort_relay(relay, pending):
+        if pending is not None:
+            concurrent.futures.wait([pending])
+        relay.abort()
+
+class AsyncHttpServer:
+    """基于 asyncio 的 HTTP 服务器引擎
+
+    每个连接只占用一个协程，空闲的长连接和慢速视频下载不再各自占住一个工作线程，
+    单进程即可同时维持数千个并发流。可在 config.json 中设置 SERVER_ENGINE 为 asyncio 启用。
+    """
+    keepalive_timeout = 75  # 长连接空闲超时（秒）
+    max_header_size = 64 * 1024
+
+    def __init__(self, server_address, ssl_context=None, max_worker_threads=200, sock=None):
+        self.server_address = server_address
+        self.ssl_context = ssl_context
+        # 多进程模式下工作进程使用的监听套接字
+        self.sock = sock
+        # 处理非代理请求和缓存命中的线程池，这些任务都很短
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_worker_threads,
+            thread_name_prefix="SilkRoad-Async"
+        )
+        self.loop = None
+        self.loop_thread_id = None
+
+    async def serve_forever(self):
+        self.loop = asyncio.get_running_loop()
+        self.loop_thread_id = get_ident()
+        if self.sock is not None:
+            server = await asyncio.start_server(self.handle_connection, sock=self.sock, ssl=self.ssl_context,
+                                                limit=self.max_header_size, backlog=1024)
+        else:
+            host, port = self.server_address
+            server = await asyncio.start_server(self.handle_connection, host or None, port, ssl=self.ssl_context,
+                                                limit=self.max_header_size, backlog=1024)
+        async with server:
+            await server.serve_forever()
+
+    async def handle_connection(self, reader, writer):
+        client_address = writer.get_extra_info('peername')
+        try:
+            while True:
+                handler = AsyncRequestHandler(self, reader, writer, client_address)
+                if not await handler.handle_one_request_async():
+                    break
+        except (ConnectionError, asyncio.TimeoutError, ssl.SSLError):
+            # 客户端断开、长连接空闲超时或 TLS 握手失败
+            pass
+        except Exception as e:
+            logger.error(f"处理连接时出错 {client_address}: {e}")
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
 # 性能调优配置
 PERFORMANCE_CONFIG = {
-    'HTTP_CLIENT_POOL_SIZE': 100,      # HTTP客户端连接池大小
+    'HTTP_CLIENT_POOL_SIZE': 500,      # 共享上游连接池的最大连接数
+    'MAX_CONNECTIONS_PER_HOST': 256,  # 每个上游主机的最大并发请求数（长连接流也占用名额）
+    'KEEPALIVE_EXPIRY': 30.0,         # 上游空闲连接保持时间（秒）
+    'UPSTREAM_HTTP2': True,           # 上游支持时使用 HTTP/2（需要安装 h2）
+    'STREAM_CHUNK_SIZE': 64 * 1024,   # 流式转发响应体的块大小（字节）
     'MAX_WORKER_THREADS': 200,        # 最大工作线程数
-    'SESSION_CACHE_TTL': 300,         # 会话缓存有效期（秒）
     'LOG_SAMPLE_RATE': 1,           # 日志采样率（0-1）
     'ENABLE_PERFORMANCE_MODE': True   # 是否启用性能模式
 }
 
+# ------------------ 运行状态统计 ------------------
+def collect_stats():
+    """汇总各子系统的运行统计，供状态接口使用"""
+    stats = {'pid': os.getpid(), 'worker': WORKER_ID, 'time': int(time.time()), 'compressed_variants': compressed_variants.get_stats(),
+             'assets': asset_registry.get_stats()}
+    stats['cache'] = cache_manager.get_stats()
+    stats['coalescing'] = single_flight.get_stats()
+    stats['sessions'] = sessions.get_stats()
+    stats['blacklist'] = blacklist.get_stats()
+    stats['hosts'] = host_classifier.get_stats()
+    stats['prefetch'] = subresource_prefetcher.get_stats()
+    pool = globals().get('http_client_pool')
+    if pool is not None:
+        stats['upstream'] = pool.get_stats()
+    return stats
+
+# ------------------ 性能基准测试 ------------------
+def _benchmark_throughput(func, payload, rounds):
+    """重复执行 func(payload)，返回吞吐量（MB/s）"""
+    func(payload)  # 预热
+    start = time.perf_counter()
+    for _ in range(rounds):
+        func(payload)
+    elapsed = time.perf_counter() - start
+    return len(payload) * rounds / elapsed / 1024 / 1024
+
+def benchmark_rewrite():
+    """对比原逐条规则替换实现与单遍编译引擎的 HTML 链接修正吞吐量"""
+    scheme, site = 'https', 'https://www.example.com'
+    fragment = ('<div class="item"><a href="/post/1">文章</a><img src="//img.example.com/a.png">'
+                '<script src="https://cdn.example.com/app.js"></script>'
+                "<a href='http://other.example.org/x'>x</a><p>正文内容 lorem ipsum dolor sit amet</p></div>\n")
+    page = ('<html><head><title>bench</title></head><body>' + fragment * 8000 + '</body></html>').encode('utf-8')
+    script_tags, _ = script_manager.get_script_tags()
+    rules = link_rules(scheme, site)
+
+    def legacy(body):
+        # 原 revision_link：逐条规则 bytes.replace、解码为 str 插入脚本后再编码，
+        # 且 process_response 会对同一页面执行两次并再做一次解码/编码
+        for _ in range(2):
+            out = body
+            for pattern, replacement in rules:
+                out = out.replace(pattern, replacement)
+            content_str = out.decode('utf-8', errors='ignore')
+            if "</body>" in content_str:
+                content_str = content_str.replace("</body>", "</body>" + script_tags.decode('utf-8'))
+                out = content_str.encode('utf-8')
+            out = out.decode('utf-8').encode('utf-8')
+        return out
+
+    def compiled_whole(body):
+        rewriter = StreamingLinkRewriter(get_rewrite_engine(scheme, site, script_tags))
+        return rewriter.feed(body) + rewriter.flush()
+
+    def compiled_streaming(body):
+        rewriter = StreamingLinkRewriter(get_rewrite_engine(scheme, site, script_tags))
+        chunk_size = PERFORMANCE_CONFIG['STREAM_CHUNK_SIZE']
+        for i in range(0, len(body), chunk_size):
+            rewriter.feed(body[i:i + chunk_size])
+        return rewriter.flush()
+
+    print(f"HTML 链接修正基准测试：页面大小 {len(page) / 1024 / 1024:.2f} MB")
+    for name, func in (("原实现（逐条规则，两次处理）", legacy),
+                       ("编译引擎（整页）", compiled_whole),
+                       ("编译引擎（64KB 分块流式）", compiled_streaming)):
+        print(f"  {name}: {_benchmark_throughput(func, page, 10):.1f} MB/s")
+
+def benchmark_sessions(count=100000):
+    """在大量在线会话下对比原列表实现与字典+到期堆实现的会话查找与回收耗时"""
+    store = Sessions(recycle_interval=None)
+    start = time.perf_counter()
+    tokens = [store.generate_new_session() for _ in range(count)]
+    elapsed = time.perf_counter() - start
+    print(f"会话存储基准测试：{count} 个在线会话")
+    print(f"  生成会话: {elapsed / count * 1e6:.2f} µs/个")
+
+    rounds = 200000
+    start = time.perf_counter()
+    for i in range(rounds):
+        store.is_session_exist(tokens[i % count])
+    print(f"  查找有效会话: {(time.perf_counter() - start) / rounds * 1e6:.3f} µs/次")
+    start = time.perf_counter()
+    for i in range(rounds):
+        store.is_session_exist('invalid-session')
+    print(f"  查找无效会话: {(time.perf_counter() - start) / rounds * 1e6:.3f} µs/次")
+
+    # 签名会话：验证缓存命中与每次都重新计算签名
+    signed = SignedSessions(['benchmark-key'])
+    signed_tokens = [signed.generate_new_session() for _ in range(1000)]
+    start = time.perf_counter()
+    for i in range(rounds):
+        signed.is_session_exist(signed_tokens[i % len(signed_tokens)])
+    print(f"  签名会话验证（缓存命中）: {(time.perf_counter() - start) / rounds * 1e6:.3f} µs/次")
+    start = time.perf_counter()
+    for i in range(rounds // 10):
+        signed._verify(signed_tokens[i % len(signed_tokens)])
+    print(f"  签名会话验证（计算签名）: {(time.perf_counter() - start) / (rounds // 10) * 1e6:.3f} µs/次")
+
+    # 原实现：缓存未命中时线性扫描会话列表
+    legacy = [[token, time.time()] for token in tokens]
+    legacy_rounds = 50
+    start = time.perf_counter()
+    for _ in range(legacy_rounds):
+        for item in legacy:
+            if item[0] == 'invalid-session':
+                break
+    print(f"  原实现查找无效会话（线性扫描）: {(time.perf_counter() - start) / legacy_rounds * 1e6:.1f} µs/次")
+
+    # 全部会话到期后回收（登录时间错开，与实际情况一致）
+    now = time.time()
+    with store.lock:
+        for i, token in enumerate(tokens):
+            store.sessions[token] = now - store.age - count + i
+        store.expiry_heap = [(now - count + i, token) for i, token in enumerate(tokens)]
+    start = time.perf_counter()
+    store.recycle_session()
+    print(f"  回收 {count} 个过期会话: {(time.perf_counter() - start) * 1000:.1f} ms，剩余 {len(store.sessions)} 个")
+    # 原实现逐个 list.remove，为平方复杂度
+    deleting = list(legacy)
+    start = time.perf_counter()
+    for item in deleting:
+        legacy.remove(item)
+    print(f"  原实现回收 {count} 个过期会话: {(time.perf_counter() - start) * 1000:.1f} ms")
+
+def benchmark_blacklist():
+    """不同规模黑名单下的单次查找耗时，并与逐条比较域名后缀的实现对比"""
+    rng = random.Random(1)
+    tlds = ['com', 'net', 'org', 'cn', 'io', 'co.uk', 'com.cn', 'info']
+
+    def random_domain():
+        name = ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz0123456789') for _ in range(rng.randint(5, 14)))
+        return f"{name}.{rng.choice(tlds)}"
+
+    def per_lookup(compiled, hosts, repeat=100):
+        # 取多次运行中的最小值，减少机器负载波动的影响
+        match = compiled.match
+        hosts = hosts * repeat
+        best = None
+        for _ in range(5):
+            start = time.perf_counter()
+            for host in hosts:
+                match(host, '/index.html')
+            elapsed = time.perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        return best / len(hosts) * 1e6
+
+    print("黑名单基准测试（单次查找耗时）：")
+    for count in (1000, 10000, 100000):
+        domains = [random_domain() for _ in range(count)]
+        patterns = [f"{random_domain()}/ads/*" for _ in range(count // 100)]
+        start = time.perf_counter()
+        compiled = CompiledBlacklist(domains, patterns)
+        build_ms = (time.perf_counter() - start) * 1000
+        hits = [f"www.{domain}" for domain in domains[:1000]]
+        misses = [f"static.cdn.{random_domain()}" for _ in range(1000)]
+        print(f"  {count} 个域名 + {len(patterns)} 个模式：编译 {build_ms:.0f} ms，"
+              f"命中 {per_lookup(compiled, hits):.3f} µs，未命中 {per_lookup(compiled, misses):.3f} µs")
+        if count == 10000:
+            # 域名部分含通配符的模式无法按域名索引，合并为一个正则表达式对每个请求匹配
+            wildcard = CompiledBlacklist(domains, patterns + ['*.tracker.*/pixel*', '*/*ad-banner-*.js'])
+            print(f"  另加 2 个域名通配模式：命中 {per_lookup(wildcard, hits):.3f} µs，未命中 {per_lookup(wildcard, misses):.3f} µs")
+            # 原始做法：逐条比较域名后缀
+            suffixes = [(domain, '.' + domain) for domain in domains]
+            legacy_rounds = 200
+            start = time.perf_counter()
+            for i in range(legacy_rounds):
+                host = misses[i % 1000]
+                any(host == domain or host.endswith(suffix) for domain, suffix in suffixes)
+            print(f"  {count} 个域名逐条比较后缀（未命中）: {(time.perf_counter() - start) / legacy_rounds * 1e6:.1f} µs/次")
+
+# 可通过 python SilkRoad.py --benchmark <名称> 运行的基准测试
+BENCHMARKS = {
+    'rewrite': benchmark_rewrite,
+    'sessions': benchmark_sessions,
+    'blacklist': benchmark_blacklist,
+}
+
+def run_benchmark(name):
+    """运行指定的基准测试"""
+    if name not in BENCHMARKS:
+        print(f"未知的基准测试: {name}，可选: {', '.join(BENCHMARKS)}")
+        return
+    BENCHMARKS[name]()
+
 # ------------------ 主程序入口 ------------------
 if __name__ == '__main__':
+    # 运行基准测试后直接退出（后台定时任务为非守护线程，需强制结束进程）
+    if len(sys.argv) >= 3 and sys.argv[1] == '--benchmark':
+        logger.remove()
+        run_benchmark(sys.argv[2])
+        os._exit(0)
+    
     # 设置日志 - 在高并发模式下调整日志级别
     if PERFORMANCE_CONFIG['ENABLE_PERFORMANCE_MODE']:
         logger.add(config['LOG_FILE'], rotation="500 MB", level="WARNING")  # 只记录警告和错误
@@ -1756,7 +6433,10 @@ if __name__ == '__main__':
         logger.add(config['LOG_FILE'], rotation="500 MB", level="INFO")
     
     # 初始化HTTP客户端连接池
-    http_client_pool = HttpClientPool(pool_size=PERFORMANCE_CONFIG['HTTP_CLIENT_POOL_SIZE'])
+    http_client_pool = HttpClientPool(pool_size=PERFORMANCE_CONFIG['HTTP_CLIENT_POOL_SIZE'],
+                                      max_connections_per_host=PERFORMANCE_CONFIG['MAX_CONNECTIONS_PER_HOST'],
+                                      keepalive_expiry=PERFORMANCE_CONFIG['KEEPALIVE_EXPIRY'],
+                                      http2=PERFORMANCE_CONFIG['UPSTREAM_HTTP2'])
     
     # 设置线程池大小
     ThreadingHttpServer.max_worker_threads = PERFORMANCE_CONFIG['MAX_WORKER_THREADS']
@@ -1764,6 +6444,12 @@ if __name__ == '__main__':
     # 执行系统自检和缓存清理
     system_check_and_cleanup()
     
+    # 在后台预压缩静态资源与模板文件
+    if config.get('COMPRESSION_ENABLED', True):
+        Thread(target=compressed_variants.warm,
+               args=([template.static_dir, os.path.join(template.template_dir, 'templates')],),
+               daemon=True).start()
+    
     # 添加客户端缓存和cookie清理的响应头处理
     class ClientCacheCleaner:
         """用于清除客户端缓存和Cookie的工具类"""
@@ -1800,15 +6486,40 @@ if __name__ == '__main__':
     
     # 启动HTTP服务器
     server_address = (config['BIND_IP'], config['PORT'])
-    with ThreadingHttpServer(server_address, SilkRoadHTTPRequestHandler) as httpd:
-        if config['SCHEME'] == 'https':
-            context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
-            context.load_cert_chain(certfile=config['CERT_FILE'], keyfile=config['KEY_FILE'])
-            httpd.socket = context.wrap_socket(httpd.socket, server_side=True)
-        
-        logger.info('系统启动完成！服务运行在 {} 端口 {} ({}://{}:{}...)',
+    context = None
+    if config['SCHEME'] == 'https':
+        context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        context.load_cert_chain(certfile=config['CERT_FILE'], keyfile=config['KEY_FILE'])
+    
+    server_engine = config.get('SERVER_ENGINE', 'threading')
+    if server_engine == 'asyncio':
+        # asyncio 引擎：每个连接一个协程，适合大量并发长连接与流媒体
+        async_server = AsyncHttpServer(server_address, context,
+                                       max_worker_threads=PERFORMANCE_CONFIG['MAX_WORKER_THREADS'],
+                                       sock=worker_listen_socket(server_address))
+        logger.info('系统启动完成！(asyncio 引擎) 服务运行在 {} 端口 {} ({}://{}:{}...)',
                     config["BIND_IP"], config["PORT"], config["SCHEME"], config["DOMAIN"], config["PORT"])
         try:
-            httpd.serve_forever()
+            asyncio.run(async_server.serve_forever())
         except Exception as e:
             logger.error("服务器错误: {}", e)
+    else:
+        if server_engine != 'threading':
+            logger.warning(f"未知的服务器引擎 {server_engine}，使用 threading 引擎")
+        listen_socket = worker_listen_socket(server_address)
+        with ThreadingHttpServer(server_address, SilkRoadHTTPRequestHandler,
+                                 bind_and_activate=listen_socket is None) as httpd:
+            if listen_socket is not None:
+                # 工作进程使用继承的（或 SO_REUSEPORT）监听套接字
+                httpd.socket.close()
+                httpd.socket = listen_socket
+                httpd.server_address = listen_socket.getsockname()
+            if context is not None:
+                httpd.socket = context.wrap_socket(httpd.socket, server_side=True)
+            
+            logger.info('系统启动完成！服务运行在 {} 端口 {} ({}://{}:{}...)',
+                        config["BIND_IP"], config["PORT"], config["SCHEME"], config["DOMAIN"], config["PORT"])
+            try:
+                httpd.serve_forever()
+            except Exception as e:
+                logger.error("服务器错误: {}", e)
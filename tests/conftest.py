@@ -0,0 +1,8 @@
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# SilkRoad.py 在导入时按相对路径读取 databases/ 与 templates/，先切换到仓库根目录
+os.chdir(ROOT)
+sys.path.insert(0, ROOT)
@@ -0,0 +1,40 @@
+import SilkRoad
+
+
+def compiled(domains=(), patterns=()):
+    return SilkRoad.CompiledBlacklist(domains, patterns)
+
+
+def test_domain_blocks_subdomains():
+    blacklist = compiled(domains=['Example.com'])
+    assert blacklist.match('example.com', '/')
+    assert blacklist.match('www.example.com', '/any?q=1')
+    assert not blacklist.match('notexample.com', '/')
+    assert not blacklist.match('example.org', '/')
+
+
+def test_scheme_and_wildcard_prefix_in_domain_entries():
+    blacklist = compiled(domains=['https://ads.example.net/path', '*.tracker.io'])
+    assert blacklist.match('ads.example.net', '/')
+    assert blacklist.match('a.b.tracker.io', '/')
+    assert not blacklist.match('example.net', '/')
+
+
+def test_host_patterns_match_full_path():
+    blacklist = compiled(patterns=['video.example.com/ads/*', 'video.example.com/promo'])
+    assert blacklist.match('video.example.com', '/ads/1.mp4')
+    assert blacklist.match('video.example.com', '/promo')
+    assert not blacklist.match('video.example.com', '/promo/more')
+    assert not blacklist.match('video.example.com', '/watch')
+    assert blacklist.patterns == 2
+
+
+def test_domain_entry_overrides_patterns():
+    blacklist = compiled(domains=['example.com'], patterns=['www.example.com/ads/*'])
+    assert blacklist.match('www.example.com', '/watch')
+    assert blacklist.domains == 1
+
+
+def test_empty():
+    blacklist = compiled()
+    assert not blacklist.match('example.com', '/')
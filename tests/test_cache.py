@@ -0,0 +1,119 @@
+import email.utils
+import time
+
+import httpx
+import pytest
+
+import SilkRoad
+
+
+def http_date(offset):
+    return email.utils.formatdate(time.time() + offset, usegmt=True)
+
+
+class TestCacheLifetime:
+    def test_max_age_minus_age(self):
+        headers = httpx.Headers({'Cache-Control': 'max-age=100', 'Age': '30'})
+        assert SilkRoad.cache_lifetime(headers, 3600) == 70
+
+    def test_age_beyond_lifetime_is_zero(self):
+        headers = httpx.Headers({'Cache-Control': 'max-age=10', 'Age': '50'})
+        assert SilkRoad.cache_lifetime(headers, 3600) == 0
+
+    def test_s_maxage_overrides_max_age(self):
+        headers = httpx.Headers({'Cache-Control': 'max-age=10, s-maxage=500'})
+        assert SilkRoad.cache_lifetime(headers, 3600) == 500
+
+    @pytest.mark.parametrize('cache_control', ['private', 'no-store', 'private, max-age=600'])
+    def test_not_storable(self, cache_control):
+        headers = httpx.Headers({'Cache-Control': cache_control})
+        assert SilkRoad.cache_lifetime(headers, 3600) is None
+
+    def test_vary_star_not_storable(self):
+        headers = httpx.Headers({'Cache-Control': 'max-age=60', 'Vary': '*'})
+        assert SilkRoad.cache_lifetime(headers, 3600) is None
+
+    def test_expires_relative_to_date(self):
+        headers = httpx.Headers({'Date': http_date(0), 'Expires': http_date(120)})
+        assert 118 <= SilkRoad.cache_lifetime(headers, 3600) <= 120
+
+    def test_invalid_expires_is_stale(self):
+        headers = httpx.Headers({'Expires': '0', 'ETag': '"v1"'})
+        assert SilkRoad.cache_lifetime(headers, 3600) == 0
+
+    def test_last_modified_heuristic_is_capped(self):
+        headers = httpx.Headers({'Date': http_date(0), 'Last-Modified': http_date(-100000)})
+        assert SilkRoad.cache_lifetime(headers, 3600) == 3600
+
+    def test_no_cache_needs_revalidation(self):
+        headers = httpx.Headers({'Cache-Control': 'no-cache, max-age=600', 'ETag': '"v1"'})
+        assert SilkRoad.cache_lifetime(headers, 3600) == 0
+
+    def test_no_freshness_or_validator(self):
+        assert SilkRoad.cache_lifetime(httpx.Headers(), 3600) is None
+
+
+class TestCacheMeta:
+    def meta(self, response_headers, request_headers=None):
+        return SilkRoad.cache_manager.cache_meta(httpx.Headers(response_headers),
+                                                 httpx.Headers(request_headers or {}))
+
+    def test_fresh_response(self):
+        meta = self.meta({'Cache-Control': 'max-age=60'})
+        assert meta['expires_at'] - meta['stored_at'] == pytest.approx(60, abs=1)
+        assert meta['vary'] == {}
+
+    def test_set_cookie_not_stored(self):
+        assert self.meta({'Cache-Control': 'max-age=60', 'Set-Cookie': 'sid=1'}) is None
+
+    def test_authorization_needs_explicit_permission(self):
+        request = {'Authorization': 'Bearer t'}
+        assert self.meta({'Cache-Control': 'max-age=60'}, request) is None
+        for cache_control in ('public, max-age=60', 's-maxage=60', 'max-age=60, must-revalidate'):
+            assert self.meta({'Cache-Control': cache_control}, request) is not None
+
+    def test_vary_records_request_values(self):
+        meta = self.meta({'Cache-Control': 'max-age=60', 'Vary': 'Accept-Encoding, Accept-Language'},
+                         {'Accept-Language': 'en'})
+        assert meta['vary'] == {'accept-language': 'en'}
+
+
+class TestIsNotModified:
+    def test_etag_match(self):
+        assert SilkRoad.is_not_modified({'If-None-Match': '"a", "b"'}, '"b"', None)
+
+    def test_weak_comparison(self):
+        assert SilkRoad.is_not_modified({'If-None-Match': 'W/"a"'}, '"a"', None)
+        assert SilkRoad.is_not_modified({'If-None-Match': '"a"'}, 'W/"a"', None)
+
+    def test_etag_mismatch_ignores_date(self):
+        headers = {'If-None-Match': '"a"', 'If-Modified-Since': http_date(0)}
+        assert not SilkRoad.is_not_modified(headers, '"b"', http_date(-60))
+
+    def test_wildcard(self):
+        assert SilkRoad.is_not_modified({'If-None-Match': '*'}, '"x"', None)
+        assert not SilkRoad.is_not_modified({'If-None-Match': '*'}, None, None)
+
+    def test_if_modified_since(self):
+        headers = {'If-Modified-Since': http_date(0)}
+        assert SilkRoad.is_not_modified(headers, None, http_date(-60))
+        assert not SilkRoad.is_not_modified(headers, None, http_date(60))
+        assert not SilkRoad.is_not_modified(headers, None, None)
+
+
+class TestParseRangeHeader:
+    @pytest.mark.parametrize('value, expected', [
+        ('bytes=0-99', (0, 99, False)),
+        ('bytes=100-', (100, 999, True)),
+        ('bytes=900-5000', (900, 999, False)),
+        ('bytes=-100', (900, 999, False)),
+        ('bytes=-5000', (0, 999, False)),
+    ])
+    def test_valid(self, value, expected):
+        assert SilkRoad.parse_range_header(value, 1000) == expected
+
+    @pytest.mark.parametrize('value', [
+        None, '', 'items=0-1', 'bytes=0-1,5-6', 'bytes=5', 'bytes=a-b', 'bytes=-0', 'bytes=10-5', 'bytes=1000-',
+    ])
+    def test_invalid(self, value):
+        assert SilkRoad.parse_range_header(value, 1000) is None
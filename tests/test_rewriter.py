@@ -0,0 +1,55 @@
+import pytest
+
+import SilkRoad
+
+SITE = 'https://example.com'
+SCRIPT = b'<script src="/x.js"></script>'
+PAGE = ('<html><head><link href="/a.css"><script src=\'//cdn.example.net/b.js\'></script></head>'
+        '<body><a href="https://other.org/p">p</a><img src="http://img.example.com/i.png">'
+        '<p>丝绸之路</p></body></html>').encode('utf-8')
+
+
+def rewrite(chunks, engine, encoding='utf-8'):
+    rewriter = SilkRoad.StreamingLinkRewriter(engine, encoding)
+    output = b''.join(rewriter.feed(chunk) for chunk in chunks)
+    return output + rewriter.flush()
+
+
+@pytest.fixture
+def engine():
+    return SilkRoad.get_rewrite_engine('https', SITE, SCRIPT)
+
+
+def test_rewrites_links_and_injects_script(engine):
+    server = SilkRoad.config['SERVER'].encode('utf-8')
+    output = rewrite([PAGE], engine)
+    assert b'"' + server + SITE.encode() + b'/a.css"' in output
+    assert b"'" + server + b'https://cdn.example.net/b.js' in output
+    assert b'"' + server + b'https://other.org/p"' in output
+    assert b'"' + server + b'http://img.example.com/i.png"' in output
+    assert output.count(SCRIPT) == 1
+    assert output.endswith(b'</body>' + SCRIPT + b'</html>')
+
+
+def test_every_chunk_boundary(engine):
+    expected = rewrite([PAGE], engine)
+    for cut in range(1, len(PAGE)):
+        assert rewrite([PAGE[:cut], PAGE[cut:]], engine) == expected
+
+
+def test_byte_at_a_time(engine):
+    expected = rewrite([PAGE], engine)
+    assert rewrite([PAGE[i:i + 1] for i in range(len(PAGE))], engine) == expected
+
+
+def test_multibyte_encoding_split(engine):
+    page = PAGE.decode('utf-8').encode('gbk')
+    expected = rewrite([PAGE], engine)
+    for cut in range(1, len(page)):
+        assert rewrite([page[:cut], page[cut:]], engine, 'gbk') == expected
+
+
+def test_script_injected_once():
+    engine = SilkRoad.get_rewrite_engine('https', SITE, SCRIPT)
+    output = rewrite([b'<body>a</body>', b'<body>b</body>'], engine)
+    assert output.count(SCRIPT) == 1
@@ -0,0 +1,35 @@
+import SilkRoad
+
+
+def test_token_round_trip():
+    sessions = SilkRoad.SignedSessions(['key-a'])
+    token = sessions.generate_new_session()
+    assert sessions.is_session_exist(token)
+
+
+def test_rotation_keeps_old_tokens_valid():
+    old = SilkRoad.SignedSessions(['key-a'])
+    token = old.generate_new_session()
+    rotated = SilkRoad.SignedSessions(['key-b', 'key-a'])
+    assert rotated.is_session_exist(token)
+    # 新令牌由第一个密钥签发，只保留旧密钥的服务器无法验证
+    new_token = rotated.generate_new_session()
+    assert rotated.is_session_exist(new_token)
+    assert not old.is_session_exist(new_token)
+
+
+def test_retired_key_rejected():
+    token = SilkRoad.SignedSessions(['key-a']).generate_new_session()
+    assert not SilkRoad.SignedSessions(['key-b']).is_session_exist(token)
+
+
+def test_tampered_and_expired_tokens_rejected():
+    sessions = SilkRoad.SignedSessions(['key-a'])
+    token = sessions.generate_new_session()
+    kid, expires, nonce, signature = token.split('.')
+    assert not sessions.is_session_exist('.'.join((kid, 'ffffffffff', nonce, signature)))
+    assert not sessions.is_session_exist(token[:-2] + ('AA' if token[-2:] != 'AA' else 'BB'))
+    assert not sessions.is_session_exist('')
+    assert not sessions.is_session_exist('x' * 300)
+    expired = SilkRoad.SignedSessions(['key-a'], age=-1)
+    assert not expired.is_session_exist(expired.generate_new_session())